@@ -14,6 +14,9 @@
 """
 
 
+import errno
+import fcntl
+import json
 import os
 import shutil
 import subprocess
@@ -26,6 +29,80 @@ import config
 from blade_util import environ_add_path
 
 
+# ioctl to clone a file on the copy-on-write file systems, such as btrfs and xfs
+_FICLONE = 0x40049409
+
+_clone_supported = True
+
+
+def _link_file(src, dst):
+    """Clone the file if supported, or copy it.
+
+    It is used for the writable test data. A cloned file shares the data
+    with the src until either is modified. It is never hard linked, through
+    which the tests writing the test data would modify the files in the
+    source tree.
+    """
+    global _clone_supported
+    if _clone_supported:
+        try:
+            with open(src, 'rb') as s:
+                with open(dst, 'wb') as d:
+                    fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+            shutil.copystat(src, dst)
+            return
+        except (IOError, OSError) as e:
+            if os.path.exists(dst):
+                os.remove(dst)
+            if e.errno != errno.EXDEV:
+                _clone_supported = False
+    shutil.copy2(src, dst)
+
+
+def _file_key(path):
+    """The key to check whether the file in the runfiles dir is modified. """
+    st = os.lstat(path)
+    return [st.st_ino, st.st_size, st.st_mtime]
+
+
+def _load_runfiles_manifest(manifest_file, entries):
+    """Returns the keys of the files in the runfiles dir recorded in the
+    manifest, or None if the manifest is missing or its entries changed.
+    """
+    try:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get('entries') != json.loads(json.dumps(entries)):
+        return None
+    return dict((dest.encode('utf-8'), key) for dest, key in manifest.get('files', {}).iteritems())
+
+
+def _clean_runfiles(runfiles_dir, paths):
+    """Remove the files written into the runfiles dir by the last run. """
+    paths = frozenset(paths)
+    # The dirs of the test data
+    dirs = set()
+    for path in paths:
+        path = os.path.dirname(path)
+        while path and path not in dirs:
+            dirs.add(path)
+            path = os.path.dirname(path)
+    for dir, subdirs, files in os.walk(runfiles_dir):
+        rel_dir = os.path.relpath(dir, runfiles_dir)
+        for name in subdirs + files:
+            path = os.path.normpath(os.path.join(rel_dir, name))
+            full_path = os.path.join(dir, name)
+            if path in paths or path in dirs:
+                continue
+            if name in subdirs and not os.path.islink(full_path):
+                shutil.rmtree(full_path)
+                subdirs.remove(name)
+            else:
+                os.remove(full_path)
+
+
 class BinaryRunner(object):
     """BinaryRunner. """
     def __init__(self, targets, options, target_database):
@@ -47,8 +124,10 @@ class BinaryRunner(object):
         """Returns the executable path. """
         return os.path.join(self.build_dir, target.path, target.name)
 
-    def _runfiles_dir(self, target):
-        """Returns runfiles dir. """
+    def _runfiles_dir(self, target, shard=None):
+        """Returns runfiles dir, each shard of a test has its own one. """
+        if shard:
+            return '%s.shard%d.runfiles' % (self._executable(target), shard[0])
         return '%s.runfiles' % self._executable(target)
 
     def _get_prebuilt_files(self, target):
@@ -79,53 +158,14 @@ class BinaryRunner(object):
                 console.error_exit('%s could not exist with %s in testdata of %s' % (
                                    dest, item, target.fullname))
 
-    def _prepare_env(self, target):
-        """Prepare the test environment. """
-        runfiles_dir = self._runfiles_dir(target)
-        shutil.rmtree(runfiles_dir, ignore_errors=True)
-        os.mkdir(runfiles_dir)
-        # Build profile symlink
-        profile_link_name = os.path.basename(self.build_dir)
-        os.symlink(os.path.abspath(self.build_dir),
-                   os.path.join(runfiles_dir, profile_link_name))
-
-        # Prebuilt library symlink
-        for prebuilt_file in self._get_prebuilt_files(target):
-            src = os.path.abspath(prebuilt_file[0])
-            dst = os.path.join(runfiles_dir, prebuilt_file[1])
-            if os.path.lexists(dst):
-                console.warning('trying to make duplicate prebuilt symlink:\n'
-                                '%s -> %s\n'
-                                '%s -> %s already exists\n'
-                                'skipped, should check duplicate prebuilt '
-                                'libraries'
-                        % (dst, src, dst, os.path.realpath(dst)))
-                continue
-            os.symlink(src, dst)
+    def _get_test_data(self, target):
+        """Returns the (src, dest) of the test data of the target.
 
-        self._prepare_test_data(target)
-        run_env = dict(os.environ)
-        environ_add_path(run_env, 'LD_LIBRARY_PATH', runfiles_dir)
-        run_lib_paths = config.get_item('cc_binary_config', 'run_lib_paths')
-        if run_lib_paths:
-            for path in run_lib_paths:
-                if path.startswith('//'):
-                    path = path[2:]
-                path = os.path.abspath(path)
-                environ_add_path(run_env, 'LD_LIBRARY_PATH', path)
-        java_home = config.get_item('java_config', 'java_home')
-        if java_home:
-            java_home = os.path.abspath(java_home)
-            environ_add_path(run_env, 'PATH', os.path.join(java_home, 'bin'))
-
-        return run_env
-
-    def _prepare_test_data(self, target):
-        if 'testdata' not in target.data:
-            return
-        runfiles_dir = self._runfiles_dir(target)
+        dest is relative to the runfiles dir.
+        """
+        test_data = []
         dest_list = []
-        for i in target.data['testdata']:
+        for i in target.data.get('testdata', []):
             if isinstance(i, tuple):
                 src, dest = i
             else:
@@ -143,45 +183,150 @@ class BinaryRunner(object):
             dest = os.path.normpath(dest)
             self.__check_test_data_dest(target, dest, dest_list)
             dest_list.append(dest)
-            dest_path = os.path.join(runfiles_dir, dest)
-            if os.path.exists(dest_path):
-                console.warning('%s: %s already existed, could not prepare testdata.' %
-                                (target.fullname, dest))
-                continue
-            try:
-                os.makedirs(os.path.dirname(dest_path))
-            except OSError:
-                pass
+            test_data.append((src, dest))
 
-            if os.path.isfile(src):
-                shutil.copy2(src, dest_path)
-            elif os.path.isdir(src):
-                shutil.copytree(src, dest_path)
-
-        self._prepare_extra_test_data(target)
-
-    def _prepare_extra_test_data(self, target):
-        """Prepare extra test data specified in the .testdata file if it exists. """
+        # Extra test data specified in the .testdata file if it exists
         testdata = os.path.join(self.build_dir, target.path,
                                 '%s.testdata' % target.name)
         if os.path.isfile(testdata):
-            runfiles_dir = self._runfiles_dir(target)
             for line in open(testdata):
                 data = line.strip().split()
                 if len(data) == 1:
-                    src, dst = data[0], ''
+                    src, dest = data[0], ''
+                else:
+                    src, dest = data[0], data[1]
+                if not dest or dest.endswith('/'):
+                    dest = os.path.join(dest, os.path.basename(src))
+                test_data.append((src, os.path.normpath(dest)))
+        return test_data
+
+    def _runfiles_manifest(self, target, test_data):
+        """Returns the entries of the runfiles dir.
+
+        Each entry is (dest, src, kind), kind is 'symlink', or the
+        (inode, size, mtime) of the src file to be copied.
+
+        The test data are symlinked, the files and dirs of the test data
+        are copied one by one only if the test writes them, which is
+        declared by the writable_testdata attribute.
+        """
+        entries = []
+        # Prebuilt library symlink
+        for prebuilt_file in self._get_prebuilt_files(target):
+            entries.append((prebuilt_file[1], os.path.abspath(prebuilt_file[0]), 'symlink'))
+        writable = target.data.get('writable_testdata', False)
+        for src, dest in test_data:
+            if not writable:
+                if os.path.exists(src):
+                    entries.append((dest, os.path.abspath(src), 'symlink'))
+                continue
+            if os.path.isfile(src):
+                files = [(src, dest)]
+            elif os.path.isdir(src):
+                files = []
+                for dir, subdirs, names in os.walk(src):
+                    subdirs.sort()
+                    for name in sorted(names):
+                        path = os.path.join(dir, name)
+                        files.append((path, os.path.join(dest, os.path.relpath(path, src))))
+            else:
+                continue
+            for path, path_dest in files:
+                st = os.stat(path)
+                entries.append((path_dest, os.path.abspath(path),
+                                [st.st_ino, st.st_size, st.st_mtime]))
+        return entries
+
+    def _prepare_runfiles(self, target, shard=None, test_data=None):
+        """Prepare the runfiles dir of the target.
+
+        The writable test data are cloned or copied as the file system
+        supports, see _runfiles_manifest. The runfiles dir is reused if its
+        manifest is unchanged, in which the files modified or removed by
+        the last run are linked again.
+        """
+        runfiles_dir = self._runfiles_dir(target, shard)
+        profile_link_name = os.path.basename(self.build_dir)
+        if test_data is None:
+            test_data = self._get_test_data(target)
+        entries = self._runfiles_manifest(target, test_data)
+        manifest_file = '%s.manifest' % runfiles_dir
+        files = None
+        if os.path.isdir(runfiles_dir):
+            files = _load_runfiles_manifest(manifest_file, entries)
+        if files is None:
+            if os.path.exists(manifest_file):
+                os.remove(manifest_file)
+            shutil.rmtree(runfiles_dir, ignore_errors=True)
+            os.mkdir(runfiles_dir)
+            files = {}
+        else:
+            _clean_runfiles(runfiles_dir, [entry[0] for entry in entries] + [profile_link_name])
+        new_files = {}
+        for dest, src, kind in entries:
+            dest_path = os.path.join(runfiles_dir, dest)
+            if os.path.lexists(dest_path):
+                if dest not in files:
+                    console.warning('%s: %s already existed, could not prepare runfiles.' %
+                                    (target.fullname, dest))
+                    continue
+                if kind == 'symlink':
+                    unchanged = os.path.islink(dest_path) and os.readlink(dest_path) == src
                 else:
-                    src, dst = data[0], data[1]
-                dst = os.path.join(runfiles_dir, dst)
-                dst_dir = os.path.dirname(dst)
-                if not os.path.isdir(dst_dir):
-                    os.makedirs(dst_dir)
-                shutil.copy2(src, dst)
-
-    def _clean_target(self, target):
+                    unchanged = files[dest] == _file_key(dest_path)
+                if unchanged:
+                    new_files[dest] = files[dest]
+                    continue
+                # Modified by the last run
+                if os.path.isdir(dest_path) and not os.path.islink(dest_path):
+                    shutil.rmtree(dest_path)
+                else:
+                    os.remove(dest_path)
+            dest_dir = os.path.dirname(dest_path)
+            if not os.path.isdir(dest_dir):
+                os.makedirs(dest_dir)
+            if kind == 'symlink':
+                os.symlink(src, dest_path)
+                new_files[dest] = None
+            else:
+                _link_file(src, dest_path)
+                new_files[dest] = _file_key(dest_path)
+        with open(manifest_file, 'w') as f:
+            json.dump({'entries': entries, 'files': new_files}, f)
+
+        # Build profile symlink, removed after running
+        profile_link = os.path.join(runfiles_dir, profile_link_name)
+        if not os.path.lexists(profile_link):
+            os.symlink(os.path.abspath(self.build_dir), profile_link)
+
+    def _get_run_env(self, target, shard=None):
+        """Returns the environment to run the target. """
+        runfiles_dir = self._runfiles_dir(target, shard)
+        run_env = dict(os.environ)
+        environ_add_path(run_env, 'LD_LIBRARY_PATH', runfiles_dir)
+        run_lib_paths = config.get_item('cc_binary_config', 'run_lib_paths')
+        if run_lib_paths:
+            for path in run_lib_paths:
+                if path.startswith('//'):
+                    path = path[2:]
+                path = os.path.abspath(path)
+                environ_add_path(run_env, 'LD_LIBRARY_PATH', path)
+        java_home = config.get_item('java_config', 'java_home')
+        if java_home:
+            java_home = os.path.abspath(java_home)
+            environ_add_path(run_env, 'PATH', os.path.join(java_home, 'bin'))
+
+        return run_env
+
+    def _prepare_env(self, target, shard=None):
+        """Prepare the test environment. """
+        self._prepare_runfiles(target, shard)
+        return self._get_run_env(target, shard)
+
+    def _clean_target(self, target, shard=None):
         """clean the test target environment. """
         profile_link_name = os.path.basename(self.build_dir)
-        profile_link_path = os.path.join(self._runfiles_dir(target), profile_link_name)
+        profile_link_path = os.path.join(self._runfiles_dir(target, shard), profile_link_name)
         if os.path.exists(profile_link_path):
             os.remove(profile_link_path)
 
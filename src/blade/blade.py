@@ -14,15 +14,20 @@
 
 import os
 import time
-import json
 
 import config
 import console
+import phase_stats
+import profile_breakdown
+import remote_execution
+# Imported after config to avoid the circular import
+import cc_targets
 
 from blade_util import cpu_count
 from dependency_analyzer import analyze_deps
 from load_build_files import load_targets
 from blade_platform import BuildPlatform
+from blade_platform import CcFlagsManager
 from build_environment import BuildEnvironment
 from rules_generator import SconsRulesGenerator
 from rules_generator import NinjaRulesGenerator
@@ -89,33 +94,40 @@ class Blade(object):
 
         self.__build_time = time.time()
 
-        self.__build_platform = BuildPlatform()
-        self.build_environment = BuildEnvironment(self.__root_dir)
+        with phase_stats.phase('platform'):
+            self.__build_platform = BuildPlatform()
+            self.build_environment = BuildEnvironment(self.__root_dir)
+        self.__cc_flags_manager = None
 
         self.svn_root_dirs = []
 
-        self._verify_history_path = os.path.join(build_path, '.blade_verify.json')
+        self._verify_history_path = os.path.join(build_path, '.blade_verify.log')
         self._verify_history = {
             'header_inclusion_dependencies': {},  # path(.H) -> mtime(modification time)
         }
+        self._verify_history_log_lines = 0
+        self._loaded_verify_history = {}
 
     def load_targets(self):
         """Load the targets. """
         console.info('loading BUILDs...')
-        (self.__direct_targets,
-         self.__all_command_targets,
-         self.__build_targets) = load_targets(self.__command_targets,
-                                              self.__root_dir,
-                                              self)
+        with phase_stats.phase('load'):
+            (self.__direct_targets,
+             self.__all_command_targets,
+             self.__build_targets) = load_targets(self.__command_targets,
+                                                  self.__root_dir,
+                                                  self)
         console.info('loading done.')
         return self.__direct_targets, self.__all_command_targets  # For test
 
     def analyze_targets(self):
         """Expand the targets. """
         console.info('analyzing dependency graph...')
-        (self.__sorted_targets_keys,
-         self.__depended_targets) = analyze_deps(self.__build_targets)
+        with phase_stats.phase('analyze'):
+            (self.__sorted_targets_keys,
+             self.__depended_targets) = analyze_deps(self.__build_targets)
         self.__targets_expanded = True
+        phase_stats.count('targets', len(self.__build_targets))
 
         console.info('analyzing done.')
         return self.__build_targets  # For test
@@ -129,8 +141,9 @@ class Blade(object):
     def generate_build_rules(self):
         """Generate the constructing rules. """
         console.info('generating build rules...')
-        generator = self.get_build_rules_generator()
-        rules = generator.generate_build_script()
+        with phase_stats.phase('generate'):
+            generator = self.get_build_rules_generator()
+            rules = generator.generate_build_script()
         console.info('generating done.')
         return rules
 
@@ -141,17 +154,33 @@ class Blade(object):
 
     def verify(self):
         """Verify specific targets after build is complete. """
+        with phase_stats.phase('verify'):
+            return self._verify()
+
+    def _verify(self):
         verify_history = self.load_verify_history()
         error = 0
         header_inclusion_dependencies = config.get_item('cc_config',
                                                         'header_inclusion_dependencies')
         header_inclusion_history = verify_history['header_inclusion_dependencies']
-        for k in self.__sorted_targets_keys:
-            target = self.__build_targets[k]
-            if (header_inclusion_dependencies and
-                target.type == 'cc_library' and target.srcs):
-                if not target.verify_header_inclusion_dependencies(header_inclusion_history):
-                    error += 1
+        targets_files = []
+        if header_inclusion_dependencies:
+            for k in self.__sorted_targets_keys:
+                target = self.__build_targets[k]
+                if target.type == 'cc_library' and target.srcs:
+                    files = target.inclusion_stacks_files_to_verify(header_inclusion_history)
+                    if files:
+                        targets_files.append((target, files))
+        if targets_files:
+            paths = [path for target, files in targets_files for path in files]
+            inclusion_stacks = cc_targets.extract_inclusion_stacks(
+                    paths, self.__build_path, cpu_count())
+            for target, files in targets_files:
+                with profile_breakdown.measure(('verify rule type', target.type),
+                                               ('verify target', target.fullname)):
+                    if not target.verify_header_inclusion_dependencies(
+                            header_inclusion_history, inclusion_stacks):
+                        error += 1
         self.dump_verify_history()
         return error == 0
 
@@ -168,7 +197,8 @@ class Blade(object):
                                  self.__options,
                                  self.__target_database,
                                  self.__direct_targets)
-        return test_runner.run()
+        with phase_stats.phase('test'):
+            return test_runner.run()
 
     def query(self, targets):
         """Query the targets. """
@@ -325,6 +355,10 @@ class Blade(object):
         """Get all the targets to be build. """
         return self.__build_targets
 
+    def get_sorted_targets_keys(self):
+        """Get the targets keys in topological order. """
+        return self.__sorted_targets_keys
+
     def get_depended_target_database(self):
         """Get depended target database that query dependent targets directly. """
         return self.__depended_targets
@@ -382,10 +416,12 @@ class Blade(object):
                 and k not in self.__direct_targets):
                 continue
 
-            if native_builder == 'ninja':
-                blade_object.ninja_rules()
-            else:
-                blade_object.scons_rules()
+            with profile_breakdown.measure(('target type', target.type),
+                                           ('target', target.fullname)):
+                if native_builder == 'ninja':
+                    blade_object.ninja_rules()
+                else:
+                    blade_object.scons_rules()
             rules = blade_object.get_rules()
             if rules:
                 rules_buf.append('\n')
@@ -396,6 +432,14 @@ class Blade(object):
         """Return handle of the platform class. """
         return self.__build_platform
 
+    def get_cc_flags_manager(self):
+        """Return the C/C++ flags manager shared by the rules generator and the targets. """
+        if self.__cc_flags_manager is None:
+            self.__cc_flags_manager = CcFlagsManager(self.__options,
+                                                     self.__build_path,
+                                                     self.__build_platform.get_gcc_version())
+        return self.__cc_flags_manager
+
     def get_sources_keyword_list(self):
         """This keywords list is used to check the source files path.
 
@@ -408,14 +452,58 @@ class Blade(object):
         return keywords
 
     def load_verify_history(self):
+        """Load the verify history by replaying the history log.
+
+        Each line of the log is an entry "section\tpath\tmtime", and the
+        last one wins. An entry with empty mtime means the path is removed.
+        """
+        self._verify_history_log_lines = 0
         if os.path.exists(self._verify_history_path):
             with open(self._verify_history_path) as f:
-                self._verify_history = json.load(f)
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != 3 or fields[0] not in self._verify_history:
+                        continue
+                    self._verify_history_log_lines += 1
+                    section, path, mtime = fields
+                    if mtime:
+                        self._verify_history[section][path] = int(mtime)
+                    else:
+                        self._verify_history[section].pop(path, None)
+        self._loaded_verify_history = dict((section, dict(history))
+                for section, history in self._verify_history.iteritems())
         return self._verify_history
 
+    def _compact_verify_history(self):
+        lines = []
+        for section, history in self._verify_history.iteritems():
+            for path, mtime in history.iteritems():
+                lines.append('%s\t%s\t%d\n' % (section, path, mtime))
+        tmp_path = self._verify_history_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.writelines(lines)
+        os.rename(tmp_path, self._verify_history_path)
+
     def dump_verify_history(self):
-        with open(self._verify_history_path, 'w') as f:
-            json.dump(self._verify_history, f)
+        """Append the changed entries to the history log.
+
+        The log is compacted when the stale entries outnumber the alive ones.
+        """
+        lines, alive = [], 0
+        for section, history in self._verify_history.iteritems():
+            alive += len(history)
+            loaded_history = self._loaded_verify_history[section]
+            for path, mtime in history.iteritems():
+                if loaded_history.get(path) != mtime:
+                    lines.append('%s\t%s\t%d\n' % (section, path, mtime))
+            for path in loaded_history:
+                if path not in history:
+                    lines.append('%s\t%s\t\n' % (section, path))
+        if self._verify_history_log_lines + len(lines) > 2 * alive + 1024:
+            self._compact_verify_history()
+        elif lines:
+            with open(self._verify_history_path, 'a') as f:
+                f.writelines(lines)
 
     def parallel_jobs_num(self):
         """Tune the jobs num. """
@@ -428,7 +516,13 @@ class Blade(object):
         jobs_num = 0
         distcc_enabled = config.get_item('distcc_config', 'enabled')
 
-        if distcc_enabled and self.build_environment.distcc_env_prepared:
+        remote_slots = remote_execution.slots()
+        if remote_slots:
+            jobs_num = remote_slots + cpu_count()
+        elif distcc_enabled and self.build_environment.distcc_slots:
+            # The ninja pools limit the distributed and local actions
+            jobs_num = self.build_environment.distcc_slots + cpu_count()
+        elif distcc_enabled and self.build_environment.distcc_env_prepared:
             # Distcc cost doesn;t much local cpu, jobs can be quite large.
             distcc_num = len(self.build_environment.get_distcc_hosts_list())
             jobs_num = min(max(int(1.5 * distcc_num), 1), 20)
@@ -80,11 +80,16 @@ from string import Template
 
 import blade
 import build_attributes
+import build_trace
 import console
 import config
+import phase_stats
+import profile_breakdown
+import remote_execution
+import toolchain_server
 
 from blade_util import find_blade_root_dir, find_file_bottom_up
-from blade_util import get_cwd
+from blade_util import get_cwd, md5sum_file
 from blade_util import lock_file, unlock_file
 from command_args import CmdArguments
 
@@ -263,17 +268,94 @@ def _ninja_build(options):
         cmd.append('-k0')
     if options.verbose:
         cmd.append('-v')
-    return _run_native_builder(cmd)
+    if blade.blade.build_environment.distcc_pump:
+        # Start the include server for the distcc pump mode
+        cmd.insert(0, 'pump')
+    build_dir = blade.blade.get_build_path()
+    server = toolchain_server.start(build_dir)
+    # Started after forking the toolchain server, which runs in threads
+    executor = remote_execution.start(build_dir)
+    try:
+        return _run_native_builder(cmd)
+    finally:
+        remote_execution.stop(build_dir, executor)
+        toolchain_server.stop(build_dir, server)
+
+
+def _native_build(options, native_builder):
+    if native_builder == 'ninja':
+        return _ninja_build(options)
+    return _scons_build(options)
+
+
+def _build_outputs_digests(build_dir):
+    """Returns the md5 of the outputs in the build dir.
+
+    The files in the top dir of the build dir and the hidden files are
+    the logs and states of blade and the native builders, not outputs.
+    The precompiled headers are skipped too, they are memory dumps of the
+    compiler and never reproducible, unlike the objects compiled with them.
+    """
+    digests = {}
+    for root, dirs, files in os.walk(build_dir):
+        if root == build_dir:
+            continue
+        for name in files:
+            path = os.path.join(root, name)
+            if (name.startswith('.') or name.endswith('.gch') or
+                os.path.islink(path)):
+                continue
+            digests[path] = md5sum_file(path)
+    return digests
+
+
+def _check_reproducible(options, native_builder):
+    """Rebuild without ccache and compare the outputs of the two builds. """
+    build_dir = blade.blade.get_build_path()
+    digests = _build_outputs_digests(build_dir)
+    clean(options)
+    console.info('rebuilding to check the reproducibility...')
+    console.flush()
+    os.environ['CCACHE_DISABLE'] = '1'
+    with phase_stats.phase('rebuild'):
+        returncode = _native_build(options, native_builder)
+    if returncode != 0:
+        console.error('rebuilding failure.')
+        return returncode
+    new_digests = _build_outputs_digests(build_dir)
+    # An output missing in either build is a difference too
+    paths = set(digests) | set(new_digests)
+    differences = sorted([path for path in paths
+                          if digests.get(path) != new_digests.get(path)])
+    if differences:
+        console.error('%d of %d outputs are not reproducible:' % (
+                      len(differences), len(paths)))
+        for path in differences:
+            if path not in new_digests:
+                console.error('  %s (missing in the rebuild)' % path)
+            elif path not in digests:
+                console.error('  %s (missing in the first build)' % path)
+            else:
+                console.error('  %s' % path)
+        return 1
+    console.info('all of %d outputs are reproducible.' % len(digests))
+    return 0
 
 
 def build(options):
     _check_code_style(_TARGETS)
     console.info('building...')
     console.flush()
-    if config.get_item('global_config', 'native_builder') == 'ninja':
-        returncode = _ninja_build(options)
-    else:
-        returncode = _scons_build(options)
+    native_builder = config.get_item('global_config', 'native_builder')
+    trace = None
+    if options.build_trace:
+        trace = build_trace.BuildTrace(blade.blade, native_builder)
+        trace.start()
+    with phase_stats.phase('build'):
+        returncode = _native_build(options, native_builder)
+    if trace:
+        trace.stop()
+        trace.report(options.jobs or blade.blade.parallel_jobs_num())
     if returncode != 0:
         console.error('building failure.')
         return returncode
@@ -281,6 +363,8 @@ def build(options):
         console.error('building failure.')
         return 1
     console.info('building done.')
+    if options.check_reproducible:
+        return _check_reproducible(options, native_builder)
     return 0
 
 
@@ -346,13 +430,17 @@ def load_config(options, blade_root_dir):
     """load the configuration file and parse. """
     # Init global build attributes
     build_attributes.initialize(options)
-    config.load_files(blade_root_dir, options.load_local_config)
+    with phase_stats.phase('config'):
+        config.load_files(blade_root_dir, options.load_local_config)
 
 
 def setup_build_dir(options):
     build_path_format = config.get_item('global_config', 'build_path_template')
     s = Template(build_path_format)
     build_dir = s.substitute(bits=options.bits, profile=options.profile)
+    if getattr(options, 'profile_generate', False):
+        # Keep the instrumented outputs away from the normal ones
+        build_dir += '_pgo'
     if not os.path.exists(build_dir):
         os.mkdir(build_dir)
     return build_dir
@@ -465,6 +553,7 @@ def run_subcommand_profile(command, options, targets, blade_path, build_dir):
     # wll not modify the local exit_code.
     # so we use a mutable object list to obtain the return value of run_subcommand
     exit_code = [-1]
+    profile_breakdown.enable()
     cProfile.runctx("exit_code[0] = run_subcommand(command, options, targets, blade_path, build_dir)",
                     globals(), locals(), pstats_file)
     p = pstats.Stats(pstats_file)
@@ -474,6 +563,7 @@ def run_subcommand_profile(command, options, targets, blade_path, build_dir):
                  'you can use gprof2dot or vprof to convert it to graph' % pstats_file)
     console.info('gprof2dot.py -f pstats --color-nodes-by-selftime %s'
                  ' | dot -T pdf -o blade.pdf' % pstats_file)
+    profile_breakdown.report(build_dir)
     return exit_code[0]
 
 
@@ -493,12 +583,20 @@ def _main(blade_path):
     generate_scm(build_dir)
 
     lock_file_fd = lock_workspace()
+    exit_code = 1
     try:
         if options.profiling:
-            return run_subcommand_profile(command, options, targets, blade_path, build_dir)
-        return run_subcommand(command, options, targets, blade_path, build_dir)
+            exit_code = run_subcommand_profile(command, options, targets, blade_path, build_dir)
+        else:
+            exit_code = run_subcommand(command, options, targets, blade_path, build_dir)
+        return exit_code
     finally:
         unlock_workspace(lock_file_fd)
+        try:
+            phase_stats.dump(build_dir, command, targets, exit_code)
+        except (IOError, OSError), e:
+            # Never hide the result of the command
+            console.warning('Failed to write the stats: %s' % e)
 
 
 def main(blade_path):
@@ -249,28 +249,124 @@ class CcFlagsManager(object):
         self.options = options
         self.build_dir = build_dir
         self.gcc_version = gcc_version
+        self.split_dwarf_flags = None
 
-    def _filter_out_invalid_flags(self, flag_list, language='c'):
-        """Filter the unsupported compilation flags. """
+    def _probe_flags(self, flag_list, command, outputs, kind, quiet=False):
+        """Filter the flags unsupported by the compiler or the linker.
+
+        command is the template of the probing command which reads the
+        source from stdin, '%s' in it is replaced by each flag. outputs
+        are the files written by the command. The unsupported flags are
+        warned unless quiet, when the caller has a fallback for them.
+        """
         supported_flags, unsupported_flags = [], []
-        # Put compilation output into test.o instead of /dev/null
-        # because the command line with '--coverage' below exit
-        # with status 1 which makes '--coverage' unsupported
-        # echo "int main() { return 0; }" | gcc -o /dev/null -c -x c --coverage - > /dev/null 2>&1
-        obj = os.path.join(self.build_dir, 'test.o')
         for flag in var_to_list(flag_list):
-            cmd = ('echo "int main() { return 0; }" | '
-                   '%s -o %s -c -x %s %s - > /dev/null 2>&1 && rm -f %s' % (
-                   self.cc, obj, language, flag, obj))
+            cmd = 'echo "int main() { return 0; }" | %s > /dev/null 2>&1' % (
+                  command % flag)
             if subprocess.call(cmd, shell=True) == 0:
                 supported_flags.append(flag)
             else:
                 unsupported_flags.append(flag)
-        if unsupported_flags:
-            console.warning('Unsupported C/C++ flags: %s' %
-                            ', '.join(unsupported_flags))
+            for output in outputs:
+                if os.path.exists(output):
+                    os.remove(output)
+        if unsupported_flags and not quiet:
+            console.warning('Unsupported %s flags: %s' % (
+                            kind, ', '.join(unsupported_flags)))
         return supported_flags
 
+    def _filter_out_invalid_flags(self, flag_list, language='c', quiet=False):
+        """Filter the unsupported compilation flags. """
+        # Put compilation output into test.o instead of /dev/null
+        # because the command line with '--coverage' below exit
+        # with status 1 which makes '--coverage' unsupported
+        # echo "int main() { return 0; }" | gcc -o /dev/null -c -x c --coverage - > /dev/null 2>&1
+        obj = os.path.join(self.build_dir, 'test.o')
+        # Written beside the object by -gsplit-dwarf
+        dwo = os.path.join(self.build_dir, 'test.dwo')
+        return self._probe_flags(flag_list,
+                                 '%s -o %s -c -x %s %%s -' % (self.cc, obj, language),
+                                 [obj, dwo], 'C/C++', quiet)
+
+    def _filter_out_invalid_link_flags(self, flag_list, base_flags=None):
+        """Filter the link flags unsupported by the compiler or the linker.
+
+        Each flag is probed together with the base flags, such as the
+        -fuse-ld option which selects the linker.
+        """
+        output = os.path.join(self.build_dir, 'test')
+        base_flags = ' '.join(var_to_list(base_flags))
+        return self._probe_flags(flag_list,
+                                 '%s -o %s -x c - %s %%s' % (self.cc, output, base_flags),
+                                 [output], 'link')
+
+    def _get_linker_flags(self):
+        """Get the flags to select the linker and its threads. """
+        link_config = config.get_section('link_config')
+        linker = link_config['linker']
+        if not linker:
+            return []
+        linker_flags = self._filter_out_invalid_link_flags('-fuse-ld=%s' % linker)
+        if not linker_flags:
+            return []
+        threads = link_config['link_threads']
+        if threads > 0:
+            if linker == 'gold':
+                threads_flag = '-Wl,--threads,--thread-count=%d' % threads
+            elif linker == 'lld':
+                threads_flag = '-Wl,--threads=%d' % threads
+            else:
+                console.warning('link_threads is not supported by linker %s' % linker)
+                return linker_flags
+            linker_flags += self._filter_out_invalid_link_flags(threads_flag,
+                                                                linker_flags)
+        return linker_flags
+
+    def _get_reproducible_flags(self):
+        """Get the flags to remove the blade root and build dir from outputs. """
+        flags = []
+        for path, new_path in [(os.getcwd(), '.'), (self.build_dir, 'blade-bin')]:
+            flag = '-ffile-prefix-map=%s=%s' % (path, new_path)
+            if not self._filter_out_invalid_flags(flag, quiet=True):
+                # Only the debug information is remapped by the old compilers,
+                # the fallback is checked and warned with the other flags
+                flag = '-fdebug-prefix-map=%s=%s' % (path, new_path)
+            flags.append(flag)
+        return flags
+
+    def get_arflags(self):
+        """Get the flags passed to ar. """
+        arflags = ''.join(config.get_item('cc_library_config', 'arflags'))
+        if config.get_item('cc_config', 'reproducible') and 'D' not in arflags:
+            # Zero the timestamps, uids and gids of members
+            arflags += 'D'
+        return arflags
+
+    def _get_pgo_flags(self):
+        """Get the flags of profile guided optimization.
+
+        The build dir is stripped from the names of the profiles, so the
+        profiles generated in the instrumented build dir are valid in the
+        normal one and across checkouts. It needs gcc 12 or later, the
+        profiles never match without it.
+        """
+        profile_use = getattr(self.options, 'profile_use', None)
+        if getattr(self.options, 'profile_generate', False):
+            profile_dir = os.path.abspath(os.path.join(self.build_dir, 'pgo_profiles'))
+            flags = ['-fprofile-generate=%s' % profile_dir,
+                     '-fprofile-update=atomic']
+        elif profile_use:
+            flags = ['-fprofile-use=%s' % profile_use, '-fprofile-correction']
+        else:
+            return []
+        prefix_flag = '-fprofile-prefix-path=%s' % os.path.abspath(self.build_dir)
+        if not self._filter_out_invalid_flags(prefix_flag, quiet=True):
+            console.error_exit('PGO requires %s of gcc 12 or later to match the '
+                               'profiles across the build dirs, which is not '
+                               'supported by %s' % (prefix_flag.split('=')[0], self.cc))
+        flags.append(prefix_flag)
+        return flags
+
     def set_cc(self, cc):
         """set up the compiler. """
         self.cc = cc
@@ -286,17 +382,37 @@ class CcFlagsManager(object):
             flags_except_warning = ['-m%s' % self.options.m]
             linkflags = ['-m%s' % self.options.m]
         flags_except_warning.append('-pipe')
+        linker_flags = self._get_linker_flags()
+        linkflags += linker_flags
 
         # Debugging information setting
         debug_info_level = global_config['debug_info_level']
         debug_info_options = cc_config['debug_info_levels'][debug_info_level]
         flags_except_warning += debug_info_options
+        # -gsplit-dwarf is added by the targets, see CcTarget._get_compile_flags
+        if debug_info_level != 'no':
+            if cc_config['split_dwarf'] and cc_config['dwp']:
+                # The dwp of binutils crashes on the DWARF 5 split units,
+                # which are emitted by default since gcc 11
+                flags_except_warning.append('-gdwarf-4')
+            if cc_config['gdb_index']:
+                flags_except_warning.append('-ggnu-pubnames')
+                linkflags += self._filter_out_invalid_link_flags('-Wl,--gdb-index',
+                                                                 linker_flags)
 
         # Option debugging flags
         if self.options.profile == 'debug':
             flags_except_warning.append('-fstack-protector')
         elif self.options.profile == 'release':
             flags_except_warning.append('-DNDEBUG')
+            link_config = config.get_section('link_config')
+            if link_config['release_gc_sections']:
+                flags_except_warning += ['-ffunction-sections', '-fdata-sections']
+                linkflags += self._filter_out_invalid_link_flags('-Wl,--gc-sections',
+                                                                 linker_flags)
+            if link_config['release_icf']:
+                linkflags += self._filter_out_invalid_link_flags('-Wl,--icf=safe',
+                                                                 linker_flags)
 
         flags_except_warning += [
                 '-D_FILE_OFFSET_BITS=64',
@@ -319,11 +435,29 @@ class CcFlagsManager(object):
                 linkflags += ['-Wl,--whole-archive', '-lgcov',
                               '-Wl,--no-whole-archive']
 
+        flags_except_warning += self._get_pgo_flags()
+        if cc_config['reproducible']:
+            flags_except_warning += self._get_reproducible_flags()
+        if getattr(self.options, 'profile_generate', False):
+            linkflags.append('-fprofile-generate')
+
         flags_except_warning = self._filter_out_invalid_flags(
                 flags_except_warning)
 
         return (flags_except_warning, linkflags)
 
+    def get_split_dwarf_flags(self):
+        """Get the flags to split the debug info into .dwo files, empty if
+        it is disabled or unsupported.
+        """
+        if self.split_dwarf_flags is None:
+            self.split_dwarf_flags = []
+            cc_config = config.get_section('cc_config')
+            debug_info_level = config.get_item('global_config', 'debug_info_level')
+            if cc_config['split_dwarf'] and debug_info_level != 'no':
+                self.split_dwarf_flags = self._filter_out_invalid_flags('-gsplit-dwarf')
+        return self.split_dwarf_flags
+
     def get_warning_flags(self):
         """Get the warning flags. """
         cc_config = config.get_section('cc_config')
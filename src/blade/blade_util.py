@@ -20,7 +20,9 @@ import sys
 import re
 import string
 import signal
+import socket
 import subprocess
+import time
 
 import console
 
@@ -45,10 +47,11 @@ def md5sum_str(user_str):
 
 def md5sum_file(file_name):
     """Calculate md5sum of the file. """
-    f = open(file_name)
-    digest = md5sum_str(f.read())
-    f.close()
-    return digest
+    m = md5.md5()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            m.update(block)
+    return m.hexdigest()
 
 
 def md5sum(obj):
@@ -204,6 +207,17 @@ def load_scm(build_dir):
     return revision, url
 
 
+def build_stamp():
+    """Returns the build time, builder and host recorded in the binaries.
+
+    They are fixed if SOURCE_DATE_EPOCH is set for reproducible builds.
+    """
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if epoch is not None:
+        return time.asctime(time.gmtime(int(epoch))), '', ''
+    return time.asctime(), os.getenv('USER'), socket.gethostname()
+
+
 def environ_add_path(env, key, path):
     """Add path to PATH link environments, such as PATH, LD_LIBRARY_PATH, etc"""
     old = env.get(key)
@@ -14,12 +14,50 @@
 import glob
 import math
 import os
+import socket
 import subprocess
+import threading
 import time
 
 import console
 
 
+# The default port of distccd and the default slots of each kind of host
+_DISTCC_PORT = 3632
+_DISTCC_TCP_SLOTS = 4
+_DISTCC_LOCAL_SLOTS = 2
+
+
+def _parse_distcc_host(spec):
+    """Returns the (address, port, slots) of a distcc host.
+
+    The spec is in the form of HOST[:PORT][/LIMIT][,OPTIONS], see distcc(1).
+    The address is None for the hosts which can not be probed by connecting,
+    such as localhost and the hosts accessed by ssh.
+    """
+    spec = spec.split(',')[0]
+    limit = 0
+    if '/' in spec:
+        spec, limit = spec.split('/', 1)
+        limit = int(limit) if limit.isdigit() else 0
+    if spec == 'localhost' or '@' in spec:
+        return None, 0, limit or _DISTCC_LOCAL_SLOTS
+    host, port = spec, _DISTCC_PORT
+    if ':' in spec:
+        host, port = spec.rsplit(':', 1)
+        port = int(port) if port.isdigit() else _DISTCC_PORT
+    return host, port, limit or _DISTCC_TCP_SLOTS
+
+
+def _distcc_host_reachable(address, port, timeout):
+    try:
+        sock = socket.create_connection((address, port), timeout)
+        sock.close()
+        return True
+    except (socket.error, socket.timeout):
+        return False
+
+
 class BuildEnvironment(object):
     """Managers ccache, distcc, dccc. """
     def __init__(self, blade_root_dir, distcc_hosts_list=None):
@@ -39,6 +77,9 @@ class BuildEnvironment(object):
         if self.distcc_installed and not self.distcc_host_list:
             console.warning('DISTCC_HOSTS not set but you have '
                             'distcc installed, will just build locally')
+        # The total slots of the reachable hosts, set by probe_distcc_hosts
+        self.distcc_slots = 0
+        self.distcc_pump = False
         self.distcc_log_file = os.environ.get('DISTCC_LOG', '')
         if self.distcc_log_file:
             console.info('distcc log: %s' % self.distcc_log_file)
@@ -157,6 +198,62 @@ class BuildEnvironment(object):
         """Returns the hosts list. """
         return filter(lambda x: x, self.distcc_host_list.split(' '))
 
+    def probe_distcc_hosts(self, timeout, pump=False):
+        """Drop the unreachable distcc hosts and count the slots of the rest.
+
+        The hosts are probed concurrently by connecting to their distccd.
+        The compiles fall back to local if no host is reachable. The hosts
+        are marked to be sent the preprocessing jobs in pump mode.
+
+        Returns the distcc hosts to use.
+        """
+        specs = self.get_distcc_hosts_list()
+        reachable = [True] * len(specs)
+        threads = []
+        for i, spec in enumerate(specs):
+            if spec.startswith('-') or spec.startswith('+'):
+                continue  # Options such as --randomize
+            address, port, slots = _parse_distcc_host(spec)
+            if address is None:
+                continue
+            def probe(i=i, address=address, port=port):
+                reachable[i] = _distcc_host_reachable(address, port, timeout)
+            thread = threading.Thread(target=probe)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        hosts, self.distcc_slots = [], 0
+        for i, spec in enumerate(specs):
+            if not reachable[i]:
+                console.warning('distcc host %s is unreachable, skipped' % spec)
+                continue
+            if spec.startswith('-') or spec.startswith('+'):
+                hosts.append(spec)
+                continue
+            address, port, slots = _parse_distcc_host(spec)
+            if pump and address is not None and ',cpp' not in spec:
+                spec += ',cpp,lzo'
+            hosts.append(spec)
+            self.distcc_slots += slots
+        if not self.distcc_slots:
+            console.warning('No distcc host is reachable, will just build locally')
+            self.distcc_env_prepared = False
+            return []
+        if pump:
+            self.distcc_pump = self._check_pump_install()
+        return hosts
+
+    @staticmethod
+    def _check_pump_install():
+        """Check the pump script of distcc is installed or not. """
+        for path in os.environ.get('PATH', '').split(os.pathsep):
+            if os.access(os.path.join(path, 'pump'), os.X_OK):
+                return True
+        console.warning('pump of distcc is not found, will not run in pump mode')
+        return False
+
     def _add_rule(self, rule):
         """Append to buffer. """
         self.rules_buf.append(rule)
@@ -0,0 +1,407 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   March 19, 2018
+
+
+"""
+ This module traces the actions run by the native builder during building,
+ maps them back to the blade targets, writes a chrome trace-event file
+ (chrome://tracing) and reports where the building time went.
+
+"""
+
+
+import json
+import os
+import re
+import threading
+import time
+
+import console
+
+
+# The file the scons actions record their timing to, set in environment
+# so that the echospawn in scons process could see it
+TRACE_ENV_NAME = 'BLADE_BUILD_TRACE'
+
+_SCONS_TRACE_FILE = '.blade_scons_trace'
+
+_TRACE_FILE = 'blade_build_trace.json'
+
+_TOP_N = 10
+
+_TIMELINE_BUCKETS = 20
+
+
+def _read_processes():
+    """Returns {pid: (ppid, comm, rss in KB)} of all processes. """
+    page_kb = os.sysconf('SC_PAGE_SIZE') / 1024
+    processes = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            stat = open('/proc/%s/stat' % pid).read()
+        except IOError:
+            continue
+        # The comm field may contain spaces, so split after it
+        left, right = stat.find('('), stat.rfind(')')
+        fields = stat[right + 2:].split()
+        processes[int(pid)] = (int(fields[1]), stat[left + 1:right],
+                               int(fields[21]) * page_kb)
+    return processes
+
+
+def _read_cmdline(pid):
+    try:
+        return open('/proc/%d/cmdline' % pid).read().replace('\0', ' ')
+    except IOError:
+        return ''
+
+
+class _MemorySampler(threading.Thread):
+    """Samples the peak memory of the actions run by the native builder.
+
+    An action is a child process of the native builder, its memory is the
+    total RSS of the process tree rooted from it.
+    """
+    def __init__(self, native_builder, interval=0.1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.native_builder = native_builder
+        self.interval = interval
+        self.builder_pid = None
+        self.peaks = {}     # pid -> peak RSS(KB)
+        self.cmdlines = {}  # pid -> command line
+        self.stopped = threading.Event()
+
+    def _find_builder(self, processes, children):
+        queue = list(children.get(os.getpid(), []))
+        while queue:
+            pid = queue.pop()
+            if processes[pid][1] == self.native_builder:
+                return pid
+            queue += children.get(pid, [])
+        return None
+
+    def _sample(self):
+        processes = _read_processes()
+        children = {}
+        for pid, (ppid, comm, rss) in processes.iteritems():
+            children.setdefault(ppid, []).append(pid)
+        if self.builder_pid is None:
+            self.builder_pid = self._find_builder(processes, children)
+            if self.builder_pid is None:
+                return
+        for action in children.get(self.builder_pid, []):
+            rss, queue = 0, [action]
+            while queue:
+                pid = queue.pop()
+                rss += processes[pid][2]
+                queue += children.get(pid, [])
+            if action not in self.cmdlines:
+                self.cmdlines[action] = _read_cmdline(action)
+            self.peaks[action] = max(self.peaks.get(action, 0), rss)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self._sample()
+            except (IOError, OSError, IndexError, ValueError):
+                # Processes come and go during sampling
+                pass
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class BuildTrace(object):
+    """Trace the actions of one native building. """
+    def __init__(self, blade, native_builder):
+        self.blade = blade
+        self.build_dir = blade.get_build_path()
+        self.native_builder = native_builder
+        self.ninja_log = os.path.join(self.build_dir, '.ninja_log')
+        self.scons_trace = os.path.join(self.build_dir, _SCONS_TRACE_FILE)
+        self.ninja_log_offset = 0
+        self.start_time = 0
+        self.sampler = None
+
+    def start(self):
+        """Called before the native builder starts. """
+        self.start_time = time.time()
+        if self.native_builder == 'ninja':
+            if os.path.exists(self.ninja_log):
+                self.ninja_log_offset = os.path.getsize(self.ninja_log)
+        else:
+            open(self.scons_trace, 'w').close()
+            os.environ[TRACE_ENV_NAME] = os.path.abspath(self.scons_trace)
+        if os.path.isdir('/proc'):
+            self.sampler = _MemorySampler(self.native_builder)
+            self.sampler.start()
+
+    def stop(self):
+        """Called after the native builder exits. """
+        if self.sampler:
+            self.sampler.stop()
+        os.environ.pop(TRACE_ENV_NAME, None)
+
+    def _load_ninja_actions(self):
+        """Load the actions of this building from .ninja_log.
+
+        The time in .ninja_log is in milliseconds since the start of ninja.
+        An action with multiple outputs has a line for each of them, which
+        are merged by the start, end and hash of the command.
+        """
+        actions = []
+        merged = {}
+        if not os.path.exists(self.ninja_log):
+            return actions
+        f = open(self.ninja_log)
+        offset = self.ninja_log_offset
+        recompacted = os.path.getsize(self.ninja_log) < offset
+        if not recompacted:
+            f.seek(offset)
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 4:
+                continue
+            start, end, mtime, output = fields[:4]
+            if recompacted:
+                # Ninja rewrote the log on startup, keep the entries
+                # whose output was modified after the building started
+                # (in seconds before ninja 1.10, in nanoseconds since then)
+                mtime = int(mtime)
+                if mtime > 1e12:
+                    mtime /= 1e9
+                if mtime < int(self.start_time):
+                    continue
+            key = (start, end, fields[4] if len(fields) > 4 else output)
+            if key in merged:
+                merged[key]['outputs'].append(output)
+                continue
+            merged[key] = {
+                'output': output,
+                'outputs': [output],
+                'start': int(start) / 1000.0,
+                'end': int(end) / 1000.0,
+            }
+            actions.append(merged[key])
+        f.close()
+        return actions
+
+    def _load_scons_actions(self):
+        """Load the actions recorded by echospawn of scons. """
+        actions = []
+        if not os.path.exists(self.scons_trace):
+            return actions
+        for line in open(self.scons_trace):
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 4:
+                continue
+            start, end, pid, output = fields
+            actions.append({
+                'output': output,
+                'start': float(start) - self.start_time,
+                'end': float(end) - self.start_time,
+                'pid': int(pid),
+            })
+        os.remove(self.scons_trace)
+        return actions
+
+    def _fill_peak_memory(self, actions):
+        if not self.sampler:
+            return
+        peaks, cmdlines = self.sampler.peaks, self.sampler.cmdlines
+        if self.native_builder == 'ninja':
+            # Match the sampled processes with actions by the outputs
+            # appear in their command lines
+            outputs = {}
+            for action in actions:
+                for output in action['outputs']:
+                    outputs[output] = action
+            for pid, cmdline in cmdlines.iteritems():
+                for token in cmdline.split():
+                    action = outputs.get(token.strip('\'"'))
+                    if action:
+                        action['rss'] = max(action.get('rss', 0), peaks[pid])
+                        break
+        else:
+            for action in actions:
+                if action['pid'] in peaks:
+                    action['rss'] = peaks[action['pid']]
+
+    def _output_targets(self):
+        """Returns {output file: target key} from the generated rules. """
+        build_dir = self.build_dir.rstrip('/') + '/'
+        if self.native_builder == 'ninja':
+            pattern = None
+        else:
+            pattern = re.compile(r'"(%s[^"]+)"' % re.escape(build_dir))
+        output_targets = {}
+        for key, target in self.blade.get_build_targets().iteritems():
+            for rule in target.get_rules():
+                if pattern:
+                    for output in pattern.findall(rule):
+                        output_targets.setdefault(output, key)
+                elif rule.startswith('build '):
+                    outputs = rule[len('build '):rule.find(':')]
+                    for output in outputs.split():
+                        if output != '|':
+                            output_targets[output] = key
+        return output_targets
+
+    def _guess_target(self, output, build_targets):
+        """Guess the target of output by the conventions of output paths. """
+        build_dir = self.build_dir.rstrip('/') + '/'
+        if output.startswith(build_dir):
+            output = output[len(build_dir):]
+        pos = output.find('.objs/')
+        if pos != -1:
+            return tuple(output[:pos].rsplit('/', 1))
+        path, name = os.path.split(output)
+        candidates = [name]
+        if name.startswith('lib'):
+            candidates.append(name[3:])
+        for candidate in list(candidates):
+            while '.' in candidate:
+                candidate = candidate.rsplit('.', 1)[0]
+                candidates.append(candidate)
+        for candidate in candidates:
+            if (path, candidate) in build_targets:
+                return (path, candidate)
+        return None
+
+    def _map_targets(self, actions):
+        build_targets = self.blade.get_build_targets()
+        output_targets = self._output_targets()
+        for action in actions:
+            key = None
+            for output in action.get('outputs', [action['output']]):
+                key = output_targets.get(output)
+                if key is not None:
+                    break
+            if key is None:
+                key = self._guess_target(action['output'], build_targets)
+            action['target'] = key
+
+    def _write_chrome_trace(self, actions):
+        """Write actions as complete events, one lane(tid) per slot. """
+        events = []
+        lanes = []  # end time of the last action in each lane
+        for action in sorted(actions, key=lambda a: a['start']):
+            for tid, end in enumerate(lanes):
+                if end <= action['start']:
+                    break
+            else:
+                tid = len(lanes)
+                lanes.append(0)
+            lanes[tid] = action['end']
+            args = {'output': action['output']}
+            if action.get('rss'):
+                args['peak_rss_kb'] = action['rss']
+            target = action['target']
+            events.append({
+                'name': os.path.basename(action['output']),
+                'cat': target and '%s:%s' % target or 'unknown',
+                'ph': 'X',
+                'pid': 0,
+                'tid': tid,
+                'ts': int(action['start'] * 1000000),
+                'dur': int((action['end'] - action['start']) * 1000000),
+                'args': args,
+            })
+        path = os.path.join(self.build_dir, _TRACE_FILE)
+        f = open(path, 'w')
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        f.close()
+        return path
+
+    def _target_costs(self, actions):
+        """Returns {target key: (total action time, start, end)}. """
+        costs = {}
+        for action in actions:
+            key = action['target']
+            if key is None:
+                continue
+            duration = action['end'] - action['start']
+            total, start, end = costs.get(key, (0, action['start'], action['end']))
+            costs[key] = (total + duration,
+                          min(start, action['start']), max(end, action['end']))
+        return costs
+
+    def _critical_path(self, costs):
+        """Returns the chain of targets which determined the building time.
+
+        Start from the target finished last, step to its dependency finished
+        last repeatedly, each target on the chain is charged the time from
+        that dependency finished to itself finished.
+        """
+        build_targets = self.blade.get_build_targets()
+        keys = [k for k in self.blade.get_sorted_targets_keys() if k in costs]
+        if not keys:
+            return []
+        key = max(reversed(keys), key=lambda k: costs[k][2])
+        path = []
+        while key is not None:
+            deps = [d for d in build_targets[key].expanded_deps if d in costs]
+            prev = None
+            if deps:
+                prev = max(deps, key=lambda k: costs[k][2])
+            begin = prev and costs[prev][2] or 0
+            path.append((key, costs[key][2] - begin))
+            key = prev
+        path.reverse()
+        return path
+
+    def _timeline(self, actions):
+        """Returns the average number of running actions in each time bucket. """
+        span = max(a['end'] for a in actions)
+        bucket = span / _TIMELINE_BUCKETS or 1
+        running = [0.0] * _TIMELINE_BUCKETS
+        for action in actions:
+            for i in range(_TIMELINE_BUCKETS):
+                begin, end = i * bucket, (i + 1) * bucket
+                overlap = min(end, action['end']) - max(begin, action['start'])
+                if overlap > 0:
+                    running[i] += overlap / bucket
+        return span, running
+
+    def report(self, jobs):
+        """Write the trace file and print the summary. """
+        if self.native_builder == 'ninja':
+            actions = self._load_ninja_actions()
+        else:
+            actions = self._load_scons_actions()
+        if not actions:
+            console.info('build trace: no action was run')
+            return
+        self._fill_peak_memory(actions)
+        self._map_targets(actions)
+        path = self._write_chrome_trace(actions)
+        console.info('build trace of %d actions is written to %s, '
+                     'open it in chrome://tracing' % (len(actions), path))
+
+        costs = self._target_costs(actions)
+        console.info('top %d slowest targets (action time, elapsed time):' % _TOP_N)
+        for key in sorted(costs, key=lambda k: costs[k][0], reverse=True)[:_TOP_N]:
+            total, start, end = costs[key]
+            console.info('  %8.2fs %8.2fs  %s:%s' % (total, end - start, key[0], key[1]))
+
+        path = self._critical_path(costs)
+        console.info('critical path (%.2fs):' % sum(cost for key, cost in path))
+        for key, cost in path:
+            console.info('  %8.2fs  %s:%s' % (cost, key[0], key[1]))
+
+        span, running = self._timeline(actions)
+        busy = sum(a['end'] - a['start'] for a in actions)
+        console.info('parallelism: %.2f of %d jobs on average in %.2fs' % (
+                     busy / span if span else 0, jobs, span))
+        for i, n in enumerate(running):
+            console.info('  %3d%% %5.1f %s' % (i * 100 / _TIMELINE_BUCKETS, n,
+                                              '#' * int(round(n * 40 / max(jobs, 1)))))
@@ -12,6 +12,7 @@
 """
 
 
+import multiprocessing
 import os
 import subprocess
 from string import Template
@@ -21,6 +22,8 @@ import blade
 import config
 import console
 import build_rules
+import unity_build
+import version_stamp
 from blade_util import var_to_list, stable_unique
 from target import Target
 
@@ -168,6 +171,96 @@ class CcTarget(Target):
             console.warning("//%s: warning='no' should only be used "
                             "for code in thirdparty." % self.fullname)
 
+    def _set_pch(self, pch):
+        """Set the header to be precompiled for the C++ sources. """
+        if not pch:
+            return
+        if self.data.get('secure'):
+            console.warning('%s: pch is ignored for secure target' % self.fullname)
+            return
+        if not os.path.isfile(self._source_file_path(pch)):
+            console.error_exit('%s: pch %s does not exist' % (self.fullname, pch))
+        self.data['pch'] = pch
+
+    def _pch_paths(self):
+        """Returns the paths of the wrapper header and the precompiled header.
+
+        The precompiled header is generated beside the wrapper header, so
+        the compiler finds it when the wrapper header is included, and the
+        wrapper header is used as a fallback if the precompiled header is
+        invalid.
+        """
+        wrapper = os.path.join(self._target_file_path() + '.objs', self.data['pch'])
+        return wrapper, wrapper + '.gch'
+
+    def _write_pch_wrapper(self, wrapper):
+        """Write the wrapper header which includes the pch by its full path. """
+        content = '#include "%s"\n' % self._source_file_path(self.data['pch'])
+        if os.path.isfile(wrapper) and open(wrapper).read() == content:
+            return
+        dir = os.path.dirname(wrapper)
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        with open(wrapper, 'w') as f:
+            f.write(content)
+
+    def _split_dwarf_enabled(self):
+        """Whether the debug info of the objects is split into the .dwo files.
+
+        It is disabled for the link time optimized objects, for which gcc
+        ignores -gsplit-dwarf and writes no .dwo file.
+        """
+        return (not self._lto_enabled() and
+                bool(self.blade.get_cc_flags_manager().get_split_dwarf_flags()))
+
+    def _dwo_outputs(self, src, obj):
+        """Returns the split debug info file written beside the object. """
+        if (src.endswith(('.c', '.cc', '.cpp', '.cxx')) and
+            self._split_dwarf_enabled()):
+            return ['%s.dwo' % os.path.splitext(obj)[0]]
+        return None
+
+    def _lto_enabled(self):
+        """Whether the link time optimization is enabled for this target.
+
+        The lto attribute of target overrides the profiles configured.
+        """
+        if self.data.get('secure'):
+            return False
+        lto = self.data.get('lto')
+        if lto is None:
+            profile = self.blade.get_options().profile
+            return profile in config.get_item('cc_config', 'lto_profiles')
+        return lto
+
+    def _unity_build_enabled(self):
+        return (config.get_item('cc_config', 'unity_build') and
+                self.data.get('unity_build') and not self.data.get('secure'))
+
+    def _unity_batches(self, srcs):
+        """Batch the C++ sources into unity files.
+
+        Returns the (unity file, sources) of each batch and the sources to
+        be compiled separately in the original order.
+        """
+        objs_dir = self._target_file_path() + '.objs'
+        cxx_srcs, objects = {}, {}
+        for src in srcs:
+            path = self._source_file_path(src)
+            if self._get_ninja_rule_from_suffix(src) == 'cxx' and os.path.exists(path):
+                cxx_srcs[path] = src
+                objects[path] = '%s.o' % os.path.join(objs_dir, src)
+        batches, separated = unity_build.batch_sources(
+                objects, config.get_item('cc_config', 'unity_build_batch_size'))
+        unity_batches, batched = [], set()
+        for index, batch in batches:
+            unity_file = os.path.join(objs_dir, 'unity_%d.cc' % index)
+            unity_build.write_unity_file(unity_file, batch)
+            batch_srcs = [cxx_srcs[path] for path in batch]
+            batched.update(batch_srcs)
+            unity_batches.append((unity_file, batch_srcs))
+        return unity_batches, [src for src in srcs if src not in batched]
+
     def _objs_name(self):
         """Concatenating path and name to be objs var. """
         name = self.data['objs_name']
@@ -245,6 +338,9 @@ class CcTarget(Target):
             self._write_rule('%s.Append(CPPFLAGS=%s)' % (env_name, flags_from_option))
         if incs_list:
             self._write_rule('%s.Append(CPPPATH=%s)' % (env_name, incs_list))
+        compile_flags = self._get_compile_flags()
+        if compile_flags:
+            self._write_rule('%s.Append(CCFLAGS=%s)' % (env_name, compile_flags))
 
     def _setup_as_flags(self):
         """_setup_as_flags. """
@@ -260,6 +356,9 @@ class CcTarget(Target):
         extra_linkflags = self.data.get('extra_linkflags')
         if extra_linkflags:
             self._write_rule('%s.Append(LINKFLAGS=%s)' % (self._env_name(), extra_linkflags))
+        if self._lto_enabled():
+            self._write_rule('%s.Append(LINKFLAGS=["-flto=%d"])' % (
+                    self._env_name(), config.get_item('cc_config', 'lto_jobs')))
 
     def _get_optimize_flags(self):
         """get optimize flags such as -O2"""
@@ -307,6 +406,18 @@ class CcTarget(Target):
 
         return (cpp_flags, incs)
 
+    def _get_compile_flags(self):
+        """Return the flags only passed to the compiles.
+
+        They are not passed to the preprocessing of the header inclusion
+        check, in which gcc reports the conflicts among them as notes.
+        """
+        if self._lto_enabled():
+            return ['-flto']
+        if self._split_dwarf_enabled():
+            return self.blade.get_cc_flags_manager().get_split_dwarf_flags()
+        return []
+
     def _get_as_flags(self):
         """Return as flags according to the build architecture. """
         options = self.blade.get_options()
@@ -486,6 +597,28 @@ class CcTarget(Target):
             paths = self._prebuilt_cc_library_scons_rules()
         self._prebuilt_cc_library_symbolic_link(*paths)
 
+    def _thin_archive_enabled(self):
+        """Whether the static library can be a thin archive.
+
+        A thin archive only refers to the objects, so it is only used for
+        libraries consumed by other cc targets in the build dir. Libraries
+        built explicitly or referenced by package, gen_rule and other
+        targets are kept as full archives to be copied out.
+        """
+        if not config.get_item('cc_library_config', 'thin_archive'):
+            return False
+        if self.key in self.blade.get_direct_targets():
+            return False
+        depended_targets = self.blade.get_depended_target_database()
+        dependents = depended_targets.get(self.key)
+        if not dependents:
+            return False
+        build_targets = self.blade.get_build_targets()
+        for key in dependents:
+            if not isinstance(build_targets[key], CcTarget):
+                return False
+        return True
+
     def _static_cc_library(self):
         """_cc_library.
 
@@ -494,6 +627,10 @@ class CcTarget(Target):
         """
         env_name = self._env_name()
         var_name = self._var_name()
+        if self._thin_archive_enabled():
+            self._write_rule('%s.Append(ARFLAGS="T")' % env_name)
+        if self._lto_enabled():
+            self._write_rule('%s.Replace(AR="gcc-ar", RANLIB="gcc-ranlib")' % env_name)
         self._write_rule('%s = %s.Library("%s", %s)' % (
                 var_name,
                 env_name,
@@ -581,9 +718,22 @@ class CcTarget(Target):
         objs_dir = self._target_file_path() + '.objs'
 
         self._setup_cc_flags()
+        pch = self._cc_pch_rules()
 
         objs = []
-        for src in self.srcs:
+        srcs = self.srcs
+        if self._unity_build_enabled():
+            unity_batches, srcs = self._unity_batches(srcs)
+            for index, (unity_file, batch) in enumerate(unity_batches):
+                obj = 'obj_%s' % self._var_name('unity_%d' % index)
+                self._write_rule('%s = %s.SharedObject(target = "%s" + top_env["OBJSUFFIX"], '
+                                 'source = "%s", SHCXXCOM = "$UNITYCXXCOM")' % (
+                                 obj, env_name, unity_file, unity_file))
+                if pch:
+                    self._write_rule('%s.Depends(%s, %s)' % (env_name, obj, pch))
+                self._split_dwarf_rules(unity_file, unity_file + '.o', obj)
+                objs.append(obj)
+        for src in srcs:
             obj = 'obj_%s' % self._var_name_of(src)
             target_path = os.path.join(objs_dir, src)
             source_path = self._target_file_path(src)  # Also find generated files
@@ -594,6 +744,10 @@ class CcTarget(Target):
             self._write_rule('%s = %s.SharedObject(%s)' % (obj, env_name, rule_args))
             if self.data.get('secure'):
                 self._securecc_object_rules(obj, source_path)
+            else:
+                if pch and self._get_ninja_rule_from_suffix(src) == 'cxx':
+                    self._write_rule('%s.Depends(%s, %s)' % (env_name, obj, pch))
+                self._split_dwarf_rules(src, target_path + '.o', obj)
             objs.append(obj)
 
         if len(objs) == 1:
@@ -607,6 +761,33 @@ class CcTarget(Target):
         if objs and self.blade.get_command() == 'clean':
             self._write_rule('%s.Clean([%s], "%s")' % (env_name, objs_name, objs_dir))
 
+    def _cc_pch_rules(self):
+        """Generate the precompiled header and let the C++ sources use it.
+
+        Returns the variable name of the precompiled header, or None.
+        """
+        if not self.data.get('pch'):
+            return None
+        env_name = self._env_name()
+        wrapper, gch = self._pch_paths()
+        self._write_pch_wrapper(wrapper)
+        # Precompile with the flags before the pch flags are appended
+        pch_env_name = '%s_pch' % env_name
+        pch = self._var_name('pch')
+        self._write_rule('%s = %s.Clone()' % (pch_env_name, env_name))
+        self._write_rule('%s = %s.Pch(target="%s", source="%s")' % (
+                         pch, pch_env_name, gch, wrapper))
+        self._generate_generated_header_files_depends(pch)
+        self._write_rule('%s.Append(CXXFLAGS=["-include", "%s", "-Winvalid-pch"])' % (
+                         env_name, wrapper))
+        return pch
+
+    def _split_dwarf_rules(self, src, obj_path, obj):
+        """Let scons know the split debug info file written with the object. """
+        dwo = self._dwo_outputs(src, obj_path)
+        if dwo:
+            self._write_rule('%s.SideEffect("%s", %s)' % (self._env_name(), dwo[0], obj))
+
     def _securecc_object_rules(self, obj, src, scons=True):
         """Touch the source file if needed and generate specific object rules for securecc. """
         if scons:
@@ -668,6 +849,9 @@ class CcTarget(Target):
         cppflags, includes = self._get_cc_flags()
         if cppflags:
             vars['cppflags'] = ' '.join(cppflags)
+        compile_flags = self._get_compile_flags()
+        if compile_flags:
+            vars['compileflags'] = ' '.join(compile_flags)
         if includes:
             vars['includes'] = ' '.join(['-I%s' % inc for inc in includes])
 
@@ -693,9 +877,11 @@ class CcTarget(Target):
         """
         Find dynamic dependencies for ninja build,
         including system libraries and user libraries.
+        The interface stubs(.toc) of user libraries are also returned,
+        which are the libraries themselves if they have no stubs.
         """
         targets = self.blade.get_build_targets()
-        sys_libs, usr_libs = [], []
+        sys_libs, usr_libs, usr_lib_tocs = [], [], []
         for key in self.expanded_deps:
             dep = targets[key]
             if dep.type == 'cc_library' and not dep.srcs:
@@ -706,7 +892,8 @@ class CcTarget(Target):
                 lib = dep._get_target_file('so')
                 if lib:
                     usr_libs.append(lib)
-        return sys_libs, usr_libs
+                    usr_lib_tocs.append(dep._get_target_file('toc') or lib)
+        return sys_libs, usr_libs, usr_lib_tocs
 
     def _ninja_static_dependencies(self):
         """
@@ -763,6 +950,25 @@ class CcTarget(Target):
                          variables=vars)
         self.ninja_build(obj, 'securecc', inputs=secure_obj)
 
+    def _cc_pch_ninja(self, vars, implicit_deps):
+        """Generate the precompiled header build in ninja.
+
+        Returns the variables and implicit dependencies of the C++ objects
+        using the precompiled header.
+        """
+        wrapper, gch = self._pch_paths()
+        self._write_pch_wrapper(wrapper)
+        self.ninja_build(gch, 'cxxpch', inputs=wrapper,
+                         implicit_deps=implicit_deps,
+                         variables=vars)
+        pch_vars = dict(vars)
+        pch_flags = '-include %s -Winvalid-pch' % wrapper
+        if 'cppflags' in vars:
+            pch_vars['cppflags'] = '%s %s' % (vars['cppflags'], pch_flags)
+        else:
+            pch_vars['cppflags'] = pch_flags
+        return pch_vars, implicit_deps + [gch]
+
     def _cc_objects_ninja(self, sources=None, generated=False, generated_headers=None):
         """Generate cc objects build rules in ninja. """
         vars = {}
@@ -774,6 +980,9 @@ class CcTarget(Target):
         secure = self.data.get('secure')
         if secure:
             implicit_deps.append('__securecc_phony__')
+        pch = not secure and self.data.get('pch')
+        if pch:
+            pch_vars, pch_implicit_deps = self._cc_pch_ninja(vars, implicit_deps)
 
         objs_dir = self._target_file_path() + '.objs'
         objs, hdrs_inclusion_srcs = [], []
@@ -781,6 +990,24 @@ class CcTarget(Target):
             srcs = sources
         else:
             srcs = self.srcs
+            if self._unity_build_enabled():
+                unity_batches, srcs = self._unity_batches(srcs)
+                for unity_file, batch in unity_batches:
+                    obj = '%s.o' % unity_file
+                    if pch:
+                        self.ninja_build(obj, 'cxxunity', inputs=unity_file,
+                                         implicit_deps=pch_implicit_deps,
+                                         variables=pch_vars,
+                                         implicit_outputs=self._dwo_outputs(unity_file, obj))
+                    else:
+                        self.ninja_build(obj, 'cxxunity', inputs=unity_file,
+                                         implicit_deps=implicit_deps,
+                                         variables=vars,
+                                         implicit_outputs=self._dwo_outputs(unity_file, obj))
+                    for src in batch:
+                        hdrs_inclusion_srcs.append((self._source_file_path(src),
+                            '%s.o' % os.path.join(objs_dir, src), 'cxx', obj))
+                    objs.append(obj)
         for src in srcs:
             obj = '%s.o' % os.path.join(objs_dir, src)
             if secure:
@@ -795,12 +1022,19 @@ class CcTarget(Target):
                     path = self._source_file_path(src)
                     if os.path.exists(path):
                         input = path
-                        hdrs_inclusion_srcs.append((path, obj, rule))
+                        hdrs_inclusion_srcs.append((path, obj, rule, obj))
                     else:
                         input = self._target_file_path(src)
-                self.ninja_build(obj, rule, inputs=input,
-                                 implicit_deps=implicit_deps,
-                                 variables=vars)
+                if pch and rule == 'cxx':
+                    self.ninja_build(obj, rule, inputs=input,
+                                     implicit_deps=pch_implicit_deps,
+                                     variables=pch_vars,
+                                     implicit_outputs=self._dwo_outputs(src, obj))
+                else:
+                    self.ninja_build(obj, rule, inputs=input,
+                                     implicit_deps=implicit_deps,
+                                     variables=vars,
+                                     implicit_outputs=self._dwo_outputs(src, obj))
             objs.append(obj)
 
         self.data['objs'] = objs
@@ -811,17 +1045,26 @@ class CcTarget(Target):
     def _static_cc_library_ninja(self):
         output = self._target_file_path('lib%s.a' % self.name)
         objs = self.data.get('objs', [])
-        self.ninja_build(output, 'ar', inputs=objs)
+        rule = 'ar'
+        if self._thin_archive_enabled():
+            rule = 'thinar'
+        vars = {}
+        if self._lto_enabled():
+            vars['ar'] = 'gcc-ar'
+        self.ninja_build(output, rule, inputs=objs, variables=vars)
         self._add_default_target_file('a', output)
 
     def _dynamic_cc_library_ninja(self):
         output = self._target_file_path('lib%s.so' % self.name)
         ldflags = self._generate_ninja_link_flags()
-        sys_libs, usr_libs = self._ninja_dynamic_dependencies()
-        extra_ldflags = ['-l%s' % lib for lib in sys_libs]
-        self._cc_link_ninja(output, 'solink', deps=usr_libs,
-                            ldflags=ldflags, extra_ldflags=extra_ldflags)
+        sys_libs, usr_libs, usr_lib_tocs = self._ninja_dynamic_dependencies()
+        extra_ldflags = usr_libs + ['-l%s' % lib for lib in sys_libs]
+        self._cc_link_ninja(output, 'solink', deps=[],
+                            ldflags=ldflags, extra_ldflags=extra_ldflags,
+                            implicit_deps=usr_lib_tocs,
+                            order_only_deps=usr_libs)
         self._add_target_file('so', output)
+        self._add_target_file('toc', output + '.toc')
 
     def _cc_library_ninja(self):
         self._static_cc_library_ninja()
@@ -830,18 +1073,27 @@ class CcTarget(Target):
 
     def _cc_link_ninja(self, output, rule, deps,
                        ldflags=None, extra_ldflags=None,
-                       implicit_deps=None, order_only_deps=None):
+                       implicit_deps=None, order_only_deps=None,
+                       pool=None):
         objs = self.data.get('objs', [])
         vars = {}
         if ldflags:
             vars['ldflags'] = ' '.join(ldflags)
         if extra_ldflags:
             vars['extra_ldflags'] = ' '.join(extra_ldflags)
+        if pool:
+            vars['pool'] = pool
+        if self._lto_enabled():
+            rule = 'lto' + rule
+        implicit_outputs = None
+        if rule.endswith('solink'):
+            implicit_outputs = [output + '.toc']
         self.ninja_build(output, rule,
                          inputs=objs + deps,
                          implicit_deps=implicit_deps,
                          order_only_deps=order_only_deps,
-                         variables=vars)
+                         variables=vars,
+                         implicit_outputs=implicit_outputs)
 
 
 class CcLibrary(CcTarget):
@@ -870,6 +1122,9 @@ class CcLibrary(CcTarget):
                  extra_linkflags,
                  allow_undefined,
                  secure,
+                 pch,
+                 unity_build,
+                 lto,
                  blade,
                  kwargs):
         """Init method.
@@ -902,6 +1157,10 @@ class CcLibrary(CcTarget):
         self.data['deprecated'] = deprecated
         self.data['allow_undefined'] = allow_undefined
         self.data['secure'] = secure
+        self.data['unity_build'] = unity_build
+        self.data['lto'] = lto
+        self._set_pch(pch)
+        self._declared_generated_hdrs_cache = None
 
     def _rpath_link(self, dynamic):
         path = self._prebuilt_cc_library_path(dynamic)[1]
@@ -984,106 +1243,63 @@ class CcLibrary(CcTarget):
         else:
             return hdrs[:self_hdr_index] + level_two_hdrs[hdr] + hdrs[self_hdr_index + 1:]
 
-    @staticmethod
-    def _parse_hdr_level(line):
-        pos = line.find(' ')
-        if pos == -1:
-            return -1, ''
-        level, hdr = line[:pos].count('.'), line[pos + 1:]
-        if hdr.startswith('./'):
-            hdr = hdr[2:]
-        return level, hdr
-
-    def _extract_generated_hdrs_inclusion_stacks(self, src, history):
-        """Extract generated headers and inclusion stacks for each one of them.
-
-        Given the following inclusions found in the app/example/foo.cc.o.H:
-
-            . ./app/example/foo.h
-            .. build64_release/app/example/proto/foo.pb.h
-            ... build64_release/common/rpc/rpc_service.pb.h
-            . build64_release/app/example/proto/bar.pb.h
-            . ./common/rpc/rpc_client.h
-            .. build64_release/common/rpc/rpc_options.pb.h
-
-        Return a list with each item being a list representing where the
-        generated header is included from in the current translation unit.
-
-        Note that ONLY the first generated header is tracked while other
-        headers included from the generated header directly or indirectly
-        are ignored since that part of inclusion is ensured by imports of
-        proto_library.
-
-        As shown in the example above, it returns:
-
-            [
-                ['app/example/foo.h', 'build64_release/app/example/proto/foo.pb.h'],
-                ['build64_release/app/example/proto/bar.pb.h'],
-                ['common/rpc/rpc_client.h', 'build64_release/common/rpc/rpc_options.pb.h'],
-            ]
-        """
+    def _inclusion_stacks_file(self, src):
+        """Returns the path of the inclusion stacks file(.H) of src. """
         objs_dir = self._target_file_path() + '.objs'
-        path = '%s.o.H' % os.path.join(objs_dir, src)
-        if (not os.path.exists(path) or
-            (path in history and int(os.path.getmtime(path)) == history[path])):
-            return '', []
-
-        build_dir = self.build_path
-        stacks, hdrs_stack = [], []
-
-        def _process_hdr(level, hdr, current_level):
-            if hdr.startswith('/'):
-                skip_level = level
-            elif hdr.startswith(build_dir):
-                skip_level = level
-                stacks.append(hdrs_stack + [hdr])
-            else:
-                current_level = level
-                hdrs_stack.append(hdr)
-                skip_level = -1
-            return current_level, skip_level
+        return '%s.o.H' % os.path.join(objs_dir, src)
 
-        current_level = 0
-        skip_level = -1
-        with open(path) as f:
-            for line in f.read().splitlines():
-                if line.startswith('Multiple include guards may be useful for'):
-                    break
-                level, hdr = self._parse_hdr_level(line)
-                if level == -1:
-                    console.log('%s: Unrecognized line %s' % (self.fullname, line))
-                    break
-                if level > current_level:
-                    if skip_level != -1 and level > skip_level:
-                        continue
-                    assert level == current_level + 1
-                    current_level, skip_level = _process_hdr(level, hdr, current_level)
-                else:
-                    while current_level >= level:
-                        current_level -= 1
-                        hdrs_stack.pop()
-                    current_level, skip_level = _process_hdr(level, hdr, current_level)
+    def inclusion_stacks_files_to_verify(self, history):
+        """Returns the inclusion stacks files changed since last verification. """
+        if not self._need_generate_hdrs():
+            return []
+        paths = []
+        for src in self.srcs:
+            path = self._inclusion_stacks_file(src)
+            try:
+                mtime = int(os.path.getmtime(path))
+            except OSError:
+                continue
+            if history.get(path) != mtime:
+                paths.append(path)
+        return paths
 
-        return path, stacks
+    def _declared_generated_hdrs(self):
+        """Returns the generated headers declared by the dependencies.
 
-    def verify_header_inclusion_dependencies(self, history):
+        The result is cached since it is the same for all the sources.
+        """
+        if self._declared_generated_hdrs_cache is None:
+            build_targets = self.blade.get_build_targets()
+            declared_hdrs = set()
+            for key in self.expanded_deps:
+                dep = build_targets[key]
+                declared_hdrs.update(dep.data.get('generated_hdrs', []))
+            self._declared_generated_hdrs_cache = declared_hdrs
+        return self._declared_generated_hdrs_cache
+
+    def verify_header_inclusion_dependencies(self, history, inclusion_stacks):
+        """Verify the generated headers included by the sources are declared.
+
+        inclusion_stacks maps the inclusion stacks file(.H) to the stacks
+        extracted from it, only the files in it are verified.
+        """
         if not self._need_generate_hdrs():
             return True
 
-        build_targets = self.blade.get_build_targets()
         # TODO(wentingli): Check regular headers as well
-        declared_hdrs = set()
-        for key in self.expanded_deps:
-            dep = build_targets[key]
-            declared_hdrs.update(dep.data.get('generated_hdrs', []))
-
         preprocess_paths, failed_preprocess_paths = set(), set()
         for src in self.srcs:
-            source = self._source_file_path(src)
-            path, stacks = self._extract_generated_hdrs_inclusion_stacks(src, history)
-            if not path:
+            path = self._inclusion_stacks_file(src)
+            if path not in inclusion_stacks:
                 continue
+            source = self._source_file_path(src)
             preprocess_paths.add(path)
+            stacks, unrecognized_line = inclusion_stacks[path]
+            if unrecognized_line is not None:
+                console.log('%s: Unrecognized line %s' % (self.fullname, unrecognized_line))
+            if not stacks:
+                continue
+            declared_hdrs = self._declared_generated_hdrs()
             for stack in stacks:
                 generated_hdr = stack[-1]
                 if generated_hdr not in declared_hdrs:
@@ -1115,11 +1331,11 @@ class CcLibrary(CcTarget):
         for key in ('c_warnings', 'cxx_warnings'):
             if key in vars:
                 del vars[key]
-        for src, obj, rule in hdrs_inclusion_srcs:
+        for src, obj, rule, compiled_obj in hdrs_inclusion_srcs:
             output = '%s.H' % obj
             rule = '%shdrs' % rule
             self.ninja_build(output, rule, inputs=src,
-                             implicit_deps=[obj],
+                             implicit_deps=[compiled_obj],
                              variables=vars)
 
     def scons_rules(self):
@@ -1146,6 +1362,125 @@ class CcLibrary(CcTarget):
             self._cc_library_ninja()
 
 
+def _parse_hdr_level(line):
+    pos = line.find(' ')
+    if pos == -1 or line[:pos].strip('.'):
+        return -1, ''
+    level, hdr = pos, line[pos + 1:]
+    if hdr.startswith('./'):
+        hdr = hdr[2:]
+    return level, hdr
+
+
+def extract_generated_hdrs_inclusion_stacks(path, build_dir):
+    """Extract generated headers and inclusion stacks for each one of them.
+
+    Given the following inclusions found in the app/example/foo.cc.o.H:
+
+        . ./app/example/foo.h
+        .. build64_release/app/example/proto/foo.pb.h
+        ... build64_release/common/rpc/rpc_service.pb.h
+        . build64_release/app/example/proto/bar.pb.h
+        . ./common/rpc/rpc_client.h
+        .. build64_release/common/rpc/rpc_options.pb.h
+
+    Return a list with each item being a list representing where the
+    generated header is included from in the current translation unit.
+
+    Note that ONLY the first generated header is tracked while other
+    headers included from the generated header directly or indirectly
+    are ignored since that part of inclusion is ensured by imports of
+    proto_library.
+
+    As shown in the example above, it returns:
+
+        [
+            ['app/example/foo.h', 'build64_release/app/example/proto/foo.pb.h'],
+            ['build64_release/app/example/proto/bar.pb.h'],
+            ['common/rpc/rpc_client.h', 'build64_release/common/rpc/rpc_options.pb.h'],
+        ]
+
+    The unrecognized line which stops the parsing is also returned, or None.
+
+    It is a module level function so that it could be run in the worker
+    processes of verification.
+    """
+    stacks, hdrs_stack = [], []
+
+    def _process_hdr(level, hdr, current_level):
+        if hdr.startswith('/'):
+            skip_level = level
+        elif hdr.startswith(build_dir):
+            skip_level = level
+            stacks.append(hdrs_stack + [hdr])
+        else:
+            current_level = level
+            hdrs_stack.append(hdr)
+            skip_level = -1
+        return current_level, skip_level
+
+    current_level = 0
+    skip_level = -1
+    unrecognized_line = None
+    with open(path) as f:
+        for line in f.read().splitlines():
+            if line.startswith('Multiple include guards may be useful for'):
+                break
+            if not line.startswith('.'):
+                # Such as the notes of the compiler
+                continue
+            level, hdr = _parse_hdr_level(line)
+            if level == -1:
+                unrecognized_line = line
+                break
+            if level > current_level:
+                if skip_level != -1 and level > skip_level:
+                    continue
+                assert level == current_level + 1
+                current_level, skip_level = _process_hdr(level, hdr, current_level)
+            else:
+                while current_level >= level:
+                    current_level -= 1
+                    hdrs_stack.pop()
+                current_level, skip_level = _process_hdr(level, hdr, current_level)
+
+    return stacks, unrecognized_line
+
+
+def _extract_inclusion_stacks_worker(args):
+    path, build_dir = args
+    return path, extract_generated_hdrs_inclusion_stacks(path, build_dir)
+
+
+# Parsing in worker processes pays off only when there are enough files
+_PARALLEL_EXTRACTION_THRESHOLD = 64
+
+
+def extract_inclusion_stacks(paths, build_dir, jobs):
+    """Extract the inclusion stacks of all the files in parallel.
+
+    Returns a dict mapping each path to the result of
+    extract_generated_hdrs_inclusion_stacks.
+    """
+    jobs = min(jobs, len(paths) / _PARALLEL_EXTRACTION_THRESHOLD)
+    if jobs <= 1:
+        return dict(_extract_inclusion_stacks_worker((path, build_dir))
+                    for path in paths)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # Wait with a timeout to make KeyboardInterrupt work
+        result = pool.map_async(_extract_inclusion_stacks_worker,
+                                [(path, build_dir) for path in paths],
+                                chunksize=16).get(0xFFFF)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return dict(result)
+
+
 def cc_library(name,
                srcs=[],
                deps=[],
@@ -1165,6 +1500,9 @@ def cc_library(name,
                extra_linkflags=[],
                allow_undefined=False,
                secure=False,
+               pch=None,
+               unity_build=True,
+               lto=None,
                **kwargs):
     """cc_library target. """
     target = CcLibrary(name,
@@ -1185,6 +1523,9 @@ def cc_library(name,
                        extra_linkflags,
                        allow_undefined,
                        secure,
+                       pch,
+                       unity_build,
+                       lto,
                        blade.blade,
                        kwargs)
     if pre_build:
@@ -1216,6 +1557,10 @@ class CcBinary(CcTarget):
                  extra_cppflags,
                  extra_linkflags,
                  export_dynamic,
+                 exclusive_link,
+                 pch,
+                 unity_build,
+                 lto,
                  blade,
                  kwargs):
         """Init method.
@@ -1241,6 +1586,10 @@ class CcBinary(CcTarget):
         self.data['embed_version'] = embed_version
         self.data['dynamic_link'] = dynamic_link
         self.data['export_dynamic'] = export_dynamic
+        self.data['exclusive_link'] = exclusive_link
+        self.data['unity_build'] = unity_build
+        self.data['lto'] = lto
+        self._set_pch(pch)
 
         # add extra link library
         link_libs = var_to_list(config.get_item('cc_binary_config', 'extra_libs'))
@@ -1249,6 +1598,17 @@ class CcBinary(CcTarget):
     def _allow_duplicate_source(self):
         return True
 
+    def _dwp_enabled(self):
+        return config.get_item('cc_config', 'dwp') and self._split_dwarf_enabled()
+
+    def _cc_binary_dwp(self):
+        """Package the split debug info files of the binary. """
+        if self._dwp_enabled():
+            var_name = self._var_name()
+            self._write_rule('%s = %s.Dwp("%s.dwp", %s)' % (
+                self._var_name('dwp'), self._env_name(),
+                self._target_file_path(), var_name))
+
     def _expand_deps_generation(self):
         if self.data.get('dynamic_link'):
             build_targets = self.blade.get_build_targets()
@@ -1312,8 +1672,18 @@ class CcBinary(CcTarget):
 
         self._write_rpath_links()
         if self.data['embed_version']:
-            self._write_rule('%s.Append(LINKFLAGS=str(version_obj[0]))' % env_name)
-            self._write_rule('%s.Requires(%s, version_obj)' % (env_name, var_name))
+            self._write_version_rules()
+
+    def _write_version_rules(self):
+        env_name = self._env_name()
+        var_name = self._var_name()
+        self._write_rule('%s.Append(LINKFLAGS=str(version_obj[0]))' % env_name)
+        self._write_rule('%s.Depends(%s, version_obj)' % (env_name, var_name))
+        if getattr(self.blade.get_options(), 'stamp', False):
+            self._write_rule('%s.Depends(%s, "%s")' % (
+                env_name, var_name, version_stamp.stamp_file_path(self.build_path)))
+            self._write_rule('%s.AddPostAction(%s, scons_helper.stamp_version)' % (
+                env_name, var_name))
 
     def _dynamic_cc_binary(self):
         """_dynamic_cc_binary. """
@@ -1334,8 +1704,7 @@ class CcBinary(CcTarget):
         self._add_default_target_var('bin', var_name)
 
         if self.data['embed_version']:
-            self._write_rule('%s.Append(LINKFLAGS=str(version_obj[0]))' % env_name)
-            self._write_rule('%s.Requires(%s, version_obj)' % (env_name, var_name))
+            self._write_version_rules()
 
         self._write_rpath_links()
 
@@ -1353,6 +1722,7 @@ class CcBinary(CcTarget):
             self._dynamic_cc_binary()
         else:
             self._cc_binary()
+        self._cc_binary_dwp()
 
     def _generate_cc_binary_link_flags(self, dynamic_link):
         ldflags = []
@@ -1368,27 +1738,46 @@ class CcBinary(CcTarget):
 
     def _cc_binary_ninja(self, dynamic_link):
         ldflags = self._generate_cc_binary_link_flags(dynamic_link)
-        implicit_deps = []
+        implicit_deps, order_only_deps, solibs = [], [], []
         if dynamic_link:
-            sys_libs, usr_libs = self._ninja_dynamic_dependencies()
+            sys_libs, usr_libs, implicit_deps = self._ninja_dynamic_dependencies()
+            # Link with the libraries but only depend on their stubs
+            solibs, usr_libs = usr_libs, []
+            order_only_deps = solibs[:]
         else:
             sys_libs, usr_libs, link_all_symbols_libs = self._ninja_static_dependencies()
             if link_all_symbols_libs:
                 ldflags += self._generate_link_all_symbols_link_flags(link_all_symbols_libs)
                 implicit_deps = link_all_symbols_libs
 
-        extra_ldflags, order_only_deps = [], []
+        extra_ldflags = solibs[:]
+        stamp = (self.data['embed_version'] and
+                 getattr(self.blade.get_options(), 'stamp', False))
         if self.data['embed_version']:
             scm = os.path.join(self.build_path, 'scm.cc.o')
             extra_ldflags.append(scm)
-            order_only_deps.append(scm)
+            implicit_deps = implicit_deps + [scm]
         extra_ldflags += ['-l%s' % lib for lib in sys_libs]
+        pool = None
+        if self.data['exclusive_link']:
+            pool = 'exclusive_link_pool'
         output = self._target_file_path()
-        self._cc_link_ninja(output, 'link', deps=usr_libs,
+        link_output = output
+        if stamp:
+            # Stamp a copy of the linked binary, so a new stamp does not relink
+            link_output = output + '.unstamped'
+        self._cc_link_ninja(link_output, 'link', deps=usr_libs,
                             ldflags=ldflags, extra_ldflags=extra_ldflags,
                             implicit_deps=implicit_deps,
-                            order_only_deps=order_only_deps)
+                            order_only_deps=order_only_deps,
+                            pool=pool)
+        if stamp:
+            self.ninja_build(output, 'versionstamp', inputs=link_output,
+                             implicit_deps=[version_stamp.stamp_file_path(self.build_path)])
         self._add_default_target_file('bin', output)
+        if self._dwp_enabled():
+            self.ninja_build(output + '.dwp', 'dwp', inputs=output)
+            self._add_target_file('dwp', output + '.dwp')
 
     def ninja_rules(self):
         """Generate ninja build rules for cc binary/test. """
@@ -1409,6 +1798,10 @@ def cc_binary(name,
               extra_cppflags=[],
               extra_linkflags=[],
               export_dynamic=False,
+              exclusive_link=False,
+              pch=None,
+              unity_build=True,
+              lto=None,
               **kwargs):
     """cc_binary target. """
     cc_binary_target = CcBinary(name,
@@ -1423,6 +1816,10 @@ def cc_binary(name,
                                 extra_cppflags,
                                 extra_linkflags,
                                 export_dynamic,
+                                exclusive_link,
+                                pch,
+                                unity_build,
+                                lto,
                                 blade.blade,
                                 kwargs)
     blade.blade.register_target(cc_binary_target)
@@ -1619,11 +2016,17 @@ class CcTest(CcBinary):
                  optimize,
                  dynamic_link,
                  testdata,
+                 writable_testdata,
                  extra_cppflags,
                  extra_linkflags,
                  export_dynamic,
+                 exclusive_link,
+                 pch,
+                 unity_build,
+                 lto,
                  always_run,
                  exclusive,
+                 shards,
                  heap_check,
                  heap_check_debug,
                  blade,
@@ -1650,12 +2053,18 @@ class CcTest(CcBinary):
                           extra_cppflags,
                           extra_linkflags,
                           export_dynamic,
+                          exclusive_link,
+                          pch,
+                          unity_build,
+                          lto,
                           blade,
                           kwargs)
         self.type = 'cc_test'
         self.data['testdata'] = var_to_list(testdata)
+        self.data['writable_testdata'] = writable_testdata
         self.data['always_run'] = always_run
         self.data['exclusive'] = exclusive
+        self._set_test_shards(shards)
 
         gtest_lib = var_to_list(cc_test_config['gtest_libs'])
         gtest_main_lib = var_to_list(cc_test_config['gtest_main_libs'])
@@ -1694,11 +2103,17 @@ def cc_test(name,
             optimize=[],
             dynamic_link=None,
             testdata=[],
+            writable_testdata=False,
             extra_cppflags=[],
             extra_linkflags=[],
             export_dynamic=False,
+            exclusive_link=False,
+            pch=None,
+            unity_build=True,
+            lto=None,
             always_run=False,
             exclusive=False,
+            shards=1,
             heap_check=None,
             heap_check_debug=False,
             **kwargs):
@@ -1713,11 +2128,17 @@ def cc_test(name,
                             optimize,
                             dynamic_link,
                             testdata,
+                            writable_testdata,
                             extra_cppflags,
                             extra_linkflags,
                             export_dynamic,
+                            exclusive_link,
+                            pch,
+                            unity_build,
+                            lto,
                             always_run,
                             exclusive,
+                            shards,
                             heap_check,
                             heap_check_debug,
                             blade.blade,
@@ -109,9 +109,21 @@ class CmdArguments(object):
             console.error_exit('please specify --deps, --depended or both to '
                                'query target')
 
+    def _check_pgo_options(self):
+        """check profile guided optimization options. """
+        if self.options.profile_generate and self.options.profile_use:
+            console.error_exit('--profile-generate and --profile-use can not '
+                               'be used together')
+        if self.options.profile_use:
+            if not os.path.isdir(self.options.profile_use):
+                console.error_exit('--profile-use: directory %s does not exist' %
+                                   self.options.profile_use)
+            self.options.profile_use = os.path.abspath(self.options.profile_use)
+
     def _check_build_options(self):
         """check the building options. """
         self._check_plat_and_profile_options()
+        self._check_pgo_options()
 
     def _check_build_command(self):
         """check build options. """
@@ -228,6 +240,23 @@ class CmdArguments(object):
             '--no-test', dest='no_test', action='store_true',
             default=False, help='Do not build the test targets')
 
+        parser.add_argument(
+            '--build-trace', dest='build_trace', action='store_true',
+            default=False,
+            help='Trace the timing and memory of build actions, '
+                 'report the slowest targets and the critical path')
+
+        parser.add_argument(
+            '--check-reproducible', dest='check_reproducible',
+            action='store_true', default=False,
+            help='Clean and rebuild the targets without ccache after building, '
+                 'report the outputs which are different between the two builds')
+
+        parser.add_argument(
+            '--stamp', dest='stamp', action='store_true', default=False,
+            help='Stamp the scm info, build time, builder and host into '
+                 'the binaries which embed the version, for release builds')
+
         parser.add_argument(
             '-n', '--dry-run', dest='dry_run', action='store_true', default=False,
             help='Dry run (don\'t run commands but act like they succeeded)')
@@ -261,6 +290,19 @@ class CmdArguments(object):
             action='store_true', default=False,
             help='Add build options to support coverage test')
 
+    def __add_pgo_arguments(self, parser):
+        """Add profile guided optimization arguments. """
+        parser.add_argument(
+            '--profile-generate', dest='profile_generate',
+            action='store_true', default=False,
+            help='Build instrumented binaries into a separate build dir to '
+                 'collect the profiles for profile guided optimization')
+
+        parser.add_argument(
+            '--profile-use', dest='profile_use', type=str,
+            help='Optimize with the profiles collected in the directory by '
+                 'the instrumented binaries')
+
     def _add_query_arguments(self, parser):
         """Add query arguments for parser. """
         self.__add_plat_profile_arguments(parser)
@@ -325,6 +367,7 @@ class CmdArguments(object):
             self.__add_cache_arguments(parser)
             self.__add_generate_arguments(parser)
             self.__add_coverage_arguments(parser)
+            self.__add_pgo_arguments(parser)
 
     def _add_common_arguments(self, *parsers):
         for parser in parsers:
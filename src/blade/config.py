@@ -38,6 +38,9 @@ class BladeConfig(object):
                 'build_path_template': 'build${bits}_${profile}',
                 'duplicated_source_action': 'warning', # Can be 'warning', 'error', 'none'
                 'test_timeout': None,
+                # The expected duration of each shard of the tests with
+                # shards = 'auto', in seconds
+                'test_shard_duration': 60,
                 'native_builder': 'scons',
                 'debug_info_level': 'mid',
             },
@@ -58,12 +61,57 @@ class BladeConfig(object):
             },
 
             'distcc_config': {
-                'enabled': False
+                'enabled': False,
+                # Send the preprocessing to the hosts too, ninja only
+                'pump': False,
+                # Seconds to wait for the hosts when probing them, ninja only
+                'probe_timeout': 1,
+            },
+
+            'remote_execution_config': {
+                'enabled': False,
+                # host:port of the workers, ninja only
+                'workers': [],
+                # Start the workers on the local machine during the build
+                'local_workers': 0,
+                # Max concurrent actions on each worker
+                'worker_jobs': 4,
+                # The file containing the token shared with the workers
+                'token_file': '',
+                # Seconds to wait for the workers when probing them
+                'probe_timeout': 1,
             },
 
             'link_config': {
                 'link_on_tmp': False,
-                'enable_dccc': False
+                'enable_dccc': False,
+                # The linker passed to -fuse-ld, empty means the default
+                'linker': '',
+                # Threads used by gold or lld, 0 means the linker default
+                'link_threads': 0,
+                # Identical code folding and removing unused sections,
+                # only enabled in release profile
+                'release_icf': False,
+                'release_gc_sections': False,
+            },
+
+            # Pools of the ninja backend to limit the concurrency of
+            # the memory hungry actions
+            'pool_config': {
+                # Max concurrent actions in the pool, 0 means derived
+                # from the available memory
+                'link_depth': 0,
+                'java_depth': 0,
+                'jar_depth': 0,
+                'lto_depth': 0,
+                # Estimated peak memory(MB) of one action in the pool,
+                # used before any peak memory is recorded
+                'link_memory': 2048,
+                'java_memory': 1024,
+                'jar_memory': 1024,
+                'lto_memory': 4096,
+                # Memory(MB) reserved for the other actions
+                'reserved_memory': 2048,
             },
 
             'java_config': {
@@ -161,6 +209,24 @@ class BladeConfig(object):
                     'high': ['-g3'],
                 },
                 'header_inclusion_dependencies': False,
+                # Compile the C++ sources of each target in batches
+                'unity_build': False,
+                'unity_build_batch_size': 8,
+                # How long a recently edited source is compiled separately
+                'unity_build_isolation_hours': 24,
+                # How long a source failed in the unity files is compiled separately
+                'unity_build_exclusion_hours': 168,
+                # Put the debug info into .dwo files beside the objects
+                'split_dwarf': False,
+                # Package the .dwo files of each cc_binary into a .dwp file
+                'dwp': False,
+                'gdb_index': False,
+                # The profiles in which the link time optimization is enabled
+                'lto_profiles': [],
+                # Parallel jobs of each link time optimization
+                'lto_jobs': 4,
+                # Make the outputs independent of the paths and build time
+                'reproducible': False,
             },
             'cc_library_config': {
                 'prebuilt_libpath_pattern' : 'lib${bits}_${profile}',
@@ -170,6 +236,9 @@ class BladeConfig(object):
                 # in deterministic mode discarding timestamps
                 'arflags': ['rcs'],
                 'ranlibflags': [],
+                # Create thin archives for the libraries only used in the
+                # build dir to save the disk writes
+                'thin_archive': False,
             }
         }
 
@@ -299,6 +368,9 @@ def cc_library_config(append=None, **kwargs):
 __DUPLICATED_SOURCE_ACTION_VALUES = set(['warning', 'error', 'none', None])
 
 
+__LINKER_VALUES = set(['', 'bfd', 'gold', 'lld'])
+
+
 @config_rule
 def global_config(append=None, **kwargs):
     """global_config section. """
@@ -317,9 +389,22 @@ def distcc_config(append=None, **kwargs):
 @config_rule
 def link_config(append=None, **kwargs):
     """link_config. """
+    _check_kwarg_enum_value(kwargs, 'linker', __LINKER_VALUES)
     _blade_config.update_config('link_config', append, kwargs)
 
 
+@config_rule
+def remote_execution_config(append=None, **kwargs):
+    """remote_execution_config. """
+    _blade_config.update_config('remote_execution_config', append, kwargs)
+
+
+@config_rule
+def pool_config(append=None, **kwargs):
+    """pool_config. """
+    _blade_config.update_config('pool_config', append, kwargs)
+
+
 @config_rule
 def java_config(append=None, **kwargs):
     """java_config. """
@@ -305,6 +305,7 @@ class CuTest(CuBinary):
                  extra_cppflags,
                  extra_linkflags,
                  testdata,
+                 writable_testdata,
                  always_run,
                  exclusive,
                  blade,
@@ -322,6 +323,7 @@ class CuTest(CuBinary):
                           kwargs)
         self.type = 'cu_test'
         self.data['testdata'] = var_to_list(testdata)
+        self.data['writable_testdata'] = writable_testdata
         self.data['always_run'] = always_run
         self.data['exclusive'] = exclusive
 
@@ -343,6 +345,7 @@ def cu_test(name,
             extra_cppflags=[],
             extra_linkflags=[],
             testdata=[],
+            writable_testdata=False,
             always_run=False,
             exclusive=False,
             **kwargs):
@@ -355,6 +358,7 @@ def cu_test(name,
                     extra_cppflags,
                     extra_linkflags,
                     testdata,
+                    writable_testdata,
                     always_run,
                     exclusive,
                     blade.blade,
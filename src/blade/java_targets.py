@@ -938,11 +938,13 @@ class JavaTest(JavaBinary):
     """JavaTest"""
     def __init__(self, name, srcs, deps, resources, source_encoding,
                  warnings, main_class, exclusions,
-                 testdata, target_under_test, kwargs):
+                 testdata, writable_testdata, target_under_test, shards, kwargs):
         JavaBinary.__init__(self, name, srcs, deps, resources,
                             source_encoding, warnings, main_class, exclusions, kwargs)
         self.type = 'java_test'
         self.data['testdata'] = var_to_list(testdata)
+        self.data['writable_testdata'] = writable_testdata
+        self._set_test_shards(shards)
         if target_under_test:
             self.data['target_under_test'] = self._unify_dep(target_under_test)
 
@@ -1060,7 +1062,9 @@ def java_test(name,
               main_class = 'org.junit.runner.JUnitCore',
               exclusions=[],
               testdata=[],
+              writable_testdata=False,
               target_under_test='',
+              shards=1,
               **kwargs):
     """Define java_test target. """
     target = JavaTest(name,
@@ -1072,7 +1076,9 @@ def java_test(name,
                       main_class,
                       exclusions,
                       testdata,
+                      writable_testdata,
                       target_under_test,
+                      shards,
                       kwargs)
     blade.blade.register_target(target)
 
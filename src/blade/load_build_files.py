@@ -23,6 +23,8 @@ import build_rules
 import blade
 import console
 import build_attributes
+import phase_stats
+import profile_breakdown
 from blade_util import var_to_list
 from pathlib import Path
 
@@ -113,7 +115,9 @@ def glob(srcs, excludes=[]):
                 return True
         return False
 
-    return sorted(set([str(p) for p in includes_iterator() if not exclusion(p)]))
+    build_file = os.path.join(str(source_dir), 'BUILD')
+    with profile_breakdown.measure(('glob', build_file)):
+        return sorted(set([str(p) for p in includes_iterator() if not exclusion(p)]))
 
 
 # Each include in a BUILD file can only affect itself
@@ -127,7 +131,9 @@ def include(name):
         name = name[2:]
     else:
         dir = blade.blade.get_current_source_path()
-    execfile(os.path.join(dir, name), __current_globles, None)
+    path = os.path.join(dir, name)
+    with profile_breakdown.measure(('include', path)):
+        execfile(path, __current_globles, None)
 
 
 build_rules.register_function(enable_if)
@@ -160,12 +166,14 @@ def _load_build_file(source_dir, processed_source_dirs, blade):
     blade.set_current_source_path(source_dir)
     build_file = os.path.join(source_dir, 'BUILD')
     if os.path.exists(build_file) and not os.path.isdir(build_file):
+        phase_stats.count('build_files')
         try:
             # The magic here is that a BUILD file is a Python script,
             # which can be loaded and executed by execfile().
             global __current_globles
             __current_globles = build_rules.get_all()
-            execfile(build_file, __current_globles, None)
+            with profile_breakdown.measure(('BUILD file', build_file)):
+                execfile(build_file, __current_globles, None)
         except SystemExit:
             console.error_exit('%s: fatal error' % build_file)
         except:
@@ -0,0 +1,78 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   March 26, 2018
+
+
+"""
+ This module records the wall/cpu time and counters of each phase of a
+ blade invocation, and appends them as a json line to the stats file in
+ the build dir.
+
+"""
+
+
+import json
+import os
+import socket
+import time
+from contextlib import contextmanager
+
+
+_STATS_FILE = 'blade_stats.jsonl'
+
+
+# [(phase name, wall time, cpu time, cpu time of child processes)]
+_phases = []
+
+# counter name -> value
+_counters = {}
+
+_start_time = time.time()
+
+
+def _cpu_times():
+    times = os.times()
+    return times[0] + times[1], times[2] + times[3]
+
+
+@contextmanager
+def phase(name):
+    """Record the time costs of the phase run in the with statement. """
+    start_time = time.time()
+    cpu, children_cpu = _cpu_times()
+    try:
+        yield
+    finally:
+        end_cpu, end_children_cpu = _cpu_times()
+        _phases.append((name, time.time() - start_time,
+                        end_cpu - cpu, end_children_cpu - children_cpu))
+
+
+def count(name, value=1):
+    """Increase the counter. """
+    _counters[name] = _counters.get(name, 0) + value
+
+
+def dump(build_dir, command, targets, exit_code):
+    """Append the stats of this invocation to the stats file. """
+    cpu, children_cpu = _cpu_times()
+    stats = {
+        'time': int(_start_time),
+        'host': socket.gethostname(),
+        'command': command,
+        'targets': targets,
+        'exit_code': exit_code,
+        'wall': round(time.time() - _start_time, 3),
+        'cpu': round(cpu, 3),
+        'children_cpu': round(children_cpu, 3),
+        'phases': [{'name': name,
+                    'wall': round(wall, 3),
+                    'cpu': round(cpu, 3),
+                    'children_cpu': round(children_cpu, 3)}
+                   for name, wall, cpu, children_cpu in _phases],
+        'counters': _counters,
+    }
+    f = open(os.path.join(build_dir, _STATS_FILE), 'a')
+    f.write(json.dumps(stats, sort_keys=True) + '\n')
+    f.close()
@@ -0,0 +1,95 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   April 02, 2018
+
+
+"""
+ This module attributes the time and memory cost of blade to BUILD files,
+ target types and targets when profiling, which cProfile can not tell.
+
+"""
+
+
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import console
+
+
+_BREAKDOWN_FILE = 'blade_profile_breakdown.json'
+
+_TOP_N = 20
+
+_enabled = False
+
+# category -> {name: [time, memory growth(KB), count]}
+_costs = {}
+
+_page_kb = 4
+
+
+def enable():
+    global _enabled, _page_kb
+    _enabled = True
+    _page_kb = os.sysconf('SC_PAGE_SIZE') / 1024
+
+
+def _resident_memory():
+    """Returns the resident memory(KB) of blade. """
+    try:
+        return int(open('/proc/self/statm').read().split()[1]) * _page_kb
+    except (IOError, IndexError, ValueError):
+        return 0
+
+
+@contextmanager
+def measure(*keys):
+    """Attribute the cost of the with statement to each (category, name).
+
+    Memory is measured as the growth of the resident memory, which is
+    a rough but cheap estimation of the allocations.
+    """
+    if not _enabled:
+        yield
+        return
+    start_time = time.time()
+    start_memory = _resident_memory()
+    try:
+        yield
+    finally:
+        cost = time.time() - start_time
+        memory = _resident_memory() - start_memory
+        for category, name in keys:
+            item = _costs.setdefault(category, {}).setdefault(name, [0, 0, 0])
+            item[0] += cost
+            item[1] += memory
+            item[2] += 1
+
+
+def _sorted_items(category):
+    costs = _costs[category]
+    return sorted(costs.iteritems(), key=lambda item: item[1][0], reverse=True)
+
+
+def report(build_dir):
+    """Print the most costly items of each category and dump all of them. """
+    if not _costs:
+        return
+    breakdown = {}
+    for category in sorted(_costs):
+        items = _sorted_items(category)
+        breakdown[category] = [{'name': name, 'time': round(cost, 6),
+                                'memory_kb': memory, 'count': count}
+                               for name, (cost, memory, count) in items]
+        console.info('%s (top %d of %d by time):' % (category, _TOP_N, len(items)))
+        console.info('  %10s %12s %6s  %s' % ('time(s)', 'memory(KB)', 'count', 'name'))
+        for name, (cost, memory, count) in items[:_TOP_N]:
+            console.info('  %10.4f %12d %6d  %s' % (cost, memory, count, name))
+    path = os.path.join(build_dir, _BREAKDOWN_FILE)
+    f = open(path, 'w')
+    json.dump(breakdown, f, indent=2, sort_keys=True)
+    f.close()
+    console.info('Cost breakdown is also written to %s' % path)
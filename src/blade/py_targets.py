@@ -421,6 +421,7 @@ class PythonTest(PythonBinary):
                  main,
                  base,
                  testdata,
+                 writable_testdata,
                  kwargs):
         """Init method. """
         PythonBinary.__init__(self,
@@ -432,6 +433,7 @@ class PythonTest(PythonBinary):
                               kwargs)
         self.type = 'py_test'
         self.data['testdata'] = testdata
+        self.data['writable_testdata'] = writable_testdata
 
 
 def py_test(name,
@@ -440,6 +442,7 @@ def py_test(name,
             main=None,
             base=None,
             testdata=[],
+            writable_testdata=False,
             **kwargs):
     """python test. """
     target = PythonTest(name,
@@ -448,6 +451,7 @@ def py_test(name,
                         main,
                         base,
                         testdata,
+                        writable_testdata,
                         kwargs)
     blade.blade.register_target(target)
 
@@ -0,0 +1,442 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   May 21, 2018
+
+
+"""
+ This module executes the C/C++ compiles of the ninja backend on the
+ worker daemons over TCP.
+
+ The sources are preprocessed locally, so the only input of a compile is
+ the preprocessed file, which is only uploaded if it is missing in the
+ content addressable storage of the worker, see remote_worker.
+
+ The ninja actions talk to an executor in blade through the toolchain
+ client, the executor keeps a pool of connections and limits the
+ concurrent actions of each worker. The actions are run locally if the
+ executor or the workers are unavailable.
+
+ The workers are probed before the build, the unreachable ones and the
+ ones refusing the token are not used. The `local_workers` of
+ remote_execution_config starts the workers on the local machine during
+ the build, for testing, they only listen on the loopback interface.
+
+ Only the compiles are executed remotely. The inputs of a preprocessed
+ compile are a single file, which is hermetic and cheap to upload. The
+ links read all the objects and libraries, and download a large output,
+ so they would spend more time in the transfer than they save. The tests
+ are not hermetic: they read the build dir through the symlink in the
+ runfiles dir, load the shared libraries and prebuilt libraries of the
+ local machine by absolute paths, and depend on its environment, so
+ their results on another machine could not be trusted.
+
+"""
+
+
+import binascii
+import json
+import os
+import pipes
+import socket
+import SocketServer
+import subprocess
+import sys
+import threading
+
+import config
+import console
+import remote_worker
+
+
+_SOCKET = '.blade_remote.sock'
+
+_LOCAL_WORKERS_DIR = '.blade_remote_workers'
+
+# Options only used by the preprocessing, with their arguments
+_PREPROCESS_OPTIONS = frozenset(['-I', '-D', '-U', '-include', '-imacros',
+                                 '-isystem', '-iquote', '-idirafter',
+                                 '-MF', '-MT', '-MQ'])
+_PREPROCESS_FLAGS = frozenset(['-MMD', '-MD', '-MP'])
+_PREPROCESS_PREFIXES = ('-I', '-D', '-U', '-isystem', '-iquote', '-idirafter')
+
+_SOURCE_SUFFIXES = frozenset(['.c', '.cc', '.cpp', '.cxx', '.c++', '.C'])
+
+
+def socket_path(build_dir):
+    """Returns the path of the unix socket the executor listens on. """
+    return os.path.join(build_dir, _SOCKET)
+
+
+def _enabled():
+    # Only the ninja backend is supported
+    return (config.get_item('remote_execution_config', 'enabled') and
+            config.get_item('global_config', 'native_builder') == 'ninja')
+
+
+# The token of the local workers if no token is configured
+_local_token = None
+
+# The configured workers which are reachable, probed once
+_reachable_workers = None
+
+
+def _token():
+    """Returns the token sent to the workers. """
+    global _local_token
+    token_file = config.get_item('remote_execution_config', 'token_file')
+    try:
+        token = remote_worker.read_token(token_file)
+    except IOError as e:
+        console.error_exit('Failed to read the remote execution token: %s' % e)
+    if token:
+        return token
+    if _local_token is None:
+        _local_token = binascii.hexlify(os.urandom(16))
+    return _local_token
+
+
+def _connect(address, token, timeout=None):
+    """Connect and authenticate to the worker, returns the socket and its file. """
+    host, port = address.rsplit(':', 1)
+    sock = socket.create_connection((host, int(port)), timeout)
+    f = sock.makefile('rb')
+    try:
+        remote_worker.send(sock, {'op': 'auth', 'token': token})
+        if not remote_worker.receive(f)[0].get('ok'):
+            raise IOError('Authentication failed')
+    except:
+        f.close()
+        sock.close()
+        raise
+    sock.settimeout(None)
+    return sock, f
+
+
+def _probe_workers():
+    """Returns the configured workers which are reachable and accept the token.
+
+    The workers are probed concurrently, only once in a build.
+    """
+    global _reachable_workers
+    if _reachable_workers is not None:
+        return _reachable_workers
+    remote_config = config.get_section('remote_execution_config')
+    addresses = remote_config['workers']
+    token = _token()
+    errors = [None] * len(addresses)
+    threads = []
+    for i, address in enumerate(addresses):
+        def probe(i=i, address=address):
+            try:
+                sock, f = _connect(address, token, remote_config['probe_timeout'])
+                f.close()
+                sock.close()
+            except (IOError, socket.error, ValueError) as e:
+                errors[i] = e
+        thread = threading.Thread(target=probe)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    _reachable_workers = []
+    for address, error in zip(addresses, errors):
+        if error:
+            console.warning('Remote worker %s is unavailable: %s, skipped' % (address, error))
+        else:
+            _reachable_workers.append(address)
+    return _reachable_workers
+
+
+def slots():
+    """Returns the total concurrent actions of the available workers. """
+    if not _enabled():
+        return 0
+    remote_config = config.get_section('remote_execution_config')
+    workers = len(_probe_workers()) + remote_config['local_workers']
+    return workers * remote_config['worker_jobs']
+
+
+class _WorkerConnections(object):
+    """The pool of connections and running actions of a worker. """
+    def __init__(self, address, jobs, token):
+        self.address = address
+        self.jobs = jobs
+        self.token = token
+        self.running = 0
+        self.down = False
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return _connect(self.address, self.token)
+
+    def release(self, connection):
+        with self._lock:
+            self._idle.append(connection)
+
+    def close(self):
+        with self._lock:
+            for sock, f in self._idle:
+                f.close()
+                sock.close()
+            self._idle = []
+
+
+class _CompileCommand(object):
+    """The compile command split into the local and remote parts. """
+    def __init__(self, args):
+        self.compiler = None
+        self.output = None
+        self.source = None
+        self.flags = []
+        i = 0
+        # Skip the compiler wrappers, the remote compiles are not cached by them
+        while i < len(args) and os.path.basename(args[i]) in ('ccache', 'distcc'):
+            i += 1
+        if i < len(args):
+            self.compiler = args[i]
+        i += 1
+        while i < len(args):
+            arg = args[i]
+            if arg == '-o' and i + 1 < len(args):
+                self.output = args[i + 1]
+                i += 2
+                continue
+            if arg in _PREPROCESS_OPTIONS and i + 1 < len(args):
+                self.flags += args[i:i + 2]
+                i += 2
+                continue
+            if not arg.startswith('-') and os.path.splitext(arg)[1] in _SOURCE_SUFFIXES:
+                self.source = arg
+            else:
+                self.flags.append(arg)
+            i += 1
+
+    def remotable(self):
+        """Whether the compile can be executed remotely. """
+        if not (self.compiler and self.output and self.source and '-c' in self.flags):
+            return False
+        if os.path.isabs(self.output):
+            return False
+        for flag in self.flags:
+            # The profiles and headers are only available locally
+            if flag.startswith('-fprofile-') or flag in ('-x', '-E'):
+                return False
+        return True
+
+    def preprocessed(self):
+        if self.source.endswith('.c'):
+            return self.output + '.i'
+        return self.output + '.ii'
+
+    def outputs(self):
+        outputs = [self.output]
+        if '-gsplit-dwarf' in self.flags:
+            outputs.append(os.path.splitext(self.output)[0] + '.dwo')
+        return outputs
+
+    def preprocess_command(self):
+        flags = [flag for flag in self.flags if flag != '-c']
+        return ([self.compiler] + flags +
+                ['-E', '-MT', self.output, '-o', self.preprocessed(), self.source])
+
+    def remote_command(self, cwd):
+        flags = []
+        skip = False
+        for flag in self.flags:
+            if skip:
+                skip = False
+            elif flag in _PREPROCESS_OPTIONS:
+                skip = True
+            elif flag not in _PREPROCESS_FLAGS and not flag.startswith(_PREPROCESS_PREFIXES):
+                flags.append(flag)
+        # Record the local dir in the debug info instead of the remote one,
+        # mapped further as the local dir is mapped if it is
+        comp_dir = cwd
+        for flag in flags:
+            for option in ('-ffile-prefix-map=', '-fdebug-prefix-map='):
+                if flag.startswith(option + cwd + '='):
+                    comp_dir = flag[len(option + cwd + '='):]
+        args = [self.compiler] + flags + ['-o', self.output, self.preprocessed()]
+        return ' '.join([pipes.quote(arg) for arg in args] +
+                        ['-fdebug-prefix-map=$BLADE_EXEC_ROOT=%s' % pipes.quote(comp_dir)])
+
+
+class _ExecutorHandler(SocketServer.StreamRequestHandler):
+    """Handle the requests of the toolchain client. """
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        args = [arg.encode('utf-8') for arg in request['args']]
+        env = dict((name.encode('utf-8'), value.encode('utf-8'))
+                   for name, value in request['env'].iteritems())
+        cwd = request['cwd'].encode('utf-8')
+        try:
+            ret, output = self.server.compile(args[1:], cwd, env)
+        except Exception as e:
+            ret, output = 1, 'Blade(error): %s\n' % e
+        self.wfile.write('%d\n' % ret)
+        self.wfile.write(output)
+
+
+class _Executor(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, workers, jobs, token):
+        SocketServer.UnixStreamServer.__init__(self, path, _ExecutorHandler)
+        self.workers = [_WorkerConnections(address, jobs, token) for address in workers]
+        self.slots = threading.Semaphore(len(workers) * jobs)
+        self.lock = threading.Lock()
+
+    def _acquire_worker(self):
+        """Returns the least loaded available worker, None if all are down. """
+        self.slots.acquire()
+        with self.lock:
+            workers = [w for w in self.workers if not w.down and w.running < w.jobs]
+            if not workers:
+                self.slots.release()
+                return None
+            worker = min(workers, key=lambda w: float(w.running) / w.jobs)
+            worker.running += 1
+            return worker
+
+    def _release_worker(self, worker):
+        with self.lock:
+            worker.running -= 1
+        self.slots.release()
+
+    def compile(self, args, cwd, env):
+        """Preprocess locally and compile remotely, returns the exit code
+        and the output. It falls back to compile locally if no worker is
+        available.
+        """
+        command = _CompileCommand(args)
+        if not command.remotable():
+            return remote_worker.run(args, cwd=cwd, env=env)
+        preprocessed = os.path.join(cwd, command.preprocessed())
+        ret, output = remote_worker.run(command.preprocess_command(), cwd=cwd, env=env)
+        if ret:
+            return ret, output
+        try:
+            worker = self._acquire_worker()
+            if worker:
+                try:
+                    return 0, output + self._execute(worker, command, cwd, preprocessed)
+                except _RemoteFailure as e:
+                    return 1, output + e.output
+                except (IOError, socket.error, ValueError) as e:
+                    # Do not try the broken worker again in this build
+                    worker.down = True
+                    worker.close()
+                    console.warning('Remote worker %s is down: %s' % (worker.address, e))
+                finally:
+                    self._release_worker(worker)
+        finally:
+            if os.path.exists(preprocessed):
+                os.remove(preprocessed)
+        return remote_worker.run(args, cwd=cwd, env=env)
+
+    def _execute(self, worker, command, cwd, preprocessed):
+        data = open(preprocessed, 'rb').read()
+        digest = remote_worker.md5(data)
+        connection = worker.acquire()
+        sock, f = connection
+        try:
+            remote_worker.send(sock, {'op': 'missing', 'digests': [digest]})
+            if remote_worker.receive(f)[0]['missing']:
+                remote_worker.send(sock, {'op': 'upload', 'digest': digest, 'size': len(data)}, data)
+                if not remote_worker.receive(f)[0]['ok']:
+                    raise IOError('Failed to upload %s' % preprocessed)
+            remote_worker.send(sock, {'op': 'execute',
+                         'command': command.remote_command(cwd),
+                         'inputs': {command.preprocessed(): digest},
+                         'outputs': command.outputs()})
+            result = remote_worker.receive(f)[0]
+            for path, digest in result['outputs'].iteritems():
+                if path not in command.outputs():
+                    raise IOError('Unexpected output %s' % path)
+                remote_worker.send(sock, {'op': 'download', 'digest': digest})
+                data = remote_worker.receive(f)[1]
+                path = os.path.join(cwd, path.encode('utf-8'))
+                with open(path + '.tmp', 'wb') as out:
+                    out.write(data)
+                os.rename(path + '.tmp', path)
+        except:
+            f.close()
+            sock.close()
+            raise
+        worker.release(connection)
+        output = result['output'].encode('utf-8')
+        if result['exit_code']:
+            raise _RemoteFailure(output)
+        return output
+
+
+class _RemoteFailure(Exception):
+    """The action failed remotely, not because of the worker. """
+    def __init__(self, output):
+        Exception.__init__(self)
+        self.output = output
+
+
+def _start_local_workers(build_dir, count, jobs, token):
+    """Start the workers on localhost, returns their processes and addresses. """
+    processes, addresses = [], []
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.abspath(__file__))
+    env[remote_worker.TOKEN_ENV] = token
+    for i in range(count):
+        dir = os.path.join(build_dir, _LOCAL_WORKERS_DIR, str(i))
+        p = subprocess.Popen([sys.executable, '-m', 'remote_worker', '--bind', '127.0.0.1',
+                              dir, '0', str(jobs)],
+                             env=env, stdout=subprocess.PIPE)
+        port = p.stdout.readline().strip()
+        if not port.isdigit():
+            console.warning('Failed to start local remote execution worker')
+            continue
+        processes.append(p)
+        addresses.append('127.0.0.1:%s' % port)
+    return processes, addresses
+
+
+def start(build_dir):
+    """Start the executor and the local workers if enabled. """
+    if not _enabled():
+        return None
+    remote_config = config.get_section('remote_execution_config')
+    token = _token()
+    processes, addresses = _start_local_workers(
+            build_dir, remote_config['local_workers'], remote_config['worker_jobs'], token)
+    addresses += _probe_workers()
+    path = socket_path(build_dir)
+    if os.path.exists(path):
+        os.remove(path)
+    if not addresses:
+        return None
+    executor = _Executor(path, addresses, remote_config['worker_jobs'], token)
+    thread = threading.Thread(target=executor.serve_forever)
+    thread.daemon = True
+    thread.start()
+    console.info('remote execution on %d workers' % len(addresses))
+    return executor, processes
+
+
+def stop(build_dir, started):
+    """Stop the executor and the local workers started by start. """
+    if not started:
+        return
+    executor, processes = started
+    executor.shutdown()
+    executor.server_close()
+    for worker in executor.workers:
+        worker.close()
+    for p in processes:
+        p.terminate()
+        p.wait()
+    path = socket_path(build_dir)
+    if os.path.exists(path):
+        os.remove(path)
+
@@ -0,0 +1,289 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   May 21, 2018
+
+
+"""
+ The worker daemon of the remote execution, see remote_execution.
+
+ The worker stores the inputs and outputs of the actions in its content
+ addressable storage(CAS) by their md5 digests, and runs each action in a
+ temporary dir with its inputs copied from the CAS. The results of the
+ successful actions are cached in memory by the command and the digests of
+ the inputs, the least recently used ones are evicted. It only depends on
+ the builtin modules and blade_util, so it can be started on a machine
+ without the source tree:
+
+     PYTHONPATH=/path/to/blade.zip python -m remote_worker \
+         [--bind HOST] [--allow HOSTS] [--token-file FILE] DIR PORT JOBS
+
+ The worker runs the commands of its clients, so it only serves the hosts
+ in the allowlist and the clients knowing the shared token, at least one
+ of them is required. The token may also be passed in the environment
+ variable BLADE_REMOTE_TOKEN.
+
+ The messages in both directions are a json line, followed by the data
+ of the size in it if any. The first message of a connection is the auth
+ with the token.
+
+"""
+
+
+import argparse
+import collections
+import hmac
+import json
+import os
+import re
+import shutil
+import socket
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+
+import blade_util
+
+
+TOKEN_ENV = 'BLADE_REMOTE_TOKEN'
+
+_DIGEST_RE = re.compile('^[0-9a-f]{32}$')
+
+# How many results are kept in the action cache, the least recently used
+# ones are evicted
+_ACTION_CACHE_SIZE = 100000
+
+
+def md5(data):
+    return blade_util.md5sum_str(data)
+
+
+def send(sock, header, data=''):
+    sock.sendall(json.dumps(header) + '\n' + data)
+
+
+def receive(f):
+    """Receive a header and its data of the size in the header. """
+    line = f.readline()
+    if not line:
+        raise IOError('Connection closed')
+    header = json.loads(line)
+    data = ''
+    if header.get('size'):
+        data = f.read(header['size'])
+        if len(data) != header['size']:
+            raise IOError('Connection closed')
+    return header, data
+
+
+def run(cmd, cwd=None, env=None, shell=False):
+    """Run the command, returns the exit code and the merged output. """
+    p = subprocess.Popen(cmd, cwd=cwd, env=env, shell=shell,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = p.communicate()[0]
+    return p.returncode, output
+
+
+def read_token(path):
+    """Read the shared token from the file, None if the path is empty. """
+    if not path:
+        return None
+    with open(path) as f:
+        return f.read().strip()
+
+
+def valid_digest(digest):
+    return isinstance(digest, basestring) and _DIGEST_RE.match(digest) is not None
+
+
+def valid_path(path):
+    """Whether the path is relative and stays inside the dir it is joined to. """
+    if not isinstance(path, basestring) or not path or os.path.isabs(path):
+        return False
+    return '..' not in path.replace(os.sep, '/').split('/')
+
+
+class _WorkerHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            header = receive(self.rfile)[0]
+        except (IOError, ValueError):
+            return
+        ok = (isinstance(header, dict) and header.get('op') == 'auth' and
+              self.server.authenticate(header.get('token')))
+        send(self.connection, {'ok': ok})
+        if not ok:
+            return
+        # The connection is kept and reused by the executor
+        while True:
+            try:
+                header, data = receive(self.rfile)
+                self._handle(header, data)
+            except (IOError, ValueError, KeyError, TypeError):
+                # Closed or malformed
+                return
+
+    def _handle(self, header, data):
+        op = header['op']
+        if op == 'missing':
+            send(self.connection, {'missing': [d for d in header['digests']
+                                               if not self.server.has(d)]})
+        elif op == 'upload':
+            send(self.connection, {'ok': self.server.put(header['digest'], data)})
+        elif op == 'download':
+            data = self.server.get(header['digest'])
+            send(self.connection, {'size': len(data)}, data)
+        elif op == 'execute':
+            send(self.connection, self.server.execute(header))
+        else:
+            raise ValueError('Unknown op %s' % op)
+
+
+class _Worker(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, dir, port, jobs, host='', token=None, allowed_hosts=None):
+        if not token and not allowed_hosts:
+            raise ValueError('Either the token or the allowed hosts is required')
+        SocketServer.TCPServer.__init__(self, (host, port), _WorkerHandler)
+        self.token = token
+        # The addresses of the allowed hosts, empty means any host
+        self.allowed_hosts = set()
+        for allowed in allowed_hosts or []:
+            self.allowed_hosts.add(socket.gethostbyname(allowed))
+        self.cas_dir = os.path.join(dir, 'cas')
+        self.exec_dir = os.path.join(dir, 'exec')
+        for d in (self.cas_dir, self.exec_dir):
+            if not os.path.isdir(d):
+                os.makedirs(d)
+        self.jobs = threading.Semaphore(jobs)
+        # md5(command and inputs) -> result, only the successful ones
+        self.action_cache = collections.OrderedDict()
+        self.action_cache_lock = threading.Lock()
+
+    def verify_request(self, request, client_address):
+        return not self.allowed_hosts or client_address[0] in self.allowed_hosts
+
+    def authenticate(self, token):
+        if not self.token:
+            return True
+        return isinstance(token, basestring) and hmac.compare_digest(
+                token.encode('utf-8'), self.token)
+
+    def _cas_path(self, digest):
+        if not valid_digest(digest):
+            raise ValueError('Invalid digest %s' % digest)
+        return os.path.join(self.cas_dir, digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self._cas_path(digest))
+
+    def put(self, digest, data):
+        if md5(data) != digest:
+            return False
+        path = self._cas_path(digest)
+        if os.path.exists(path):
+            return True
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass  # Created by another thread
+        fd, tmp = tempfile.mkstemp(dir=self.cas_dir)
+        os.write(fd, data)
+        os.close(fd)
+        os.rename(tmp, path)
+        return True
+
+    def get(self, digest):
+        return open(self._cas_path(digest), 'rb').read()
+
+    def execute(self, action):
+        for path in list(action['inputs']) + list(action['outputs']):
+            if not valid_path(path):
+                return {'exit_code': 1, 'outputs': {},
+                        'output': 'Blade(error): Invalid path %s\n' % path}
+        for digest in action['inputs'].itervalues():
+            if not self.has(digest):
+                return {'exit_code': 1, 'outputs': {},
+                        'output': 'Blade(error): Missing input %s\n' % digest}
+        key = md5(json.dumps([action['command'], sorted(action['inputs'].items()),
+                               sorted(action['outputs'])]))
+        with self.action_cache_lock:
+            result = self.action_cache.pop(key, None)
+            if result is not None:
+                self.action_cache[key] = result
+                return result
+        with self.jobs:
+            result = self._execute(action)
+        if result['exit_code'] == 0:
+            with self.action_cache_lock:
+                self.action_cache[key] = result
+                while len(self.action_cache) > _ACTION_CACHE_SIZE:
+                    self.action_cache.popitem(last=False)
+        return result
+
+    def _execute(self, action):
+        root = tempfile.mkdtemp(dir=self.exec_dir)
+        try:
+            for path, digest in action['inputs'].iteritems():
+                path = os.path.join(root, path)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                # Copied, the actions writing their inputs would corrupt
+                # the CAS through a hard link
+                shutil.copyfile(self._cas_path(digest), path)
+            for path in action['outputs']:
+                dir = os.path.dirname(os.path.join(root, path))
+                if not os.path.isdir(dir):
+                    os.makedirs(dir)
+            env = dict(os.environ)
+            env['BLADE_EXEC_ROOT'] = root
+            exit_code, output = run(action['command'], cwd=root, env=env, shell=True)
+            output = output.decode('utf-8', 'replace')
+            outputs = {}
+            if exit_code == 0:
+                for path in action['outputs']:
+                    full_path = os.path.join(root, path)
+                    if os.path.isfile(full_path):
+                        outputs[path] = blade_util.md5sum_file(full_path)
+                        if not self.has(outputs[path]):
+                            self.put(outputs[path], open(full_path, 'rb').read())
+            return {'exit_code': exit_code, 'output': output, 'outputs': outputs}
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def run_worker(dir, port, jobs, host='', token=None, allowed_hosts=None):
+    """Run the worker until killed, the port is printed once it is ready. """
+    worker = _Worker(dir, port, jobs, host, token, allowed_hosts)
+    print worker.server_address[1]
+    sys.stdout.flush()
+    worker.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='remote_worker')
+    parser.add_argument('--bind', default='',
+                        help='The address to listen on, all interfaces by default')
+    parser.add_argument('--allow', default='',
+                        help='Comma separated hosts allowed to connect')
+    parser.add_argument('--token-file', default='',
+                        help='The file containing the shared token of the clients')
+    parser.add_argument('dir')
+    parser.add_argument('port', type=int)
+    parser.add_argument('jobs', type=int)
+    options = parser.parse_args()
+    token = read_token(options.token_file) or os.environ.get(TOKEN_ENV)
+    allowed_hosts = [host for host in options.allow.split(',') if host]
+    if not token and not allowed_hosts:
+        parser.error('either --token-file or --allow is required')
+    run_worker(options.dir, options.port, options.jobs,
+               options.bind, token, allowed_hosts)
+
+
+if __name__ == '__main__':
+    main()
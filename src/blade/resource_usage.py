@@ -0,0 +1,104 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   March 12, 2018
+
+
+"""
+ This module records the peak memory usage of the memory hungry build
+ actions and estimates how many of them could run concurrently without
+ swapping.
+
+"""
+
+
+import json
+import os
+import time
+
+
+# The raw records appended by the actions
+_RUSAGE_LOG = '.blade_rusage.log'
+
+# The peak memory of each rule merged from the raw records
+_RUSAGE_HISTORY = '.blade_rusage.json'
+
+# The history is sampled again after this seconds to follow the changes
+_SAMPLE_INTERVAL = 7 * 24 * 3600
+
+
+def record(log, rule, output, maxrss):
+    """Append the peak memory(KB) of an action to the log. """
+    # A single short line written in append mode would not be interleaved
+    # with the lines written by the concurrent actions
+    f = open(log, 'a')
+    f.write('%s\t%s\t%d\n' % (rule, output, maxrss))
+    f.close()
+
+
+def log_path(build_dir):
+    """Returns the path of the log file the actions record to. """
+    return os.path.join(build_dir, _RUSAGE_LOG)
+
+
+def load_history(build_dir):
+    """Returns the peak memory(KB) of each rule recorded in history.
+
+    The records appended since last time are merged into the history file.
+    """
+    history_file = os.path.join(build_dir, _RUSAGE_HISTORY)
+    history = {}
+    if os.path.exists(history_file):
+        try:
+            history = json.load(open(history_file))
+        except ValueError:
+            history = {}
+    log = log_path(build_dir)
+    if not os.path.exists(log):
+        return history
+    for line in open(log):
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) != 3 or not fields[2].isdigit():
+            continue
+        rule, maxrss = fields[0], int(fields[2])
+        history[rule] = max(history.get(rule, 0), maxrss)
+    json.dump(history, open(history_file, 'w'))
+    os.remove(log)
+    return history
+
+
+def need_sampling(build_dir, rule, history):
+    """Returns whether the peak memory of the rule should be recorded.
+
+    Recording wraps each action with an extra process, so it is done only
+    when the rule has no history or the history is out of date.
+    """
+    if rule not in history:
+        return True
+    history_file = os.path.join(build_dir, _RUSAGE_HISTORY)
+    try:
+        return time.time() - os.path.getmtime(history_file) > _SAMPLE_INTERVAL
+    except OSError:
+        return True
+
+
+def available_memory():
+    """Returns the memory(MB) available for new processes. """
+    meminfo = {}
+    try:
+        for line in open('/proc/meminfo'):
+            fields = line.split()
+            if len(fields) >= 2 and fields[1].isdigit():
+                meminfo[fields[0].rstrip(':')] = int(fields[1])
+    except IOError:
+        pass
+    if 'MemAvailable' in meminfo:
+        return meminfo['MemAvailable'] / 1024
+    if 'MemFree' in meminfo:
+        return (meminfo['MemFree'] + meminfo.get('Cached', 0)) / 1024
+    try:
+        pages = os.sysconf('SC_PHYS_PAGES')
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        return pages * page_size / (1024 * 1024)
+    except (ValueError, OSError):
+        return 0
@@ -22,8 +22,22 @@ import subprocess
 import blade_util
 import config
 import console
+import phase_stats
+import remote_execution
+import resource_usage
+import toolchain_server
+import unity_build
+import version_stamp
 
-from blade_platform import CcFlagsManager
+
+# The memory hungry rules of ninja backend, grouped by the pools
+# which limit their concurrency
+_HEAVY_ACTION_POOLS = {
+    'link': ['link', 'solink'],
+    'java': ['javac', 'scalac'],
+    'jar': ['fatjar', 'onejar'],
+    'lto': ['ltolink', 'ltosolink'],
+}
 
 
 def _incs_list_to_string(incs):
@@ -45,7 +59,8 @@ class ScriptHeaderGenerator(object):
     for the underlying build system.
     """
     def __init__(self, options, build_dir, gcc_version,
-                 python_inc, cuda_inc, build_environment, svn_roots):
+                 python_inc, cuda_inc, build_environment, svn_roots,
+                 ccflags_manager):
         self.rules_buf = []
         self.options = options
         self.build_dir = build_dir
@@ -53,7 +68,7 @@ class ScriptHeaderGenerator(object):
         self.python_inc = python_inc
         self.cuda_inc = cuda_inc
         self.build_environment = build_environment
-        self.ccflags_manager = CcFlagsManager(options, build_dir, gcc_version)
+        self.ccflags_manager = ccflags_manager
         self.svn_roots = svn_roots
 
         self.distcc_enabled = config.get_item('distcc_config', 'enabled')
@@ -77,20 +92,22 @@ class ScriptHeaderGenerator(object):
 
 class SconsScriptHeaderGenerator(ScriptHeaderGenerator):
     def __init__(self, options, build_dir, gcc_version,
-                 python_inc, cuda_inc, build_environment, svn_roots):
+                 python_inc, cuda_inc, build_environment, svn_roots,
+                 ccflags_manager):
         ScriptHeaderGenerator.__init__(
                 self, options, build_dir, gcc_version,
-                python_inc, cuda_inc, build_environment, svn_roots)
+                python_inc, cuda_inc, build_environment, svn_roots,
+                ccflags_manager)
 
     def generate_version_file(self):
         """Generate version information files. """
-        blade_root_dir = self.build_environment.blade_root_dir
         self._add_rule(
                 'version_obj = scons_helper.generate_version_file(top_env, '
-                'blade_root_dir="%s", build_dir="%s", profile="%s", '
-                'gcc_version="%s", svn_roots=%s)' % (
-                blade_root_dir, self.build_dir, self.options.profile,
-                self.gcc_version, sorted(self.svn_roots)))
+                'build_dir="%s", profile="%s", gcc_version="%s")' % (
+                self.build_dir, self.options.profile, self.gcc_version))
+        if getattr(self.options, 'stamp', False):
+            self._add_rule('top_env.Replace(STAMP_FILE="%s")' %
+                           version_stamp.stamp_file_path(self.build_dir))
 
     def generate_imports_functions(self, blade_path):
         """Generates imports and functions. """
@@ -307,11 +324,19 @@ import scons_helper
                         cc_config['cflags'],
                         cc_config['cxxflags'],
                         ld_env_str, linkflags))
+        if cc_config['reproducible']:
+            # The random seed is used in the symbol and section names
+            self._add_rule('top_env.Append(CCFLAGS=["-frandom-seed=$TARGET"])')
+        if cc_config['unity_build']:
+            # Record the unity files failed to compile to exclude their sources
+            self._add_rule('top_env.Replace(UNITYCXXCOM=top_env["SHCXXCOM"] + '
+                           '" || { echo $SOURCE >> %s; exit 1; }")' %
+                           unity_build.failure_log_path(self.build_dir))
 
         cc_library_config = config.get_section('cc_library_config')
         # By default blade use 'ar rcs' and skip ranlib
         # to generate index for static library
-        arflags = ''.join(cc_library_config['arflags'])
+        arflags = self.ccflags_manager.get_arflags()
         self._add_rule('top_env.Replace(ARFLAGS="%s")' % arflags)
         ranlibflags = cc_library_config['ranlibflags']
         if ranlibflags:
@@ -387,16 +412,28 @@ import scons_helper
 
 class NinjaScriptHeaderGenerator(ScriptHeaderGenerator):
     def __init__(self, options, build_dir, blade_path, gcc_version,
-                 python_inc, cuda_inc, build_environment, svn_roots):
+                 python_inc, cuda_inc, build_environment, svn_roots,
+                 ccflags_manager):
         ScriptHeaderGenerator.__init__(
                 self, options, build_dir, gcc_version,
-                python_inc, cuda_inc, build_environment, svn_roots)
+                python_inc, cuda_inc, build_environment, svn_roots,
+                ccflags_manager)
         self.blade_path = blade_path
+        # rule -> (pool, whether to record the peak memory of the rule)
+        self.heavy_action_pools = {}
+        # Total slots of the distcc hosts, 0 means compiling locally
+        self.distcc_slots = 0
+        # Total slots of the remote execution workers
+        self.remote_slots = 0
 
     def generate_rule(self, name, command, description=None,
                       depfile=None, generator=False, pool=None,
                       restat=False, rspfile=None,
                       rspfile_content=None, deps=None):
+        if name in self.heavy_action_pools:
+            pool, record_rusage = self.heavy_action_pools[name]
+            if record_rusage:
+                command = self._generate_rusage_command(name, command)
         self._add_rule('rule %s' % name)
         self._add_rule('  command = %s' % command)
         if description:
@@ -423,6 +460,83 @@ ninja_required_version = 1.7
 builddir = %s
 ''' % self.build_dir)
 
+    def setup_distcc(self):
+        """Compile on the reachable distcc hosts if distcc is enabled. """
+        self.remote_slots = remote_execution.slots()
+        if self.remote_slots:
+            # Remote execution is preferred
+            return
+        if not (self.distcc_enabled and self.build_environment.distcc_env_prepared):
+            return
+        distcc_config = config.get_section('distcc_config')
+        hosts = self.build_environment.probe_distcc_hosts(
+                distcc_config['probe_timeout'], distcc_config['pump'])
+        if not hosts:
+            return
+        # Inherited by ninja and the compiles run by it
+        os.environ['DISTCC_HOSTS'] = ' '.join(hosts)
+        self.distcc_slots = self.build_environment.distcc_slots
+        console.info('distcc hosts: %s, %d slots' % (' '.join(hosts), self.distcc_slots))
+
+    def generate_pools(self):
+        """Generate pools to limit the concurrency of memory hungry actions.
+
+        The depth of pool is derived from the available memory and the
+        peak memory of the actions in it unless it is configured explicitly.
+        The peak memory is only recorded on the sampling builds.
+        """
+        pool_config = config.get_section('pool_config')
+        history = resource_usage.load_history(self.build_dir)
+        memory = (resource_usage.available_memory() -
+                  pool_config['reserved_memory'])
+        for pool in sorted(_HEAVY_ACTION_POOLS):
+            rules = _HEAVY_ACTION_POOLS[pool]
+            depth = pool_config['%s_depth' % pool]
+            if not depth:
+                peak = max([history.get(rule, 0) for rule in rules]) / 1024
+                if not peak:
+                    peak = pool_config['%s_memory' % pool]
+                depth = max(1, memory / peak)
+                if pool == 'lto':
+                    # Each link time optimization runs parallel jobs
+                    lto_jobs = config.get_item('cc_config', 'lto_jobs')
+                    depth = min(depth, max(1, blade_util.cpu_count() / lto_jobs))
+            if self.distcc_slots or self.remote_slots:
+                # The jobs number is raised for distcc, but these run locally
+                depth = min(depth, blade_util.cpu_count())
+            self._add_rule('''
+pool %s_pool
+  depth = %d''' % (pool, depth))
+            for rule in rules:
+                # The peak memory is recorded to derive the depth, or traced
+                record_rusage = getattr(self.options, 'build_trace', False) or (
+                        not pool_config['%s_depth' % pool] and
+                        resource_usage.need_sampling(self.build_dir, rule, history))
+                self.heavy_action_pools[rule] = ('%s_pool' % pool, record_rusage)
+        # Pool for the links which are too heavy to run with each other
+        self._add_rule('''
+pool exclusive_link_pool
+  depth = 1
+''')
+        if self.distcc_slots or self.remote_slots:
+            # The distributed compiles are limited by the slots of the hosts,
+            # the actions which can not be distributed by the local cpus
+            self._add_rule('''
+pool %s
+  depth = %d
+
+pool local_pool
+  depth = %d
+''' % ('remote_pool' if self.remote_slots else 'distcc_pool',
+       self.remote_slots or self.distcc_slots, blade_util.cpu_count()))
+
+    def _generate_rusage_command(self, rule, command):
+        """Wrap the command to record its peak memory. """
+        command = command.replace("'", "'\\''")
+        return self.generate_toolchain_command(
+                'rusage', suffix="%s %s \"${out}\" '%s'" % (
+                resource_usage.log_path(self.build_dir), rule, command))
+
     def generate_common_rules(self):
         self.generate_rule(name='stamp',
                            command='touch ${out}',
@@ -451,12 +565,28 @@ cxx_warnings = %s
             cc = 'ccache ' + cc
             cxx = 'ccache ' + cxx
         self.ccflags_manager.set_cc(cc)
+        compile_cc, compile_cxx = cc, cxx
+        compile_pool = local_pool = None
+        if self.distcc_slots:
+            if build_with_ccache:
+                # Only compile the cache misses on the distcc hosts
+                os.environ['CCACHE_PREFIX'] = 'distcc'
+            else:
+                compile_cc, compile_cxx = 'distcc ' + cc, 'distcc ' + cxx
+            compile_pool, local_pool = 'distcc_pool', 'local_pool'
+        elif self.remote_slots:
+            remote = self._remote_compile_command()
+            compile_cc, compile_cxx = remote + cc, remote + cxx
+            compile_pool, local_pool = 'remote_pool', 'local_pool'
         cc_config = config.get_section('cc_config')
         cc_library_config = config.get_section('cc_library_config')
         cflags, cxxflags = cc_config['cflags'], cc_config['cxxflags']
         cppflags, ldflags = self.ccflags_manager.get_flags_except_warning()
         cppflags = cc_config['cppflags'] + cppflags
-        arflags = ''.join(cc_library_config['arflags'])
+        if cc_config['reproducible']:
+            # The random seed is used in the symbol and section names
+            cppflags.append('-frandom-seed=${out}')
+        arflags = self.ccflags_manager.get_arflags()
         ldflags = cc_config['linkflags'] + ldflags
         includes = cc_config['extra_incs']
         includes = includes + ['.', self.build_dir]
@@ -465,53 +595,100 @@ cxx_warnings = %s
         self.generate_cc_warning_vars()
         self.generate_rule(name='cc',
                 command='%s -o ${out} -MMD -MF ${out}.d '
-                        '-c -fPIC %s %s ${c_warnings} ${cppflags} '
+                        '-c -fPIC %s %s ${c_warnings} ${cppflags} ${compileflags} '
                         '%s ${includes} ${in}' % (
-                        cc, ' '.join(cflags), ' '.join(cppflags), includes),
+                        compile_cc, ' '.join(cflags), ' '.join(cppflags), includes),
                 description='CC ${in}',
                 depfile='${out}.d',
+                pool=compile_pool,
                 deps='gcc')
         self.generate_rule(name='cxx',
                 command='%s -o ${out} -MMD -MF ${out}.d '
-                        '-c -fPIC %s %s ${cxx_warnings} ${cppflags} '
+                        '-c -fPIC %s %s ${cxx_warnings} ${cppflags} ${compileflags} '
                         '%s ${includes} ${in}' % (
-                        cxx, ' '.join(cxxflags), ' '.join(cppflags), includes),
+                        compile_cxx, ' '.join(cxxflags), ' '.join(cppflags), includes),
                 description='CXX ${in}',
                 depfile='${out}.d',
+                pool=compile_pool,
                 deps='gcc')
+        self.generate_rule(name='cxxpch',
+                command='%s -o ${out} -MMD -MF ${out}.d -x c++-header '
+                        '-c -fPIC %s %s ${cxx_warnings} ${cppflags} ${compileflags} '
+                        '%s ${includes} ${in}' % (
+                        cxx, ' '.join(cxxflags), ' '.join(cppflags), includes),
+                description='CXX PCH ${in}',
+                depfile='${out}.d',
+                pool=local_pool,
+                deps='gcc')
+        if config.get_item('cc_config', 'unity_build'):
+            self.generate_rule(name='cxxunity',
+                    command='%s -o ${out} -MMD -MF ${out}.d '
+                            '-c -fPIC %s %s ${cxx_warnings} ${cppflags} ${compileflags} '
+                            '%s ${includes} ${in} || '
+                            '{ echo ${in} >> %s; exit 1; }' % (
+                            compile_cxx, ' '.join(cxxflags), ' '.join(cppflags), includes,
+                            unity_build.failure_log_path(self.build_dir)),
+                    description='CXX UNITY ${in}',
+                    depfile='${out}.d',
+                    pool=compile_pool,
+                    deps='gcc')
         if config.get_item('cc_config', 'header_inclusion_dependencies'):
             preprocess = '%s -o /dev/null -E -H %s %s -w ${cppflags} %s ${includes} ${in} 2>${out}'
             self.generate_rule(name='cchdrs',
                     command=preprocess % (cc, ' '.join(cflags), ' '.join(cppflags), includes),
-                    description='CC HDRS ${in}')
+                    description='CC HDRS ${in}',
+                    pool=local_pool)
             self.generate_rule(name='cxxhdrs',
                     command=preprocess % (cxx, ' '.join(cxxflags), ' '.join(cppflags), includes),
-                    description='CXX HDRS ${in}')
+                    description='CXX HDRS ${in}',
+                    pool=local_pool)
+        if cc_config['dwp']:
+            self.generate_rule(name='dwp',
+                               command='%s -e ${in} -o ${out}' % os.environ.get('DWP', 'dwp'),
+                               description='DWP ${out}')
         securecc = '%s %s' % (cc_config['securecc'], cxx)
         self._add_rule('''
 build __securecc_phony__ : phony
 ''')
         self.generate_rule(name='securecccompile',
                 command='%s -o ${out} -c -fPIC '
-                        '%s %s ${cxx_warnings} ${cppflags} %s ${includes} ${in}' % (
+                        '%s %s ${cxx_warnings} ${cppflags} ${compileflags} %s ${includes} ${in}' % (
                         securecc, ' '.join(cxxflags), ' '.join(cppflags), includes),
-                description='SECURECC ${in}')
+                description='SECURECC ${in}',
+                pool=local_pool)
         self.generate_rule(name='securecc',
                 command=self.generate_toolchain_command('securecc_object'),
                 description='SECURECC ${in}',
                 restat=True)
 
+        # The archives of link time optimized objects are created by
+        # gcc-ar, which is set in the ar variable of the build statements
+        self._add_rule('ar = ar')
         self.generate_rule(name='ar',
-                           command='rm -f $out; ar %s $out $in' % arflags,
+                           command='rm -f $out; ${ar} %s $out $in' % arflags,
                            description='AR ${out}')
-        self.generate_rule(name='link',
-                           command='%s -o ${out} %s ${ldflags} ${in} ${extra_ldflags}' % (
-                                   ld, ' '.join(ldflags)),
-                           description='LINK ${out}')
-        self.generate_rule(name='solink',
-                           command='%s -o ${out} -shared %s ${ldflags} ${in} ${extra_ldflags}' % (
-                                   ld, ' '.join(ldflags)),
-                           description='SHAREDLINK ${out}')
+        self.generate_rule(name='thinar',
+                           command='rm -f $out; ${ar} %sT $out $in' % arflags,
+                           description='AR ${out}')
+        lto_ldflags = ldflags + ['-flto=%d' % config.get_item('cc_config', 'lto_jobs')]
+        for prefix, flags in [('', ldflags), ('lto', lto_ldflags)]:
+            self.generate_rule(name=prefix + 'link',
+                               command='%s -o ${out} %s ${ldflags} ${in} ${extra_ldflags}' % (
+                                       ld, ' '.join(flags)),
+                               description='LINK ${out}')
+            # The exported symbols and soname of the shared library are written
+            # into the .toc file, which is only updated when they change. The
+            # dependents depend on the .toc instead of the .so, so with restat
+            # they are not relinked for the implementation only changes.
+            self.generate_rule(name=prefix + 'solink',
+                               command='%s -o ${out} -shared %s ${ldflags} ${in} ${extra_ldflags} && '
+                                       '{ readelf -d ${out} | grep SONAME; '
+                                       'nm -gD -f p ${out} | cut -f1-2 -d" "; } > ${out}.tmp && '
+                                       'if ! cmp -s ${out}.tmp ${out}.toc; then mv ${out}.tmp ${out}.toc; '
+                                       'else rm -f ${out}.tmp; fi' % (
+                                       ld, ' '.join(flags)),
+                               description='SHAREDLINK ${out}',
+                               restat=True)
 
     def generate_proto_rules(self):
         proto_config = config.get_section('proto_library_config')
@@ -763,30 +940,44 @@ pool %s
                            description='PACKAGE ${out}')
 
     def generate_version_rules(self):
-        revision, url = blade_util.load_scm(self.build_dir)
-        args = '${out} ${revision} ${url} ${profile} "${compiler}"'
+        # The volatile version info is not in the source but stamped into
+        # the binaries after linking, see version_stamp
+        args = '${out} ${profile} "${compiler}"'
         self.generate_rule(name='scm',
                            command=self.generate_toolchain_command('scm', suffix=args),
-                           description='SCM ${out}')
+                           description='SCM ${out}',
+                           restat=True)
         scm = os.path.join(self.build_dir, 'scm.cc')
         self._add_rule('''
 build %s: scm
-  revision = %s
-  url = %s
   profile = %s
   compiler = %s
-''' % (scm, revision, url, self.options.profile, 'GCC ' + self.gcc_version))
+''' % (scm, self.options.profile, 'GCC ' + self.gcc_version))
         self._add_rule('''
 build %s: cxx %s
   cppflags = -w -O2
   cxx_warnings =
 ''' % (scm + '.o', scm))
+        if getattr(self.options, 'stamp', False):
+            args = '${out} ${in} %s' % version_stamp.stamp_file_path(self.build_dir)
+            self.generate_rule(name='versionstamp',
+                               command=self.generate_toolchain_command('stamp', suffix=args),
+                               description='STAMP ${out}')
+
+    def _remote_compile_command(self):
+        """The prefix of the compile commands executed remotely, see remote_execution. """
+        return 'PYTHONPATH=%s:$$PYTHONPATH python -S %s %s remote_compile ' % (
+                self.blade_path, toolchain_server.client_path(self.build_dir),
+                remote_execution.socket_path(self.build_dir))
 
     def generate_toolchain_command(self, builder, prefix='', suffix=''):
         cmd = ['PYTHONPATH=%s:$$PYTHONPATH' % self.blade_path]
         if prefix:
             cmd.append(prefix)
-        cmd.append('python -m toolchain %s' % builder)
+        # Run by the toolchain server through the client, see toolchain_server
+        cmd.append('python -S %s %s %s' % (
+                   toolchain_server.client_path(self.build_dir),
+                   toolchain_server.socket_path(self.build_dir), builder))
         if suffix:
             cmd.append(suffix)
         else:
@@ -796,6 +987,9 @@ build %s: cxx %s
     def generate(self):
         """Generate ninja rules. """
         self.generate_top_level_vars()
+        toolchain_server.write_client(self.build_dir)
+        self.setup_distcc()
+        self.generate_pools()
         self.generate_common_rules()
         self.generate_cc_rules()
         self.generate_proto_rules()
@@ -834,9 +1028,25 @@ class RulesGenerator(object):
 
     def generate_build_script(self):
         """Generate build script for underlying build system. """
+        cc_config = config.get_section('cc_config')
+        if cc_config['reproducible']:
+            # Fix the __DATE__, __TIME__ and the build time in version info,
+            # which are inherited by the native builder and the actions
+            os.environ.setdefault('SOURCE_DATE_EPOCH', '0')
+        if getattr(self.blade.get_options(), 'stamp', False):
+            version_stamp.generate_stamp_file(self.build_dir,
+                                              self.blade.build_environment.blade_root_dir,
+                                              self.blade.svn_root_dirs)
+        if cc_config['unity_build']:
+            unity_build.load_state(self.build_dir,
+                                   cc_config['unity_build_isolation_hours'],
+                                   cc_config['unity_build_exclusion_hours'])
         rules = self.generate_build_rules()
+        unity_build.save_state()
         script = open(self.script_path, 'w')
         script.writelines(rules)
+        phase_stats.count('rules', len(rules))
+        phase_stats.count('script_bytes', script.tell())
         script.close()
         return rules
 
@@ -856,7 +1066,8 @@ class SconsRulesGenerator(RulesGenerator):
                 python_inc,
                 cuda_inc,
                 self.blade.build_environment,
-                self.blade.svn_root_dirs)
+                self.blade.svn_root_dirs,
+                self.blade.get_cc_flags_manager())
 
     def generate_build_rules(self):
         """Generates scons rules to SConstruct. """
@@ -884,7 +1095,8 @@ class NinjaRulesGenerator(RulesGenerator):
                 python_inc,
                 cuda_inc,
                 self.blade.build_environment,
-                self.blade.svn_root_dirs)
+                self.blade.svn_root_dirs,
+                self.blade.get_cc_flags_manager())
         rules = ninja_script_header_generator.generate()
         rules += self.blade.gen_targets_rules()
         return rules
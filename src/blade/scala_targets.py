@@ -197,11 +197,12 @@ class ScalaFatLibrary(ScalaTarget):
 class ScalaTest(ScalaFatLibrary):
     """ScalaTest"""
     def __init__(self, name, srcs, deps, resources, source_encoding, warnings,
-                 testdata, kwargs):
+                 testdata, writable_testdata, kwargs):
         ScalaFatLibrary.__init__(self, name, srcs, deps, resources, source_encoding,
                                  warnings, [], kwargs)
         self.type = 'scala_test'
         self.data['testdata'] = var_to_list(testdata)
+        self.data['writable_testdata'] = writable_testdata
         scalatest_libs = config.get_item('scala_test_config', 'scalatest_libs')
         if scalatest_libs:
             self._add_hardcode_java_library(scalatest_libs)
@@ -283,6 +284,7 @@ def scala_test(name,
                source_encoding=None,
                warnings=None,
                testdata=[],
+               writable_testdata=False,
                **kwargs):
     """Define scala_test target. """
     target = ScalaTest(name,
@@ -292,6 +294,7 @@ def scala_test(name,
                        source_encoding,
                        warnings,
                        testdata,
+                       writable_testdata,
                        kwargs)
     blade.blade.register_target(target)
 
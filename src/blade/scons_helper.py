@@ -21,12 +21,12 @@ import re
 import py_compile
 import shutil
 import signal
-import socket
 import stat
 import string
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import tarfile
 import zipfile
@@ -36,11 +36,14 @@ import SCons
 import SCons.Action
 import SCons.Builder
 import SCons.Scanner
+import SCons.Scanner.C
 import SCons.Scanner.Prog
 
 import blade_util
+import build_trace
 import console
 import toolchain
+import version_stamp
 
 from console import colors
 
@@ -64,6 +67,11 @@ linking_tmp_dir = ''
 build_time = time.time()
 
 
+# file to record the timing of actions, set when build trace is enabled
+build_trace_file = os.environ.get(build_trace.TRACE_ENV_NAME)
+build_trace_lock = threading.Lock()
+
+
 def set_blade_error_log(path):
     global blade_error_log
     if blade_error_log:
@@ -636,9 +644,17 @@ then
   coverage_options="%s"
 fi
 
-exec java $coverage_options -classpath %s %s %s %s $@
-""" % (_generate_java_test_coverage_flag(env), ':'.join(jars),
-       jvm_flags, main_class, run_args))
+test_classes="%s"
+if [ -n "$GTEST_TOTAL_SHARDS" ]
+then
+  # Run the test classes of this shard
+  test_classes=`echo $test_classes | tr ' ' '\\n' |
+                awk -v n="$GTEST_TOTAL_SHARDS" -v i="$GTEST_SHARD_INDEX" '(NR - 1) %% n == i'`
+fi
+
+exec java $coverage_options -classpath %s %s %s $test_classes $@
+""" % (_generate_java_test_coverage_flag(env), run_args, ':'.join(jars),
+       jvm_flags, main_class))
     os.chmod(target, 0755)
     target_file.close()
 
@@ -931,6 +947,20 @@ def _echo(stdout, stderr):
             blade_error_log.write(stderr)
 
 
+def _trace_action(start_time, end_time, pid, args):
+    """Record the timing of an action for the build trace. """
+    output = args[-1]
+    if '-o' in args[:-1]:
+        output = args[args.index('-o') + 1]
+    build_trace_lock.acquire()
+    try:
+        f = open(build_trace_file, 'a')
+        f.write('%f\t%f\t%d\t%s\n' % (start_time, end_time, pid, output))
+        f.close()
+    finally:
+        build_trace_lock.release()
+
+
 def echospawn(sh, escape, cmd, args, env):
     # convert env from unicode strings
     asciienv = {}
@@ -939,6 +969,7 @@ def echospawn(sh, escape, cmd, args, env):
 
     cmdline = ' '.join(args)
     console.debug(cmdline)
+    start_time = time.time()
     p = subprocess.Popen(cmdline,
                          env=asciienv,
                          stderr=subprocess.PIPE,
@@ -946,6 +977,8 @@ def echospawn(sh, escape, cmd, args, env):
                          shell=True,
                          universal_newlines=True)
     stdout, stderr = p.communicate()
+    if build_trace_file:
+        _trace_action(start_time, time.time(), p.pid, args)
 
     global option_verbose
     if not option_verbose:
@@ -1471,6 +1504,24 @@ def setup_lex_yacc_builders(top_env):
     top_env.Replace(LEXCOM = "$LEX $LEXFLAGS -o $TARGET $SOURCES")
 
 
+def setup_pch_builders(top_env):
+    compile_pch_message = console.erasable('%sPrecompiling %s$SOURCE%s%s' % \
+        (colors('cyan'), colors('purple'), colors('cyan'), colors('end')))
+    pch_bld = SCons.Builder.Builder(action = MakeAction(
+        '$SHCXX -o $TARGET -x c++-header -c $SHCXXFLAGS $SHCCFLAGS $_CCCOMCOM $SOURCE',
+        compile_pch_message),
+        source_scanner = SCons.Scanner.C.CScanner())
+    top_env.Append(BUILDERS = {"Pch" : pch_bld})
+
+
+def setup_dwp_builders(top_env):
+    dwp_message = console.erasable('%sPackaging Debug Info %s$TARGET%s%s' % \
+        (colors('green'), colors('purple'), colors('green'), colors('end')))
+    dwp_bld = SCons.Builder.Builder(action = MakeAction(
+        '%s -e $SOURCE -o $TARGET' % os.environ.get('DWP', 'dwp'), dwp_message))
+    top_env.Append(BUILDERS = {"Dwp" : dwp_bld})
+
+
 def setup_resource_builders(top_env):
     compile_resource_index_message = console.erasable('%sGenerating resource index for %s$SOURCE_PATH/$TARGET_NAME%s%s' % \
         (colors('cyan'), colors('purple'), colors('cyan'), colors('end')))
@@ -1534,6 +1585,8 @@ def setup_shell_builders(top_env):
 
 def setup_other_builders(top_env):
     setup_lex_yacc_builders(top_env)
+    setup_pch_builders(top_env)
+    setup_dwp_builders(top_env)
     setup_resource_builders(top_env)
     setup_python_builders(top_env)
     setup_package_builders(top_env)
@@ -1568,87 +1621,19 @@ def setup_swig_builders(top_env, build_dir):
     top_env.Append(BUILDERS={"SwigPhp" : swig_php_bld})
 
 
-def _exec_get_version_info(cmd, cwd):
-    lc_all_env = os.environ
-    lc_all_env['LC_ALL'] = 'POSIX'
-    p = subprocess.Popen(cmd,
-                         env=lc_all_env,
-                         cwd=cwd,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE,
-                         shell=True)
-    stdout, stderr = p.communicate()
-    if p.returncode:
-        return None
-    else:
-        return stdout.replace('"','\\"').replace('\n', '\\n"\n"')
-
-
-def _get_version_info(blade_root_dir, svn_roots):
-    """Gets svn root dir info. """
-    svn_info_map = {}
-    if os.path.exists("%s/.git" % blade_root_dir):
-        cmd = "git log -n 1"
-        dirname = os.path.dirname(blade_root_dir)
-        version_info = _exec_get_version_info(cmd, None)
-        if version_info:
-            svn_info_map[dirname] = version_info
-        return svn_info_map
-
-    for root_dir in svn_roots:
-        root_dir_realpath = os.path.realpath(root_dir)
-        svn_working_dir = os.path.dirname(root_dir_realpath)
-        svn_dir = os.path.basename(root_dir_realpath)
-
-        cmd = 'svn info %s' % svn_dir
-        version_info = _exec_get_version_info(cmd, svn_working_dir)
-        if not version_info:
-            cmd = 'git ls-remote --get-url && git branch | grep "*" && git log -n 1'
-            version_info = _exec_get_version_info(cmd, root_dir_realpath)
-            if not version_info:
-                console.warning('Failed to get version control info in %s' % root_dir)
-
-        if version_info:
-            svn_info_map[root_dir] = version_info
-
-    return svn_info_map
-
-def generate_version_file(top_env, blade_root_dir, build_dir,
-                          profile, gcc_version, svn_roots):
+def generate_version_file(top_env, build_dir, profile, gcc_version):
     """Generate version information files. """
-    svn_info_map = _get_version_info(blade_root_dir, svn_roots)
-    svn_info_len = len(svn_info_map)
-
-    if not os.path.exists(build_dir):
-        os.makedirs(build_dir)
-    filename = os.path.join(build_dir, 'version.c')
-    version_c = open(filename, 'w')
-
-    print >>version_c, '/* This file was generated by blade */'
-    print >>version_c, ('''
-extern const int kSvnInfoCount;
-extern const char* const kSvnInfo[];
-extern const char kBuildType[];
-extern const char kBuildTime[];
-extern const char kBuilderName[];
-extern const char kHostName[];
-extern const char kCompiler[];''')
-
-    print >>version_c, 'const int kSvnInfoCount = %d;' % svn_info_len
-    print >>version_c, 'const char* const kSvnInfo[%d] = {%s};' % (
-            svn_info_len, ', '.join(['"%s"' % v for v in svn_info_map.values()]))
-    print >>version_c, 'const char kBuildType[] = "%s";' % profile
-    print >>version_c, 'const char kBuildTime[] = "%s";' % time.asctime()
-    print >>version_c, 'const char kBuilderName[] = "%s";' % os.getenv('USER')
-    print >>version_c, (
-            'const char kHostName[] = "%s";' % socket.gethostname())
-    compiler = 'GCC %s' % gcc_version
-    print >>version_c, 'const char kCompiler[] = "%s";' % compiler
-
-    version_c.close()
+    filename = os.path.join(build_dir, 'version.cc')
+    version_stamp.generate_version_source(filename, profile,
+                                          'GCC %s' % gcc_version)
 
     env_version = top_env.Clone()
     env_version.Replace(SHCXXCOMSTR=console.erasable(
         '%sUpdating version information%s' % (
             colors('cyan'), colors('end'))))
     return env_version.SharedObject(filename)
+
+
+def stamp_version(target, source, env):
+    """Post link action to stamp the version info into the binary. """
+    return version_stamp.stamp_binary(str(target[0]), env['STAMP_FILE'])
@@ -37,6 +37,7 @@ class ShellTest(Target):
                  srcs,
                  deps,
                  testdata,
+                 writable_testdata,
                  kwargs):
         srcs = var_to_list(srcs)
         deps = var_to_list(deps)
@@ -52,6 +53,7 @@ class ShellTest(Target):
                         kwargs)
 
         self._process_test_data(testdata)
+        self.data['writable_testdata'] = writable_testdata
 
     def _process_test_data(self, testdata):
         """
@@ -136,11 +138,13 @@ def sh_test(name,
             srcs,
             deps=[],
             testdata=[],
+            writable_testdata=False,
             **kwargs):
     blade.blade.register_target(ShellTest(name,
                                           srcs,
                                           deps,
                                           testdata,
+                                          writable_testdata,
                                           kwargs))
 
 
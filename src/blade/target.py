@@ -145,6 +145,13 @@ class Target(object):
                         elif action == 'warning':
                             console.warning(message)
 
+    def _set_test_shards(self, shards):
+        """Set the shards of the test, a positive integer or 'auto'. """
+        if shards != 'auto' and not (isinstance(shards, int) and shards > 0):
+            console.error_exit('%s: shards should be a positive integer or "auto"' %
+                               self.fullname)
+        self.data['shards'] = shards
+
     def _add_hardcode_library(self, hardcode_dep_list):
         """Add hardcode dep list to key's deps. """
         for dep in hardcode_dep_list:
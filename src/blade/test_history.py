@@ -0,0 +1,176 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   May 28, 2018
+
+
+"""
+ This module keeps the history of the incremental tests in sqlite.
+
+ The history consists of:
+    meta: the test arguments and environment of the last run
+    tests: the digests, last result and failure counts of each test
+    durations: the recent durations of each test
+    digests: the file digests cached by (inode, size, mtime)
+
+ Only the rows of the tests in this run are read, and the rows of the
+ tests and files which no longer exist are removed periodically.
+
+"""
+
+
+import json
+import os
+import sqlite3
+import time
+
+import console
+
+
+_HISTORY_FILE = '.blade.test.history'
+
+# The stamp file of the old versions, removed when the history is opened
+_LEGACY_STAMP_FILE = '.blade.test.stamp'
+
+# How many recent durations are kept for each test
+_MAX_DURATIONS = 10
+
+# Interval of the garbage collection, in seconds
+_GC_INTERVAL = 86400
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT);
+CREATE TABLE IF NOT EXISTS tests (
+    name TEXT PRIMARY KEY,
+    runfile TEXT,
+    binary_digest TEXT,
+    data_digest TEXT,
+    result TEXT,
+    runs INTEGER DEFAULT 0,
+    failures INTEGER DEFAULT 0,
+    last_run REAL);
+CREATE TABLE IF NOT EXISTS durations (
+    name TEXT,
+    time REAL,
+    duration REAL);
+CREATE INDEX IF NOT EXISTS durations_name ON durations (name, time);
+CREATE TABLE IF NOT EXISTS digests (
+    path TEXT PRIMARY KEY,
+    inode INTEGER,
+    size INTEGER,
+    mtime REAL,
+    digest TEXT);
+'''
+
+# The max number of variables in a sqlite statement is 999 by default
+_QUERY_BATCH_SIZE = 500
+
+
+class TestHistory(object):
+    """The incremental test history of the workspace. """
+    def __init__(self, path=_HISTORY_FILE):
+        self.path = path
+        if os.path.exists(_LEGACY_STAMP_FILE):
+            os.remove(_LEGACY_STAMP_FILE)
+        self.loaded = True
+        try:
+            self._open()
+        except sqlite3.DatabaseError as e:
+            console.warning('error loading incremental test history: %s, '
+                            'will run full test' % e)
+            self.loaded = False
+            os.remove(self.path)
+            self._open()
+
+    def _open(self):
+        self.db = sqlite3.connect(self.path, timeout=60)
+        self.db.executescript(_SCHEMA)
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                        (key, json.dumps(value, sort_keys=True)))
+
+    def get_tests(self, names):
+        """Returns the records of the tests, keyed by name.
+
+        Each record is a dict with binary_digest, data_digest, result,
+        runs, failures and durations (the recent ones, oldest first).
+        """
+        tests = {}
+        names = list(names)
+        for i in range(0, len(names), _QUERY_BATCH_SIZE):
+            batch = names[i:i + _QUERY_BATCH_SIZE]
+            marks = ','.join('?' * len(batch))
+            for row in self.db.execute(
+                    'SELECT name, binary_digest, data_digest, result, runs, failures '
+                    'FROM tests WHERE name IN (%s)' % marks, batch):
+                tests[row[0]] = {
+                    'binary_digest': row[1],
+                    'data_digest': row[2],
+                    'result': row[3],
+                    'runs': row[4],
+                    'failures': row[5],
+                    'durations': [],
+                }
+            for name, duration in self.db.execute(
+                    'SELECT name, duration FROM durations WHERE name IN (%s) '
+                    'ORDER BY time' % marks, batch):
+                tests[name]['durations'].append(duration)
+        return tests
+
+    def update_test(self, name, runfile, digests, result=None, duration=None):
+        """Record the digests and the result of the test if it was run. """
+        binary_digest, data_digest = digests
+        self.db.execute('INSERT OR IGNORE INTO tests (name) VALUES (?)', (name,))
+        self.db.execute('UPDATE tests SET runfile = ?, binary_digest = ?, data_digest = ? '
+                        'WHERE name = ?', (runfile, binary_digest, data_digest, name))
+        if result is None:
+            return
+        now = time.time()
+        self.db.execute('UPDATE tests SET result = ?, runs = runs + 1, '
+                        'failures = failures + ?, last_run = ? WHERE name = ?',
+                        (result, int(result != 'SUCCESS'), now, name))
+        if duration is None:
+            return
+        self.db.execute('INSERT INTO durations VALUES (?, ?, ?)', (name, now, duration))
+        self.db.execute('DELETE FROM durations WHERE name = ? AND time NOT IN '
+                        '(SELECT time FROM durations WHERE name = ? '
+                        'ORDER BY time DESC LIMIT ?)', (name, name, _MAX_DURATIONS))
+
+    def get_digest(self, path, key):
+        """Returns the cached digest of the file if its key is unchanged. """
+        row = self.db.execute('SELECT inode, size, mtime, digest FROM digests '
+                              'WHERE path = ?', (path,)).fetchone()
+        if row and tuple(row[:3]) == tuple(key):
+            return row[3]
+        return None
+
+    def set_digest(self, path, key, digest):
+        self.db.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)',
+                        (path,) + tuple(key) + (digest,))
+
+    def gc(self):
+        """Remove the rows of the tests and files which no longer exist. """
+        now = time.time()
+        if self.get_meta('gc_time', 0) + _GC_INTERVAL > now:
+            return
+        for name, runfile in self.db.execute('SELECT name, runfile FROM tests').fetchall():
+            if not runfile or not os.path.exists(runfile):
+                self.db.execute('DELETE FROM tests WHERE name = ?', (name,))
+                self.db.execute('DELETE FROM durations WHERE name = ?', (name,))
+        for path, in self.db.execute('SELECT path FROM digests').fetchall():
+            if not os.path.exists(path):
+                self.db.execute('DELETE FROM digests WHERE path = ?', (path,))
+        self.set_meta('gc_time', now)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
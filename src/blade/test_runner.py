@@ -14,6 +14,8 @@
 """
 
 
+import json
+import math
 import os
 import sys
 import subprocess
@@ -25,6 +27,8 @@ import console
 
 from blade_util import environ_add_path
 from blade_util import md5sum
+from blade_util import md5sum_file
+from test_history import TestHistory
 from test_scheduler import TestScheduler
 
 
@@ -66,48 +70,37 @@ class TestRunner(binary_runner.BinaryRunner):
         """Init method. """
         binary_runner.BinaryRunner.__init__(self, targets, options, target_database)
         self.direct_targets = direct_targets
-        self.inctest_md5_file = '.blade.test.stamp'
         self.tests_detail_file = 'blade_tests_detail'
+        self.test_logs_index_file = os.path.join(self.build_dir, 'blade_test_logs.json')
         self.inctest_run_list = []
-        self.last_test_stamp = {}
-        self.last_test_stamp['md5'] = {}
-        self.test_stamp = {}
-        self.test_stamp['md5'] = {}
-        self.valid_inctest_time_interval = 86400
+        self.history = TestHistory()
+        self.test_digests = {}
+        self.test_durations = {}
+        self.test_shards = {}
+        self.test_data = {}
         self.tests_run_map = {}
         self.run_all_reason = ''
         self.title = '=' * 13
         self.skipped_tests = []
         self.coverage = getattr(options, 'coverage', False)
-        if not self.options.fulltest:
-            if os.path.exists(self.inctest_md5_file):
-                try:
-                    f = open(self.inctest_md5_file)
-                    self.last_test_stamp = eval(f.read())
-                    f.close()
-                except (IOError, SyntaxError):
-                    console.warning('error loading incremental test history, will run full test')
-                    self.run_all_reason = 'NO_HISTORY'
-
-        self.test_stamp['testarg'] = md5sum(str(self.options.args))
+        self.inctest_time = time.time()
+        if not self.history.loaded and not self.options.fulltest:
+            self.run_all_reason = 'NO_HISTORY'
+
+        self.testarg = md5sum(str(self.options.args))
         env_keys = os.environ.keys()
         env_keys = set(env_keys).difference(env_ignore_set)
-        last_test_env = {}
+        self.test_env = {}
         for env_key in env_keys:
-            last_test_env[env_key] = os.environ[env_key]
-        self.test_stamp['env'] = last_test_env
-        self.test_stamp['inctest_time'] = time.time()
+            self.test_env[env_key] = os.environ[env_key]
 
         if not self.options.fulltest:
-            if self.test_stamp['testarg'] != (
-                    self.last_test_stamp.get('testarg', None)):
+            if self.testarg != self.history.get_meta('testarg'):
                 self.run_all_reason = 'ARGUMENT'
                 console.info('all tests will run due to test arguments changed')
 
-            new_env = self.test_stamp['env']
-            old_env = self.last_test_stamp.get('env', {})
-            if isinstance(old_env, str):  # For old test record
-                old_env = {}
+            new_env = self.test_env
+            old_env = self.history.get_meta('env', {})
             if new_env != old_env:
                 self.run_all_reason = 'ENVIRONMENT'
                 console.info('all tests will run due to test environments changed:')
@@ -116,19 +109,42 @@ class TestRunner(binary_runner.BinaryRunner):
                     console.info('new environments: %s' % new)
                 if old:
                     console.info('old environments: %s' % old)
-
-            this_time = int(round(self.test_stamp['inctest_time']))
-            last_time = int(round(self.last_test_stamp.get('inctest_time', 0)))
-            interval = this_time - last_time
-
-            if interval >= self.valid_inctest_time_interval or interval < 0:
-                self.run_all_reason = 'STALE'
-                console.info('all tests will run due to all passed tests are expired now')
         else:
             self.run_all_reason = 'FULLTEST'
 
+    def _file_digest(self, path):
+        """Returns the content digest of the file.
+
+        The digests are cached by (inode, size, mtime), so the unchanged
+        files are not hashed again.
+        """
+        st = os.stat(path)
+        key = (st.st_ino, st.st_size, st.st_mtime)
+        digest = self.history.get_digest(path, key)
+        if digest is None:
+            digest = md5sum_file(path)
+            # A file modified within the mtime resolution may be modified
+            # again without changing the key, do not cache it
+            if st.st_mtime < self.inctest_time - 2:
+                self.history.set_digest(path, key, digest)
+        return digest
+
+    def _path_digest(self, path):
+        """Returns the content digest of the file or the directory. """
+        if not os.path.isdir(path):
+            return self._file_digest(path)
+        digests = []
+        for dir, subdirs, files in os.walk(path):
+            subdirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(dir, name)
+                if os.path.isfile(file_path):
+                    digests.append('%s %s' % (os.path.relpath(file_path, path),
+                                              self._file_digest(file_path)))
+        return md5sum('\n'.join(digests))
+
     def _get_test_target_md5sum(self, target):
-        """Get test target md5sum. """
+        """Get the digests of the test binary and the test data. """
         related_file_list = []
         related_file_data_list = []
         test_file_name = os.path.abspath(self._executable(target))
@@ -170,25 +186,27 @@ class TestRunner(binary_runner.BinaryRunner):
         test_target_str = ''
         test_target_data_str = ''
         for f in related_file_list:
-            mtime = os.path.getmtime(f)
-            ctime = os.path.getctime(f)
-            test_target_str += str(mtime) + str(ctime)
+            test_target_str += '%s %s\n' % (f, self._path_digest(f))
 
         for f in related_file_data_list:
-            mtime = os.path.getmtime(f)
-            ctime = os.path.getctime(f)
-            test_target_data_str += str(mtime) + str(ctime)
+            test_target_data_str += '%s %s\n' % (f, self._path_digest(f))
 
         return md5sum(test_target_str), md5sum(test_target_data_str)
 
     def _generate_inctest_run_list(self):
         """Get incremental test run list. """
-        for target in self.targets.values():
-            if not target.type.endswith('_test'):
-                continue
+        tests = [target for target in self.targets.values()
+                 if target.type.endswith('_test')]
+        history = self.history.get_tests([target.fullname for target in tests])
+        for target in tests:
             target_key = (target.path, target.name)
             test_file_name = os.path.abspath(self._executable(target))
-            self.test_stamp['md5'][test_file_name] = self._get_test_target_md5sum(target)
+            new_digests = self._get_test_target_md5sum(target)
+            self.test_digests[target.fullname] = new_digests
+            if target.fullname in history:
+                durations = history[target.fullname]['durations']
+                if durations:
+                    self.test_durations[target.key] = sum(durations) / len(durations)
             if self.run_all_reason:
                 self.tests_run_map[target_key] = {
                         'runfile': test_file_name,
@@ -206,34 +224,24 @@ class TestRunner(binary_runner.BinaryRunner):
                         'costtime': 0}
                 continue
 
-            old_md5sum = self.last_test_stamp['md5'].get(test_file_name, None)
-            new_md5sum = self.test_stamp['md5'][test_file_name]
-            if new_md5sum != old_md5sum:
+            last = history.get(target.fullname)
+            reason = ''
+            if not last or not last['result']:
+                reason = 'NO_HISTORY'
+            elif last['result'] != 'SUCCESS':
+                reason = 'LAST_FAILED'
+            elif new_digests[0] != last['binary_digest']:
+                reason = 'BINARY'
+            elif new_digests[1] != last['data_digest']:
+                reason = 'TESTDATA'
+            if reason:
                 self.inctest_run_list.append(target)
-                reason = ''
-                if isinstance(old_md5sum, tuple):
-                    if old_md5sum == (0, 0):
-                        reason = 'LAST_FAILED'
-                    else:
-                        if new_md5sum[0] != old_md5sum[0]:
-                            reason = 'BINARY'
-                        else:
-                            reason = 'TESTDATA'
-                else:
-                    reason = 'STALE'
                 self.tests_run_map[target_key] = {
                         'runfile': test_file_name,
                         'result': '',
                         'reason': reason,
                         'costtime': 0}
 
-        # Append old md5sum that not existed into new
-        old_keys = set(self.last_test_stamp['md5'].keys())
-        new_keys = set(self.test_stamp['md5'].keys())
-        diff_keys = old_keys.difference(new_keys)
-        for key in diff_keys:
-            self.test_stamp['md5'][key] = self.last_test_stamp['md5'][key]
-
     def _get_java_coverage_data(self):
         """
         Return a list of tuples(source directory, class directory, execution data)
@@ -247,16 +255,19 @@ class TestRunner(binary_runner.BinaryRunner):
             target = self.targets[key]
             if target.type != 'java_test':
                 continue
-            execution_data = os.path.join(self._runfiles_dir(target), 'jacoco.exec')
-            if not os.path.isfile(execution_data):
-                continue
             target_under_test = target.data.get('target_under_test')
             if not target_under_test:
                 continue
             target_under_test = self.target_database[target_under_test]
             source_dir = target_under_test._get_sources_dir()
             class_dir = target_under_test._get_classes_dir()
-            coverage_data.append((source_dir, class_dir, execution_data))
+            # Each shard collects its own execution data
+            shards = self.test_shards.get(key, 0)
+            runfiles_dirs = [self._runfiles_dir(target, (i, shards)) for i in range(shards)]
+            for runfiles_dir in runfiles_dirs or [self._runfiles_dir(target)]:
+                execution_data = os.path.join(runfiles_dir, 'jacoco.exec')
+                if os.path.isfile(execution_data):
+                    coverage_data.append((source_dir, class_dir, execution_data))
 
         return coverage_data
 
@@ -290,22 +301,24 @@ class TestRunner(binary_runner.BinaryRunner):
     def _generate_coverage_report(self):
         self._generate_java_coverage_report()
 
-    def _check_inctest_md5sum_file(self):
-        """check the md5sum file size, remove it when it is too large.
-           It is 2G by default.
-        """
-        if os.path.exists(self.inctest_md5_file):
-            if os.path.getsize(self.inctest_md5_file) > 2 * 1024 * 1024 * 1024:
-                console.warning('Will remove the md5sum file for incremental '
-                                'test for it is oversized')
-                os.remove(self.inctest_md5_file)
-
     def _write_test_history(self):
-        """write md5sum to file. """
-        f = open(self.inctest_md5_file, 'w')
-        print >> f, str(self.test_stamp)
-        f.close()
-        self._check_inctest_md5sum_file()
+        """Record the digests and results of the tests run. """
+        for target in self.targets.values():
+            if not target.type.endswith('_test'):
+                continue
+            run_item = self.tests_run_map.get(target.key)
+            # The tests not run or interrupted keep their history
+            if not run_item or not run_item['result']:
+                continue
+            self.history.update_test(target.fullname,
+                                     run_item['runfile'],
+                                     self.test_digests[target.fullname],
+                                     run_item['result'],
+                                     run_item['costtime'])
+        self.history.set_meta('testarg', self.testarg)
+        self.history.set_meta('env', self.test_env)
+        self.history.gc()
+        self.history.close()
 
     def _write_tests_detail_map(self):
         """write the tests detail map for further use. """
@@ -355,20 +368,57 @@ class TestRunner(binary_runner.BinaryRunner):
             for target in failed_targets:
                 print >>sys.stderr, '%s, exit code: %s' % (
                         target.fullname, target.data['test_exit_code'])
-                test_file_name = os.path.abspath(self._executable(target))
-                # Do not skip failed test by default
-                if test_file_name in self.test_stamp['md5']:
-                    self.test_stamp['md5'][test_file_name] = (0, 0)
             console.info('%d tests passed.' % (run_tests - len(failed_targets)))
         else:
             console.info('All tests passed!')
 
+    def _get_test_shards(self, target):
+        """Returns the shards of the test, [None] if it is not sharded.
+
+        The number of shards is either specified, or computed from the
+        history for shards = 'auto' to make each shard take about
+        test_shard_duration of global_config.
+        """
+        shards = target.data.get('shards', 1)
+        if target.data.get('exclusive'):
+            # Run one by one anyway
+            shards = 1
+        elif shards == 'auto':
+            duration = self.test_durations.get(target.key, 0)
+            shard_duration = config.get_item('global_config', 'test_shard_duration')
+            shards = int(math.ceil(duration / shard_duration))
+            shards = min(shards, self.options.test_jobs)
+        if shards <= 1:
+            return [None]
+        self.test_shards[target.key] = shards
+        return [(i, shards) for i in range(shards)]
+
+    def _prepare_test_runfiles(self, target, shard):
+        """Prepare the runfiles of the test, called in the test workers. """
+        self._prepare_runfiles(target, shard, self.test_data[target.key])
+
+    def _clean_target(self, target):
+        binary_runner.BinaryRunner._clean_target(self, target)
+        shards = self.test_shards.get(target.key, 0)
+        for i in range(shards):
+            binary_runner.BinaryRunner._clean_target(self, target, (i, shards))
+
+    def _write_test_logs_index(self, scheduler):
+        """Write the index of the test logs, for CI to fetch the logs. """
+        if not scheduler.test_logs:
+            return
+        logs = sorted(scheduler.test_logs, key=lambda log: (log['target'], log['shard']))
+        with open(self.test_logs_index_file, 'w') as f:
+            json.dump(logs, f, indent=2, separators=(',', ': '), sort_keys=True)
+        console.info('Test logs are listed in %s' % self.test_logs_index_file)
+
     def _show_tests_result(self, scheduler):
         """Show test detail and summary according to the options. """
         if self.options.show_details:
             self._write_tests_detail_map()
             self._show_tests_detail()
         self._show_tests_summary(scheduler)
+        self._write_test_logs_index(scheduler)
         self._write_test_history()
 
     def run(self):
@@ -382,27 +432,35 @@ class TestRunner(binary_runner.BinaryRunner):
                 if not target.data.get('always_run'):
                     self.skipped_tests.append((target.path, target.name))
                     continue
-            test_env = self._prepare_env(target)
-            cmd = [os.path.abspath(self._executable(target))]
-            cmd += self.options.args
-            if console.color_enabled:
-                test_env['GTEST_COLOR'] = 'yes'
-            else:
-                test_env['GTEST_COLOR'] = 'no'
-            test_env['GTEST_OUTPUT'] = 'xml'
-            test_env['HEAPCHECK'] = target.data.get('heap_check', '')
-            pprof_path = config.get_item('cc_test_config', 'pprof_path')
-            if pprof_path:
-                test_env['PPROF_PATH'] = os.path.abspath(pprof_path)
-            if self.coverage:
-                test_env['BLADE_COVERAGE'] = 'true'
-            tests_run_list.append((target, self._runfiles_dir(target), test_env, cmd))
+            self.test_data[target.key] = self._get_test_data(target)
+            for shard in self._get_test_shards(target):
+                test_env = self._get_run_env(target, shard)
+                cmd = [os.path.abspath(self._executable(target))]
+                cmd += self.options.args
+                if console.color_enabled:
+                    test_env['GTEST_COLOR'] = 'yes'
+                else:
+                    test_env['GTEST_COLOR'] = 'no'
+                test_env['GTEST_OUTPUT'] = 'xml'
+                test_env['HEAPCHECK'] = target.data.get('heap_check', '')
+                pprof_path = config.get_item('cc_test_config', 'pprof_path')
+                if pprof_path:
+                    test_env['PPROF_PATH'] = os.path.abspath(pprof_path)
+                if self.coverage:
+                    test_env['BLADE_COVERAGE'] = 'true'
+                if shard:
+                    test_env['GTEST_SHARD_INDEX'] = str(shard[0])
+                    test_env['GTEST_TOTAL_SHARDS'] = str(shard[1])
+                tests_run_list.append((target, self._runfiles_dir(target, shard),
+                                       test_env, cmd, shard))
 
         sys.stdout.flush()
         concurrent_jobs = self.options.test_jobs
         scheduler = TestScheduler(tests_run_list,
                                   concurrent_jobs,
-                                  self.tests_run_map)
+                                  self.tests_run_map,
+                                  self.test_durations,
+                                  self._prepare_test_runfiles)
         try:
             scheduler.schedule_jobs()
         except KeyboardInterrupt:
@@ -12,7 +12,11 @@
 """
 
 
+import heapq
+import itertools
+import os
 import Queue
+import select
 import signal
 import subprocess
 import sys
@@ -31,15 +35,80 @@ _SIGNAL_MAP = dict([
 ])
 
 
+# Read the output of the tests in blocks of this size
+_LOG_BUFFER_SIZE = 64 * 1024
+
+# How many lines of the output are shown for the failed tests
+_FAILURE_TAIL_LINES = 50
+
+
+def _log_path(run_dir):
+    """Returns the log file of the test run in the runfiles dir. """
+    return os.path.splitext(run_dir)[0] + '.log'
+
+
+def _tail(path, lines=_FAILURE_TAIL_LINES):
+    """Returns the last lines of the file, reading at most its last block. """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - _LOG_BUFFER_SIZE))
+        return ''.join(f.read().splitlines(True)[-lines:])
+
+
+def _job_name(target, shard):
+    if shard:
+        return '%s(shard %d/%d)' % (target.fullname, shard[0] + 1, shard[1])
+    return target.fullname
+
+
+class _EventQueue(object):
+    """The events of the workers, which wake up the scheduler via a pipe.
+
+    The scheduler waits on the pipe with select, so it is woken up as
+    soon as an event arrives, and can still be interrupted by Ctrl-C.
+    """
+    def __init__(self):
+        self.queue = Queue.Queue(0)
+        self.read_fd, self.write_fd = os.pipe()
+
+    def put(self, event):
+        self.queue.put(event)
+        os.write(self.write_fd, 'x')
+
+    def wait(self, timeout):
+        """Wait at most timeout seconds, returns the events arrived. """
+        readable = select.select([self.read_fd], [], [], timeout)[0]
+        if not readable:
+            return []
+        os.read(self.read_fd, 4096)
+        events = []
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except Queue.Empty:
+                return events
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
 class WorkerThread(threading.Thread):
-    def __init__(self, id, job_queue, job_handler, redirect):
-        """Init methods for this thread. """
+    def __init__(self, id, job_queue, job_handler, redirect, events):
+        """Init methods for this thread.
+
+        The worker takes the jobs from job_queue until it gets a None,
+        and notifies the scheduler through events when a job starts and
+        when the worker exits.
+        """
         threading.Thread.__init__(self)
         self.thread_id = id
         self.running = True
         self.job_queue = job_queue
         self.job_handler = job_handler
         self.redirect = redirect
+        self.events = events
+        self.job_serial = 0
         self.job_start_time, self.job_timeout = 0, 0
         self.job_process = None
         self.job_name = ''
@@ -47,14 +116,19 @@ class WorkerThread(threading.Thread):
         self.job_lock = threading.Lock()
         console.info('blade test executor %d starts to work' % self.thread_id)
 
-    def _process(self):
-        """Private handler to handle one job. """
-        console.info('blade worker %d starts to process' % self.thread_id)
-        console.info('blade worker %d finish' % self.thread_id)
-
     def terminate(self):
-        """Terminate the worker. """
+        """Terminate the worker and its running job. """
         self.running = False
+        with self.job_lock:
+            if self.job_process is not None:
+                self._terminate_job()
+
+    def _terminate_job(self):
+        try:
+            self.job_process.terminate()
+        except OSError:
+            # Already exited
+            pass
 
     def cleanup_job(self):
         """Clean up job data. """
@@ -65,67 +139,75 @@ class WorkerThread(threading.Thread):
 
     def set_job_data(self, p, name, timeout):
         """Set the popen object and name if the job is run in a subprocess. """
-        self.job_process, self.job_name, self.job_timeout = p, name, timeout
-
-    def check_job_timeout(self, now):
-        """Check whether the job is timeout or not.
-
-        This method simply checks job timeout and returns immediately.
-        The caller should invoke this method repeatedly so that a job
-        which takes a very long time would be timeout sooner or later.
-        """
-        try:
-            self.job_lock.acquire()
-            if (not self.job_is_timeout and self.job_start_time and
-                self.job_timeout is not None and
-                self.job_name and self.job_process is not None):
-                if self.job_start_time + self.job_timeout < now:
-                    self.job_is_timeout = True
-                    console.error('%s: TIMEOUT\n' % self.job_name)
-                    self.job_process.terminate()
-        finally:
-            self.job_lock.release()
+        with self.job_lock:
+            self.job_process, self.job_name, self.job_timeout = p, name, timeout
+            # Not including the preparation of the runfiles
+            self.job_start_time = time.time()
+        if timeout is not None:
+            self.events.put(('start', self, self.job_serial,
+                             self.job_start_time + timeout))
+
+    def check_job_timeout(self, serial):
+        """Terminate the job if it is still the one which is timeout. """
+        with self.job_lock:
+            if (serial == self.job_serial and not self.job_is_timeout and
+                self.job_process is not None):
+                self.job_is_timeout = True
+                console.error('%s: TIMEOUT\n' % self.job_name)
+                self._terminate_job()
 
     def run(self):
         """executes and runs here. """
         try:
-            if self.job_handler:
-                job_queue = self.job_queue
-                while not job_queue.empty() and self.running:
-                    try:
-                        job = job_queue.get_nowait()
-                    except Queue.Empty:
-                        continue
+            while self.running:
+                job = self.job_queue.get()
+                if job is None:
+                    break
+                with self.job_lock:
+                    self.job_serial += 1
                     self.job_start_time = time.time()
-                    self.job_handler(job, self.redirect, self)
-                    try:
-                        self.job_lock.acquire()
-                        self.cleanup_job()
-                    finally:
-                        self.job_lock.release()
-            else:
-                self._process()
+                self.job_handler(job, self.redirect, self)
+                with self.job_lock:
+                    self.cleanup_job()
         except:
             traceback.print_exc()
+        finally:
+            self.events.put(('exit', self))
 
 
 class TestScheduler(object):
     """TestScheduler. """
-    def __init__(self, tests_list, jobs, tests_run_map):
-        """init method. """
+    def __init__(self, tests_list, jobs, tests_run_map, test_durations=None,
+                 prepare_job=None):
+        """init method.
+
+        test_durations is the expected durations of the tests, keyed by
+        the target key, from the history of the previous runs.
+
+        prepare_job(target, shard) is called in the workers right before
+        running each job, to prepare its runfiles.
+        """
         self.tests_list = tests_list
         self.jobs = jobs
         self.tests_run_map = tests_run_map
+        self.test_durations = test_durations or {}
+        self.prepare_job = prepare_job
         self.tests_run_map_lock = threading.Lock()
         self.cpu_core_num = blade_util.cpu_count()
-        self.num_of_tests = len(self.tests_list)
+        # The shards of a test are counted as one test
+        self.num_of_tests = len(set(job[0].key for job in self.tests_list))
         self.max_worker_threads = 16
         self.failed_targets = []
         self.failed_targets_lock = threading.Lock()
+        self.shard_results = {}
+        self.test_logs = []
         self.num_of_run_tests = 0
         self.num_of_run_tests_lock = threading.Lock()
-        self.job_queue = Queue.Queue(0)
-        self.exclusive_job_queue = Queue.Queue(0)
+        self.events = _EventQueue()
+        self.workers = []
+        self.timer_seq = itertools.count()
+        self.predicted_makespan = 0
+        self.actual_makespan = 0
 
     def _get_workers_num(self):
         """get the number of thread workers. """
@@ -135,7 +217,7 @@ class TestScheduler(object):
         elif self.jobs > max_workers:
             self.jobs = max_workers
 
-        return min(self.num_of_tests, self.jobs)
+        return min(len(self.tests_list), self.jobs)
 
     def _get_result(self, returncode):
         """translate result from returncode. """
@@ -146,66 +228,118 @@ class TestScheduler(object):
         return result
 
     def _run_job_redirect(self, job, job_thread):
-        """run job and redirect the output. """
-        target, run_dir, test_env, cmd = job
-        test_name = target.fullname
+        """run job and redirect the output to the log file. """
+        target, run_dir, test_env, cmd, shard = job
+        test_name = _job_name(target, shard)
         shell = target.data.get('run_in_shell', False)
         if shell:
             cmd = subprocess.list2cmdline(cmd)
         timeout = target.data.get('test_timeout')
+        log_path = _log_path(run_dir)
         console.info('[%s/%s] Running %s' % (self.num_of_run_tests, self.num_of_tests, cmd))
-        p = subprocess.Popen(cmd,
-                             env=test_env,
-                             cwd=run_dir,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT,
-                             close_fds=True,
-                             shell=shell)
-        job_thread.set_job_data(p, test_name, timeout)
-        stdout = p.communicate()[0]
+        with open(log_path, 'w') as log:
+            p = subprocess.Popen(cmd,
+                                 env=test_env,
+                                 cwd=run_dir,
+                                 stdout=log,
+                                 stderr=subprocess.STDOUT,
+                                 close_fds=True,
+                                 shell=shell)
+            job_thread.set_job_data(p, test_name, timeout)
+            p.wait()
+        self._add_test_log(target, shard, p.returncode, log_path)
         result = self._get_result(p.returncode)
-        console.info('Output of %s:\n%s\n%s finished: %s\n' % (
-                     test_name, stdout, test_name, result))
+        if p.returncode:
+            console.info('Tail of the output of %s:\n%s' % (test_name, _tail(log_path)))
+        console.info('%s finished: %s, output in %s\n' % (test_name, result, log_path))
         console.flush()
         return p.returncode
 
     def _run_job(self, job, job_thread):
-        """run job, do not redirect the output. """
-        target, run_dir, test_env, cmd = job
-        test_name = target.fullname
+        """run job, write the output to both the console and the log file. """
+        target, run_dir, test_env, cmd, shard = job
+        test_name = _job_name(target, shard)
         shell = target.data.get('run_in_shell', False)
         if shell:
             cmd = subprocess.list2cmdline(cmd)
         timeout = target.data.get('test_timeout')
+        log_path = _log_path(run_dir)
         console.info('[%s/%s] Running %s' % (self.num_of_run_tests, self.num_of_tests, cmd))
-        p = subprocess.Popen(cmd, env=test_env, cwd=run_dir, close_fds=True, shell=shell)
+        console.flush()
+        p = subprocess.Popen(cmd,
+                             env=test_env,
+                             cwd=run_dir,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT,
+                             close_fds=True,
+                             shell=shell)
         job_thread.set_job_data(p, test_name, timeout)
+        with open(log_path, 'w') as log:
+            fd = p.stdout.fileno()
+            for data in iter(lambda: os.read(fd, _LOG_BUFFER_SIZE), ''):
+                sys.stdout.write(data)
+                sys.stdout.flush()
+                log.write(data)
+        p.stdout.close()
         p.wait()
+        self._add_test_log(target, shard, p.returncode, log_path)
         result = self._get_result(p.returncode)
         console.info('%s finished : %s\n' % (test_name, result))
 
         return p.returncode
 
+    def _add_test_log(self, target, shard, returncode, log_path):
+        with self.tests_run_map_lock:
+            self.test_logs.append({
+                'target': target.fullname,
+                'shard': shard[0] if shard else None,
+                'result': self._get_result(returncode),
+                'log': log_path,
+            })
+
     def _process_job(self, job, redirect, job_thread):
         """process routine.
 
-        Each test is a tuple (target, run_dir, env, cmd)
+        Each test is a tuple (target, run_dir, env, cmd, shard), shard is
+        (index, total) if the test is sharded, or None.
 
         """
-        target = job[0]
-        start_time = time.time()
+        target, shard = job[0], job[4]
 
         try:
-            if redirect:
-                returncode = self._run_job_redirect(job, job_thread)
-            else:
-                returncode = self._run_job(job, job_thread)
-        except OSError, e:
-            console.error('%s: Create test process error: %s' %
-                          (target.fullname, str(e)))
-            returncode = 255
+            if self.prepare_job:
+                self.prepare_job(target, shard)
+        except (IOError, OSError), e:
+            console.error('%s: Prepare runfiles error: %s' % (target.fullname, str(e)))
+            returncode, costtime = 255, 0
+        else:
+            start_time = time.time()
+            try:
+                if redirect:
+                    returncode = self._run_job_redirect(job, job_thread)
+                else:
+                    returncode = self._run_job(job, job_thread)
+            except OSError, e:
+                console.error('%s: Create test process error: %s' %
+                              (target.fullname, str(e)))
+                returncode = 255
+            costtime = time.time() - start_time
 
-        costtime = time.time() - start_time
+        self.tests_run_map_lock.acquire()
+        if shard:
+            # Merge the shards as one test, failed if any shard failed
+            results = self.shard_results.setdefault(target.key, [])
+            results.append((returncode, costtime))
+            if len(results) < shard[1]:
+                self.tests_run_map_lock.release()
+                return
+            returncode = ([code for code, cost in results if code] or [0])[0]
+            costtime = sum(cost for code, cost in results)
+        run_item_map = self.tests_run_map.get(target.key, {})
+        if run_item_map:
+            run_item_map['result'] = self._get_result(returncode)
+            run_item_map['costtime'] = costtime
+        self.tests_run_map_lock.release()
 
         if returncode:
             target.data['test_exit_code'] = returncode
@@ -213,49 +347,93 @@ class TestScheduler(object):
             self.failed_targets.append(target)
             self.failed_targets_lock.release()
 
-        self.tests_run_map_lock.acquire()
-        run_item_map = self.tests_run_map.get(target.key, {})
-        if run_item_map:
-            run_item_map['result'] = self._get_result(returncode)
-            run_item_map['costtime'] = costtime
-        self.tests_run_map_lock.release()
+        self._count_run_test()
 
+    def _count_run_test(self):
         self.num_of_run_tests_lock.acquire()
         self.num_of_run_tests += 1
         self.num_of_run_tests_lock.release()
 
+    def _expected_duration(self, job):
+        """Returns the expected duration of the test job.
+
+        The tests without history are assumed to be as long as the longest
+        known one, so they are started early rather than at the tail.
+        """
+        target, shard = job[0], job[4]
+        duration = self.test_durations.get(target.key)
+        if duration is None:
+            return max(self.test_durations.values() or [0])
+        if shard:
+            return duration / shard[1]
+        return duration
+
+    def _sort_jobs(self, jobs):
+        """Sort the jobs by longest expected duration first. """
+        return sorted(jobs, key=self._expected_duration, reverse=True)
+
+    def _predict_makespan(self, jobs, exclusive_jobs, num_of_workers):
+        """Predict the wall time of the jobs scheduled onto the workers. """
+        workers = [0] * num_of_workers
+        for job in jobs:
+            i = workers.index(min(workers))
+            workers[i] += self._expected_duration(job)
+        return max(workers) + sum(self._expected_duration(job) for job in exclusive_jobs)
+
     def print_summary(self):
         """print the summary output of tests. """
-        console.info('There are %d tests scheduled to run by scheduler' % (len(self.tests_list)))
-
-    def _join_thread(self, t):
-        """Join thread and keep signal awareable"""
-        # The Thread.join without timeout will block signals, which makes
-        # blade can't be terminated by Ctrl-C
-        while t.isAlive():
-            t.join(1)
+        console.info('There are %d tests scheduled to run by scheduler' % self.num_of_tests)
+        if self.test_durations:
+            console.info('Tests makespan: predicted %.2fs, actual %.2fs' % (
+                         self.predicted_makespan, self.actual_makespan))
+
+    def _start_workers(self, jobs, num_of_workers, redirect):
+        """Start the workers to run the jobs, returns the workers. """
+        job_queue = Queue.Queue(0)
+        for job in jobs:
+            job_queue.put(job)
+        for i in range(num_of_workers):
+            job_queue.put(None)
+        threads = []
+        for i in range(num_of_workers):
+            t = WorkerThread(len(self.workers), job_queue, self._process_job,
+                             redirect, self.events)
+            t.start()
+            threads.append(t)
+            self.workers.append(t)
+        return threads
 
     def _wait_worker_threads(self, threads):
-        """Wait for worker threads to complete. """
+        """Wait for worker threads to complete.
+
+        The timeouts of the jobs are kept in a heap, so the scheduler
+        sleeps until either the next timeout or the next event.
+        """
         test_timeout = config.get_item('global_config', 'test_timeout')
+        threads = set(threads)
+        timers = []
         try:
             while threads:
-                time.sleep(1)  # Check every second
+                timeout = None
+                if timers:
+                    timeout = max(0, timers[0][0] - time.time())
+                for event in self.events.wait(timeout):
+                    if event[0] == 'exit':
+                        threads.discard(event[1])
+                    elif event[0] == 'start' and test_timeout is not None:
+                        kind, t, serial, deadline = event
+                        heapq.heappush(timers, (deadline, next(self.timer_seq), t, serial))
                 now = time.time()
-                dead_threads = []
-                for t in threads:
-                    if t.isAlive():
-                        if test_timeout is not None:
-                            t.check_job_timeout(now)
-                    else:
-                        dead_threads.append(t)
-
-                for dt in dead_threads:
-                    threads.remove(dt)
+                while timers and timers[0][0] <= now:
+                    deadline, seq, t, serial = heapq.heappop(timers)
+                    t.check_job_timeout(serial)
         except KeyboardInterrupt:
             console.error('KeyboardInterrupt: Terminate workers...')
-            for t in threads:
+            for t in self.workers:
                 t.terminate()
+            # Their jobs are terminated, so they exit soon
+            for t in self.workers:
+                t.join()
             raise
 
     def schedule_jobs(self):
@@ -266,26 +444,28 @@ class TestScheduler(object):
         num_of_workers = self._get_workers_num()
         console.info('spawn %d worker(s) to run tests' % num_of_workers)
 
+        jobs, exclusive_jobs = [], []
         for i in self.tests_list:
             target = i[0]
             if target.data.get('exclusive'):
-                self.exclusive_job_queue.put(i)
+                exclusive_jobs.append(i)
             else:
-                self.job_queue.put(i)
+                jobs.append(i)
+        # Longest processing time first, so a long test does not start
+        # at the tail and leave the other workers idle
+        jobs = self._sort_jobs(jobs)
+        exclusive_jobs = self._sort_jobs(exclusive_jobs)
+        self.predicted_makespan = self._predict_makespan(jobs, exclusive_jobs,
+                                                         num_of_workers)
+        start_time = time.time()
 
         redirect = num_of_workers > 1
-        threads = []
-        for i in range(num_of_workers):
-            t = WorkerThread(i, self.job_queue, self._process_job, redirect)
-            t.start()
-            threads.append(t)
-        self._wait_worker_threads(threads)
+        self._wait_worker_threads(self._start_workers(jobs, num_of_workers, redirect))
 
-        if not self.exclusive_job_queue.empty():
+        if exclusive_jobs:
             console.info('spawn 1 worker to run exclusive tests')
-            last_t = WorkerThread(num_of_workers, self.exclusive_job_queue,
-                                  self._process_job, False)
-            last_t.start()
-            self._wait_worker_threads([last_t])
+            self._wait_worker_threads(self._start_workers(exclusive_jobs, 1, False))
+        self.events.close()
 
+        self.actual_makespan = time.time() - start_time
         self.print_summary()
@@ -27,42 +27,33 @@ The toolchain function is defined as follows:
 """
 
 import os
+import resource
 import sys
 import subprocess
 import shutil
-import socket
-import time
 import zipfile
 import tarfile
 
 import blade_util
 import console
 import fatjar
+import resource_usage
+import version_stamp
 
 
 def generate_scm_entry(args):
-    scm, revision, url, profile, compiler = args
-    f = open(scm, 'w')
-    f.write('''
-/* This file was generated by blade */
-extern "C" {
-namespace binary_version {
-  extern const int kSvnInfoCount = 1;
-  extern const char* const kSvnInfo[] = {"%s\\n"};
-  extern const char kBuildType[] = "%s";
-  extern const char kBuildTime[] = "%s";
-  extern const char kBuilderName[] = "%s";
-  extern const char kHostName[] = "%s";
-  extern const char kCompiler[] = "%s";
-}}
-
-''' % ('%s@%s' % (url, revision),
-       profile,
-       time.asctime(),
-       os.getenv('USER'),
-       socket.gethostname(),
-       compiler))
-    f.close()
+    scm, profile, compiler = args
+    version_stamp.generate_version_source(scm, profile, compiler)
+
+
+def generate_remote_compile_entry(args):
+    # Compile locally if the remote executor is not running
+    return subprocess.call(args)
+
+
+def generate_stamp_entry(args):
+    output, binary, stamp_file = args
+    return version_stamp.stamp_binary(binary, stamp_file, output)
 
 
 _PACKAGE_MANIFEST = 'MANIFEST.TXT'
@@ -271,8 +262,16 @@ then
   coverage_options="%s"
 fi
 
-exec java $coverage_options -classpath %s %s %s $@
-""" % (_generate_java_test_coverage_flag(targetundertestpkg), ':'.join(jars), main_class, args))
+test_classes="%s"
+if [ -n "$GTEST_TOTAL_SHARDS" ]
+then
+  # Run the test classes of this shard
+  test_classes=`echo $test_classes | tr ' ' '\\n' |
+                awk -v n="$GTEST_TOTAL_SHARDS" -v i="$GTEST_SHARD_INDEX" '(NR - 1) %% n == i'`
+fi
+
+exec java $coverage_options -classpath %s %s $test_classes $@
+""" % (_generate_java_test_coverage_flag(targetundertestpkg), args, ':'.join(jars), main_class))
     f.close()
     os.chmod(script, 0755)
 
@@ -520,8 +519,18 @@ def generate_python_binary_entry(args):
     generate_python_binary(args[0], args[1], args[2], args[3:])
 
 
+def generate_rusage_entry(args):
+    log, rule, output, cmd = args
+    returncode = subprocess.call(cmd, shell=True)
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    resource_usage.record(log, rule, output, maxrss)
+    return returncode
+
+
 toolchains = {
     'scm' : generate_scm_entry,
+    'stamp' : generate_stamp_entry,
+    'remote_compile' : generate_remote_compile_entry,
     'package' : generate_package_entry,
     'securecc_object' : generate_securecc_object_entry,
     'resource_index' : generate_resource_index_entry,
@@ -536,16 +545,23 @@ toolchains = {
     'shell_testdata' : generate_shell_testdata_entry,
     'python_library' : generate_python_library_entry,
     'python_binary' : generate_python_binary_entry,
+    'rusage' : generate_rusage_entry,
 }
 
 
-if __name__ == '__main__':
-    name = sys.argv[1]
+def run(args):
+    """Run the toolchain function with the args, returns the exit code. """
+    name = args[0]
     try:
-        ret = toolchains[name](sys.argv[2:])
+        ret = toolchains[name](args[1:])
     except Exception as e:
         ret = 1
         console.error(str(e))
+    return ret or 0
+
+
+if __name__ == '__main__':
+    ret = run(sys.argv[1:])
     if ret:
         sys.exit(ret)
 
@@ -0,0 +1,56 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   May 14, 2018
+
+
+"""
+ The client of the toolchain server, which is run by the ninja actions
+ with `python -S` to start as fast as possible, so it only imports the
+ builtin modules.
+
+ Usage: toolchain_client.py socket builder args...
+
+ The action runs in a fresh `python -m toolchain` instead if the server
+ is not available, so the blade path should be in PYTHONPATH.
+
+"""
+
+
+import json
+import os
+import socket
+import sys
+
+
+def _run_locally(args):
+    os.execv(sys.executable, [sys.executable, '-m', 'toolchain'] + args)
+
+
+def main():
+    path, args = sys.argv[1], sys.argv[2:]
+    request = {'cwd': os.getcwd(), 'env': dict(os.environ), 'args': args}
+    try:
+        request = json.dumps(request)
+    except UnicodeDecodeError:
+        # Not utf-8, can not be passed in json
+        _run_locally(args)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        _run_locally(args)
+    sock.sendall(request + '\n')
+    response = sock.makefile('rb')
+    # The response is the exit code followed by the output of the action
+    line = response.readline()
+    if not line:
+        # The server exited before running the action
+        _run_locally(args)
+    sys.stdout.write(response.read())
+    sys.stdout.flush()
+    sys.exit(int(line))
+
+
+if __name__ == '__main__':
+    main()
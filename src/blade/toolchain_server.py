@@ -0,0 +1,130 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   May 14, 2018
+
+
+"""
+ This module runs a persistent toolchain server during the ninja build,
+ so the toolchain actions do not pay for starting python and importing
+ the blade modules each time.
+
+ The server is forked from blade with the toolchain modules imported, and
+ forks again for each action, in which the working dir and environment of
+ the action are restored and its output is captured and sent back to the
+ client with the exit code. See toolchain_client for the client side.
+
+"""
+
+
+import inspect
+import json
+import os
+import signal
+import SocketServer
+import sys
+import tempfile
+
+import console
+import toolchain
+import toolchain_client
+
+
+_SOCKET = '.blade_toolchain.sock'
+
+_CLIENT = '.blade_toolchain_client.py'
+
+
+def socket_path(build_dir):
+    """Returns the path of the unix socket the server listens on.
+
+    It is relative to the blade root dir where the actions run, to keep
+    it short enough for a unix socket.
+    """
+    return os.path.join(build_dir, _SOCKET)
+
+
+def client_path(build_dir):
+    """Returns the path of the client script copied into the build dir.
+
+    The client is copied out so it can be run even if blade is in a zip.
+    """
+    return os.path.join(build_dir, _CLIENT)
+
+
+def write_client(build_dir):
+    """Write the client script unless it is unchanged. """
+    path = client_path(build_dir)
+    content = inspect.getsource(toolchain_client)
+    if os.path.isfile(path) and open(path).read() == content:
+        return
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+class _ToolchainRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        output = tempfile.TemporaryFile()
+        # The subprocesses of the action write into the output too
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(output.fileno(), 1)
+        os.dup2(output.fileno(), 2)
+        try:
+            os.chdir(request['cwd'])
+            os.environ.clear()
+            for name, value in request['env'].iteritems():
+                os.environ[name.encode('utf-8')] = value.encode('utf-8')
+            ret = toolchain.run([arg.encode('utf-8') for arg in request['args']])
+        except SystemExit as e:
+            ret = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception as e:
+            console.error(str(e))
+            ret = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        output.seek(0)
+        self.wfile.write('%d\n' % ret)
+        self.wfile.write(output.read())
+
+
+class _ToolchainServer(SocketServer.ForkingMixIn, SocketServer.UnixStreamServer):
+    # The concurrency is limited by the jobs number of ninja
+    max_children = 1024
+
+
+def start(build_dir):
+    """Fork the server and returns its pid, None if failed. """
+    path = socket_path(build_dir)
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        server = _ToolchainServer(path, _ToolchainRequestHandler)
+    except Exception as e:
+        console.warning('Failed to start toolchain server: %s' % e)
+        return None
+    console.flush()
+    pid = os.fork()
+    if pid == 0:
+        # Run the actions like they are run by python -m toolchain
+        console.set_log_file(os.devnull)
+        console.color_enabled = False
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            server.serve_forever()
+        finally:
+            os._exit(0)
+    server.server_close()
+    return pid
+
+
+def stop(build_dir, pid):
+    """Stop the server started by start. """
+    if pid is None:
+        return
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+    path = socket_path(build_dir)
+    if os.path.exists(path):
+        os.remove(path)
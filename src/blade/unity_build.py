@@ -0,0 +1,177 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   April 16, 2018
+
+
+"""
+ This module batches the C++ sources of a target into unity files, and
+ keeps the state of the sources which should be compiled separately.
+
+"""
+
+
+import json
+import os
+import time
+
+
+# The unity files failed to compile, appended by the compile actions
+_FAILURE_LOG = '.blade_unity_failure.log'
+
+_STATE_FILE = '.blade_unity.json'
+
+_state = None
+
+
+def failure_log_path(build_dir):
+    """Returns the path of the log file the failed unity files append to. """
+    return os.path.join(build_dir, _FAILURE_LOG)
+
+
+def _sources_of_unity_file(path):
+    sources = []
+    try:
+        for line in open(path):
+            if line.startswith('#include "'):
+                sources.append(line[len('#include "'):].rstrip().rstrip('"'))
+    except IOError:
+        pass
+    return sources
+
+
+def _unexpired(sources, hours, now):
+    return dict((source, t) for source, t in sources.iteritems()
+                if t + hours * 3600 > now)
+
+
+def load_state(build_dir, isolation_hours, exclusion_hours):
+    """Load the state and merge the failures of last build into it.
+
+    The state consists of:
+        suspected: the sources of the failed unity files, compiled
+                   separately until they compile, and when they failed
+        retried: the suspected sources which compiled separately, put
+                 back into the unity files once
+        excluded: the sources which compile separately but failed again
+                  in the unity files, and when they failed
+        isolated: the recently edited sources and when they were edited
+        time: when the unity files were generated last time
+
+    So a genuine compile error in a batch does not turn off the unity
+    build of its sources, and the exclusions expire like the isolations.
+    """
+    global _state
+    state_file = os.path.join(build_dir, _STATE_FILE)
+    _state = {'suspected': {}, 'retried': {}, 'excluded': {}, 'isolated': {}, 'time': 0}
+    if os.path.exists(state_file):
+        try:
+            _state.update(json.load(open(state_file)))
+        except ValueError:
+            pass
+    if not isinstance(_state['excluded'], dict):
+        _state['excluded'] = {}  # Permanent exclusions of the old versions
+    _state['build_dir'] = build_dir
+    now = time.time()
+    failed = set()
+    log = failure_log_path(build_dir)
+    if os.path.exists(log):
+        for line in open(log):
+            failed.update(_sources_of_unity_file(line.strip()))
+        os.remove(log)
+    for source in failed:
+        if source in _state['retried']:
+            _state['excluded'][source] = int(now)
+        else:
+            _state['suspected'][source] = int(now)
+    # The other retried sources compiled in the unity files
+    _state['retried'] = {}
+    _state['suspected'] = _unexpired(_state['suspected'], exclusion_hours, now)
+    _state['excluded'] = _unexpired(_state['excluded'], exclusion_hours, now)
+    _state['isolated'] = _unexpired(_state['isolated'], isolation_hours, now)
+
+
+def save_state():
+    if _state is None:
+        return
+    state = dict(_state)
+    build_dir = state.pop('build_dir')
+    state['time'] = time.time()
+    if not os.path.isdir(build_dir):
+        os.makedirs(build_dir)
+    json.dump(state, open(os.path.join(build_dir, _STATE_FILE), 'w'))
+
+
+def _compiled_since(obj, source, since):
+    """Whether the separate object of the source was compiled successfully since then. """
+    try:
+        obj_mtime = os.path.getmtime(obj)
+        return obj_mtime >= since and obj_mtime >= os.path.getmtime(source)
+    except OSError:
+        return False
+
+
+def _separated(source, obj):
+    try:
+        mtime = os.path.getmtime(source)
+    except OSError:
+        return True
+    suspected = _state['suspected']
+    if source in suspected:
+        if not _compiled_since(obj, source, suspected[source]):
+            return True
+        # It compiles separately, retry it in the unity file once
+        del suspected[source]
+        _state['retried'][source] = int(time.time())
+    if source in _state['excluded']:
+        return True
+    if source in _state['isolated']:
+        return True
+    # Edited since last generation, isolate it to avoid recompiling the
+    # whole batch on each following edit
+    if _state['time'] and mtime > _state['time']:
+        _state['isolated'][source] = int(mtime)
+        return True
+    return False
+
+
+def batch_sources(objects, batch_size):
+    """Batch the sources for unity files.
+
+    The objects map each source to its object when compiled separately.
+
+    Returns the (index, sources) of batches and the sources to be compiled
+    separately.
+
+    The batches are split from all the sources in order, so isolating
+    or excluding a source only changes the batch it belongs to.
+    """
+    sources = sorted(objects)
+    if _state is None or batch_size < 2:
+        return [], sources
+    batches, separated_sources = [], []
+    for i in range(0, len(sources), batch_size):
+        batch = []
+        for source in sources[i:i + batch_size]:
+            if _separated(source, objects[source]):
+                separated_sources.append(source)
+            else:
+                batch.append(source)
+        if len(batch) > 1:
+            batches.append((i / batch_size, batch))
+        else:
+            separated_sources += batch
+    return batches, separated_sources
+
+
+def write_unity_file(path, sources):
+    """Write the unity file unless it is unchanged to avoid recompiling. """
+    content = '// Generated by blade, do not edit\n'
+    content += ''.join('#include "%s"\n' % source for source in sources)
+    if os.path.isfile(path) and open(path).read() == content:
+        return
+    dir = os.path.dirname(path)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    with open(path, 'w') as f:
+        f.write(content)
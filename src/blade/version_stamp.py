@@ -0,0 +1,175 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   May 07, 2018
+
+
+"""
+ This module generates the version information linked into the binaries.
+
+ The version source only contains the information which rarely changes,
+ such as the build type and the compiler, so it is not regenerated and
+ the binaries are not relinked on every build. The scm info, build time,
+ builder and host are reserved as fixed size sections in the binaries,
+ which are only filled in after linking when stamping is requested by
+ the --stamp option.
+
+"""
+
+
+import json
+import os
+import subprocess
+import tempfile
+
+import blade_util
+import console
+
+
+_STAMP_FILE = 'stamp.json'
+
+# (symbol, section, size) of the stamped fields
+_STAMP_FIELDS = [
+    ('kSvnInfoData', '.blade_version.scm', 4096),
+    ('kBuildTime', '.blade_version.build_time', 64),
+    ('kBuilderName', '.blade_version.builder_name', 64),
+    ('kHostName', '.blade_version.host_name', 256),
+]
+
+
+def stamp_file_path(build_dir):
+    """Returns the path of the file recording the values to stamp. """
+    return os.path.join(build_dir, _STAMP_FILE)
+
+
+def _c_string(s):
+    return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def generate_version_source(path, profile, compiler):
+    """Write the version source unless it is unchanged to avoid relinking. """
+    lines = ['/* This file was generated by blade, do not edit */',
+             '/* The sections are filled in by "blade build --stamp" */',
+             'extern "C" {',
+             'namespace binary_version {']
+    for symbol, section, size in _STAMP_FIELDS:
+        lines.append('  __attribute__((section("%s"), used)) char %s[%d] = "";' % (
+                     section, symbol, size))
+    lines += ['  extern const int kSvnInfoCount = 1;',
+              '  extern const char* const kSvnInfo[] = {kSvnInfoData};',
+              '  extern const char kBuildType[] = %s;' % _c_string(profile),
+              '  extern const char kCompiler[] = %s;' % _c_string(compiler),
+              '}}', '']
+    content = '\n'.join(lines)
+    if os.path.isfile(path) and open(path).read() == content:
+        return
+    dir = os.path.dirname(path)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def _exec_get_version_info(cmd, cwd):
+    env = dict(os.environ)
+    env['LC_ALL'] = 'POSIX'
+    p = subprocess.Popen(cmd,
+                         env=env,
+                         cwd=cwd,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE,
+                         shell=True)
+    stdout, stderr = p.communicate()
+    if p.returncode:
+        return None
+    return stdout
+
+
+def _get_version_info(blade_root_dir, svn_roots):
+    """Gets the version control info of the root dirs. """
+    if os.path.exists(os.path.join(blade_root_dir, '.git')):
+        version_info = _exec_get_version_info('git log -n 1', blade_root_dir)
+        return [version_info] if version_info else []
+
+    version_infos = []
+    for root_dir in sorted(svn_roots):
+        root_dir_realpath = os.path.realpath(root_dir)
+        svn_working_dir = os.path.dirname(root_dir_realpath)
+        svn_dir = os.path.basename(root_dir_realpath)
+
+        cmd = 'svn info %s' % svn_dir
+        version_info = _exec_get_version_info(cmd, svn_working_dir)
+        if not version_info:
+            cmd = 'git ls-remote --get-url && git branch | grep "*" && git log -n 1'
+            version_info = _exec_get_version_info(cmd, root_dir_realpath)
+            if not version_info:
+                console.warning('Failed to get version control info in %s' % root_dir)
+                continue
+        version_infos.append(version_info)
+    return version_infos
+
+
+def generate_stamp_file(build_dir, blade_root_dir, svn_roots):
+    """Record the values to stamp into the binaries of this build. """
+    build_time, builder, host = blade_util.build_stamp()
+    stamp = {
+        'kSvnInfoData': ''.join(_get_version_info(blade_root_dir, svn_roots)),
+        'kBuildTime': build_time,
+        'kBuilderName': builder or '',
+        'kHostName': host or '',
+    }
+    path = stamp_file_path(build_dir)
+    content = json.dumps(stamp, sort_keys=True)
+    if os.path.isfile(path) and open(path).read() == content:
+        return
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def _binary_sections(binary):
+    """Returns the sizes of the stamp sections in the binary. """
+    p = subprocess.Popen(['objdump', '-h', binary],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate()
+    if p.returncode:
+        console.warning('Failed to read sections of %s: %s' % (binary, stderr))
+        return {}
+    sections = {}
+    for line in stdout.splitlines():
+        fields = line.split()
+        # Idx Name Size VMA LMA File-off Algn
+        if len(fields) >= 3 and fields[1].startswith('.blade_version.'):
+            sections[fields[1]] = int(fields[2], 16)
+    return sections
+
+
+def stamp_binary(binary, stamp_file, output=None):
+    """Fill in the stamp sections of the binary, in place if no output.
+
+    The sections may be removed by --gc-sections or absent if the binary
+    does not embed the version, they are skipped then.
+    """
+    sections = _binary_sections(binary)
+    if not sections and not output:
+        return 0
+    stamp = json.load(open(stamp_file))
+    tmp_dir = tempfile.mkdtemp(prefix='blade_stamp_')
+    try:
+        cmd = ['objcopy']
+        for symbol, section, size in _STAMP_FIELDS:
+            if section not in sections:
+                continue
+            size = sections[section]
+            value = stamp.get(symbol, '').encode('utf-8')[:size - 1]
+            path = os.path.join(tmp_dir, section.lstrip('.'))
+            with open(path, 'wb') as f:
+                f.write(value + '\0' * (size - len(value)))
+            cmd.append('--update-section=%s=%s' % (section, path))
+        cmd.append(binary)
+        if output:
+            cmd.append(output)
+        return subprocess.call(cmd)
+    finally:
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
@@ -0,0 +1,146 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   June 1, 2018
+
+
+"""
+ This is the test module for preparing the runfiles dirs of the tests.
+
+"""
+
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import blade_test
+
+sys.path.append('..')
+import blade.blade
+from blade import binary_runner
+
+
+class _Target(object):
+    def __init__(self, testdata, writable_testdata=False):
+        self.path = 'app'
+        self.name = 'foo_test'
+        self.key = ('app', 'foo_test')
+        self.fullname = 'app:foo_test'
+        self.expanded_deps = []
+        self.data = {'testdata': testdata, 'writable_testdata': writable_testdata}
+
+
+class TestBinaryRunner(unittest.TestCase):
+    """Test symlinking, copying and reusing the test data. """
+    def setUp(self):
+        self.cur_dir = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        os.makedirs('build64_release/app')
+        os.makedirs('app/data/sub')
+        self.write('app/data/a.txt', 'a')
+        self.write('app/data/sub/b.txt', 'b')
+        self.write('app/c.txt', 'c')
+        self.runner = binary_runner.BinaryRunner.__new__(binary_runner.BinaryRunner)
+        self.runner.build_dir = 'build64_release'
+        self.runner.target_database = {}
+        self.runfiles = 'build64_release/app/foo_test.runfiles'
+
+    def tearDown(self):
+        os.chdir(self.cur_dir)
+        shutil.rmtree(self.dir)
+
+    def write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def read(self, path):
+        return open(os.path.join(self.runfiles, path)).read()
+
+    def prepare(self, target):
+        self.runner._prepare_runfiles(target)
+        # Removed after running
+        os.remove(os.path.join(self.runfiles, 'build64_release'))
+
+    def testSymlinks(self):
+        """Test that the read-only test data are symlinked and reused. """
+        target = _Target(['data', ('c.txt', 'renamed/c.txt')])
+        self.prepare(target)
+        self.assertEqual(os.path.abspath('app/data'),
+                         os.readlink(os.path.join(self.runfiles, 'data')))
+        self.assertEqual(os.path.abspath('app/c.txt'),
+                         os.readlink(os.path.join(self.runfiles, 'renamed/c.txt')))
+        self.assertEqual('b', self.read('data/sub/b.txt'))
+        inode = os.lstat(os.path.join(self.runfiles, 'data')).st_ino
+
+        # Written by the last run
+        self.write(os.path.join(self.runfiles, 'output.txt'), 'output')
+        os.mkdir(os.path.join(self.runfiles, 'tmp'))
+        self.prepare(target)
+        self.assertEqual(['data', 'renamed'], sorted(os.listdir(self.runfiles)))
+        self.assertEqual(inode, os.lstat(os.path.join(self.runfiles, 'data')).st_ino)
+
+        # The symlink replaced by the last run is linked again
+        os.remove(os.path.join(self.runfiles, 'renamed/c.txt'))
+        self.write(os.path.join(self.runfiles, 'renamed/c.txt'), 'modified')
+        self.prepare(target)
+        self.assertEqual('c', self.read('renamed/c.txt'))
+        self.assertEqual('c', open('app/c.txt').read())
+
+    def testWritableTestData(self):
+        """Test that the writable test data are copied and restored. """
+        target = _Target(['data'], writable_testdata=True)
+        self.prepare(target)
+        path = os.path.join(self.runfiles, 'data/sub/b.txt')
+        self.assertFalse(os.path.islink(path))
+        self.assertNotEqual(os.stat('app/data/sub/b.txt').st_ino, os.stat(path).st_ino)
+
+        # Modified and removed by the last run
+        self.write(os.path.join(self.runfiles, 'data/a.txt'), 'modified')
+        os.remove(path)
+        self.write(os.path.join(self.runfiles, 'data/new.txt'), 'new')
+        self.prepare(target)
+        self.assertEqual('a', self.read('data/a.txt'))
+        self.assertEqual('b', self.read('data/sub/b.txt'))
+        self.assertFalse(os.path.exists(os.path.join(self.runfiles, 'data/new.txt')))
+        self.assertEqual('a', open('app/data/a.txt').read())
+
+        # The unmodified files are reused
+        inode = os.stat(path).st_ino
+        self.prepare(target)
+        self.assertEqual(inode, os.stat(path).st_ino)
+
+    def testManifestChanged(self):
+        """Test that the runfiles dir is recreated if the test data changed. """
+        target = _Target(['data'], writable_testdata=True)
+        self.prepare(target)
+        self.write('app/data/sub/b.txt', 'changed')
+        self.write('app/data/d.txt', 'd')
+        self.prepare(target)
+        self.assertEqual('changed', self.read('data/sub/b.txt'))
+        self.assertEqual('d', self.read('data/d.txt'))
+
+        # Switched to symlinks
+        self.prepare(_Target(['data']))
+        self.assertTrue(os.path.islink(os.path.join(self.runfiles, 'data')))
+
+    def testCleanRunfiles(self):
+        """Test that only the files written by the last run are removed. """
+        os.makedirs('runfiles/data/sub')
+        os.makedirs('runfiles/tmp/sub')
+        self.write('runfiles/data/a.txt', 'a')
+        self.write('runfiles/data/b.txt', 'b')
+        self.write('runfiles/tmp/sub/c.txt', 'c')
+        os.symlink(os.path.abspath('app/data'), 'runfiles/linked')
+        binary_runner._clean_runfiles('runfiles', ['data/a.txt', 'linked'])
+        self.assertEqual(['data', 'linked'], sorted(os.listdir('runfiles')))
+        self.assertEqual(['a.txt'], os.listdir('runfiles/data'))
+        # Not walked into
+        self.assertEqual(['a.txt', 'sub'], sorted(os.listdir('runfiles/linked')))
+
+
+if __name__ == '__main__':
+    blade_test.run(TestBinaryRunner)
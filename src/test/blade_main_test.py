@@ -16,20 +16,29 @@ import sys
 import unittest
 
 sys.path.append('..')
+from binary_runner_test import TestBinaryRunner
+from build_trace_test import TestBuildTrace
 from cc_binary_test import TestCcBinary
 from cc_library_test import TestCcLibrary
+from cc_pch_test import TestCcPch
 from cc_plugin_test import TestCcPlugin
 from cc_test_test import TestCcTest
 from gen_rule_test import TestGenRule
+from hdrs_inclusion_test import TestHdrsInclusion
 from java_jar_test import TestJavaJar
 from lex_yacc_test import TestLexYacc
 from load_builds_test import TestLoadBuilds
 from proto_library_test import TestProtoLibrary
 from prebuild_cc_library_test import TestPrebuildCcLibrary
 from query_target_test import TestQuery
+from remote_execution_test import TestRemoteExecution
 from resource_library_test import TestResourceLibrary
 from swig_library_test import TestSwigLibrary
 from target_dependency_test import TestDepsAnalyzing
+from test_history_test import TestTestHistory
+from test_scheduler_test import TestTestScheduler
+from toolchain_server_test import TestToolchainServer
+from unity_build_test import TestUnityBuild
 
 from html_test_runner import HTMLTestRunner
 from test_target_test import TestTestRunner
@@ -41,6 +50,7 @@ def _main():
     suite_test.addTests([
         unittest.defaultTestLoader.loadTestsFromTestCase(TestCcLibrary),
         unittest.defaultTestLoader.loadTestsFromTestCase(TestCcBinary),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestCcPch),
         unittest.defaultTestLoader.loadTestsFromTestCase(TestCcPlugin),
         unittest.defaultTestLoader.loadTestsFromTestCase(TestCcTest),
         unittest.defaultTestLoader.loadTestsFromTestCase(TestGenRule),
@@ -53,7 +63,15 @@ def _main():
         unittest.defaultTestLoader.loadTestsFromTestCase(TestDepsAnalyzing),
         unittest.defaultTestLoader.loadTestsFromTestCase(TestQuery),
         unittest.defaultTestLoader.loadTestsFromTestCase(TestTestRunner),
-        unittest.defaultTestLoader.loadTestsFromTestCase(TestPrebuildCcLibrary)
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestPrebuildCcLibrary),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestRemoteExecution),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestHdrsInclusion),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestUnityBuild),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestTestHistory),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestTestScheduler),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestToolchainServer),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestBuildTrace),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestBinaryRunner),
         ])
 
     generate_html = len(sys.argv) > 1 and sys.argv[1].startswith('html')
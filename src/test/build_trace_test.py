@@ -0,0 +1,72 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   June 1, 2018
+
+
+"""
+ This is the test module for loading the actions of the build trace.
+
+"""
+
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import blade_test
+
+sys.path.append('..')
+import blade.blade
+from blade import build_trace
+
+
+class _Blade(object):
+    def __init__(self, build_dir):
+        self.build_dir = build_dir
+
+    def get_build_path(self):
+        return self.build_dir
+
+
+class TestBuildTrace(unittest.TestCase):
+    """Test loading the actions from .ninja_log. """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.trace = build_trace.BuildTrace(_Blade(self.dir), 'ninja')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testMultipleOutputs(self):
+        """Test that the lines of the outputs of one action are merged. """
+        with open(self.trace.ninja_log, 'w') as f:
+            f.write('# ninja log v5\n'
+                    '0\t1500\t1\tapp/libfoo.so\t1111\n'
+                    '0\t1500\t1\tapp/libfoo.so.toc\t1111\n'
+                    '0\t1500\t1\tapp/bar.o\t2222\n'
+                    '1500\t3000\t1\tapp/main\t3333\n'
+                    '1500\t3000\t1\tapp/main.dwp\t3333\n')
+        actions = self.trace._load_ninja_actions()
+        self.assertEqual(3, len(actions))
+        self.assertEqual(['app/libfoo.so', 'app/libfoo.so.toc'], actions[0]['outputs'])
+        self.assertEqual('app/libfoo.so', actions[0]['output'])
+        self.assertEqual(['app/bar.o'], actions[1]['outputs'])
+        self.assertEqual((1.5, 3.0), (actions[2]['start'], actions[2]['end']))
+
+    def testOffset(self):
+        """Test that only the actions of this building are loaded. """
+        with open(self.trace.ninja_log, 'w') as f:
+            f.write('# ninja log v5\n0\t1000\t1\tapp/old.o\t1111\n')
+        self.trace.start()
+        self.trace.stop()
+        with open(self.trace.ninja_log, 'a') as f:
+            f.write('0\t1000\t1\tapp/new.o\t2222\n')
+        self.assertEqual(['app/new.o'],
+                         [a['output'] for a in self.trace._load_ninja_actions()])
+
+
+if __name__ == '__main__':
+    blade_test.run(TestBuildTrace)
@@ -0,0 +1,52 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   April 09, 2018
+
+
+"""
+ This is the test module for the pch attribute of cc targets.
+
+"""
+
+
+import blade_test
+
+
+class TestCcPch(blade_test.TargetTest):
+    """Test pch """
+    def setUp(self):
+        """setup method. """
+        self.doSetUp('test_cc_pch')
+
+    def testGenerateRules(self):
+        """Test that the precompiled header is generated and used. """
+        self.all_targets = self.blade.analyze_targets()
+        self.rules_buf = self.blade.generate_build_rules()
+
+        self.assertIn((self.target_path, 'pch_user'), self.all_targets.keys())
+
+        self.assertTrue(self.dryRun())
+
+        wrapper = 'build64_release/test_cc_pch/pch_user.objs/pch.h'
+        com_pch_line = ''
+        com_cxx_line = ''
+        com_c_line = ''
+        for line in self.scons_output:
+            if '-x c++-header' in line:
+                com_pch_line = line
+            if 'pch_user.cpp.o -c' in line:
+                com_cxx_line = line
+            if 'pch_user_c.c.o -c' in line:
+                com_c_line = line
+
+        self.assertCxxFlags(com_pch_line)
+        self.assertIn('%s.gch' % wrapper, com_pch_line)
+        self.assertNotIn('-include', com_pch_line)
+        self.assertIn('-include %s -Winvalid-pch' % wrapper, com_cxx_line)
+        self.assertNotIn('-include', com_c_line)
+        self.assertIn('#include "test_cc_pch/pch.h"', open(wrapper).read())
+
+
+if __name__ == '__main__':
+    blade_test.run(TestCcPch)
@@ -0,0 +1,84 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   May 29, 2018
+
+
+"""
+ This is the test module for parsing the header inclusion stacks.
+
+"""
+
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import blade_test
+
+sys.path.append('..')
+import blade.blade
+from blade import cc_targets
+
+
+class TestHdrsInclusion(unittest.TestCase):
+    """Test extracting the inclusion stacks from the output of gcc -H. """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def extract(self, lines):
+        path = os.path.join(self.dir, 'foo.cc.o.H')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return cc_targets.extract_generated_hdrs_inclusion_stacks(path, 'build64_release')
+
+    def testStacks(self):
+        """Test the example in the document. """
+        stacks, unrecognized = self.extract([
+            '. ./app/example/foo.h',
+            '.. build64_release/app/example/proto/foo.pb.h',
+            '... build64_release/common/rpc/rpc_service.pb.h',
+            '. build64_release/app/example/proto/bar.pb.h',
+            '. ./common/rpc/rpc_client.h',
+            '.. /usr/include/stdio.h',
+            '... /usr/include/features.h',
+            '.. build64_release/common/rpc/rpc_options.pb.h',
+            'Multiple include guards may be useful for:',
+            './app/example/foo.h',
+        ])
+        self.assertEqual([
+            ['app/example/foo.h', 'build64_release/app/example/proto/foo.pb.h'],
+            ['build64_release/app/example/proto/bar.pb.h'],
+            ['common/rpc/rpc_client.h', 'build64_release/common/rpc/rpc_options.pb.h'],
+        ], stacks)
+        self.assertIsNone(unrecognized)
+
+    def testCompilerNotes(self):
+        """Test that the notes of the compiler are skipped. """
+        stacks, unrecognized = self.extract([
+            "cc1plus: note: '-gsplit-dwarf' is not supported with LTO, disabling",
+            '. ./app/foo.h',
+            'In file included from app/foo.cc:1:',
+            '.. build64_release/app/foo.pb.h',
+        ])
+        self.assertEqual([['app/foo.h', 'build64_release/app/foo.pb.h']], stacks)
+        self.assertIsNone(unrecognized)
+
+    def testUnrecognizedLine(self):
+        """Test that the parsing stops at the malformed lines. """
+        stacks, unrecognized = self.extract([
+            '. build64_release/app/foo.pb.h',
+            '.x app/bar.h',
+            '. build64_release/app/bar.pb.h',
+        ])
+        self.assertEqual([['build64_release/app/foo.pb.h']], stacks)
+        self.assertEqual('.x app/bar.h', unrecognized)
+
+
+if __name__ == '__main__':
+    blade_test.run(TestHdrsInclusion)
@@ -0,0 +1,203 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   May 21, 2018
+
+
+"""
+ This is the test module for the remote execution worker and executor.
+
+"""
+
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+import blade_test
+
+sys.path.append('..')
+import blade.blade
+import blade.config
+from blade import remote_execution
+from blade import remote_worker
+
+
+_TOKEN = 'secret'
+
+
+class TestRemoteExecution(unittest.TestCase):
+    """Test the protocol between the executor and the worker. """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.worker = remote_worker._Worker(self.dir, 0, 2, '127.0.0.1', _TOKEN)
+        self.address = '127.0.0.1:%d' % self.worker.server_address[1]
+        self.thread = threading.Thread(target=self.worker.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.remote_config = blade.config.get_section('remote_execution_config')
+        self.saved_config = dict(self.remote_config)
+        self.connection = None
+
+    def tearDown(self):
+        if self.connection:
+            for c in self.connection:
+                c.close()
+        self.worker.shutdown()
+        self.worker.server_close()
+        # Wait for the handlers to see the closed connections
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join()
+        shutil.rmtree(self.dir)
+        self.remote_config.update(self.saved_config)
+        remote_execution._reachable_workers = None
+
+    def request(self, header, data=''):
+        if not self.connection:
+            self.connection = remote_execution._connect(self.address, _TOKEN)
+        sock, f = self.connection
+        remote_worker.send(sock, header, data)
+        return remote_worker.receive(f)
+
+    def upload(self, data):
+        digest = remote_worker.md5(data)
+        header = self.request({'op': 'upload', 'digest': digest, 'size': len(data)}, data)[0]
+        self.assertTrue(header['ok'])
+        return digest
+
+    def testAuthentication(self):
+        """Test that the connections without the token are refused. """
+        self.assertRaises(IOError, remote_execution._connect, self.address, 'wrong')
+        sock = socket.create_connection(('127.0.0.1', self.worker.server_address[1]))
+        f = sock.makefile('rb')
+        remote_worker.send(sock, {'op': 'missing', 'digests': []})
+        self.assertFalse(remote_worker.receive(f)[0]['ok'])
+        self.assertRaises(IOError, remote_worker.receive, f)
+        f.close()
+        sock.close()
+        self.assertRaises(ValueError, remote_worker._Worker, self.dir, 0, 1, '127.0.0.1')
+
+    def testAllowedHosts(self):
+        """Test that only the allowed hosts are served. """
+        worker = remote_worker._Worker(self.dir, 0, 1, '127.0.0.1',
+                                       allowed_hosts=['10.255.255.1'])
+        self.assertFalse(worker.verify_request(None, ('127.0.0.1', 1234)))
+        self.assertTrue(worker.verify_request(None, ('10.255.255.1', 1234)))
+        worker.server_close()
+
+    def testCas(self):
+        """Test uploading, querying and downloading the contents. """
+        data = 'int main() {}\n'
+        digest = remote_worker.md5(data)
+        self.assertEqual([digest], self.request({'op': 'missing', 'digests': [digest]})[0]['missing'])
+        header = self.request({'op': 'upload', 'digest': 'f' * 32, 'size': len(data)}, data)[0]
+        self.assertFalse(header['ok'])
+        self.upload(data)
+        self.assertEqual([], self.request({'op': 'missing', 'digests': [digest]})[0]['missing'])
+        self.assertEqual(data, self.request({'op': 'download', 'digest': digest})[1])
+        self.assertTrue(self.worker.has(digest))
+        self.assertEqual(data, self.worker.get(digest))
+
+    def testInvalidDigest(self):
+        """Test that the digests are not used as paths. """
+        self.assertRaises(ValueError, self.worker.get, '../../etc/passwd')
+        self.assertRaises(IOError, self.request, {'op': 'download', 'digest': '../cas'})
+
+    def testExecute(self):
+        """Test executing an action and downloading its outputs. """
+        digest = self.upload('hello\n')
+        action = {'op': 'execute', 'command': 'cp a/in.txt b/out.txt',
+                  'inputs': {'a/in.txt': digest}, 'outputs': ['b/out.txt']}
+        result = self.request(action)[0]
+        self.assertEqual(0, result['exit_code'])
+        self.assertEqual({'b/out.txt': digest}, result['outputs'])
+        self.assertEqual([], os.listdir(self.worker.exec_dir))
+
+        action['command'] = 'false'
+        result = self.request(action)[0]
+        self.assertEqual(1, result['exit_code'])
+        self.assertEqual({}, result['outputs'])
+
+    def testInputsNotShared(self):
+        """Test that an action writing its inputs does not change the CAS. """
+        digest = self.upload('hello\n')
+        action = {'op': 'execute', 'command': 'echo corrupted > in.txt; cp in.txt out.txt',
+                  'inputs': {'in.txt': digest}, 'outputs': ['out.txt']}
+        self.assertEqual(0, self.request(action)[0]['exit_code'])
+        self.assertEqual('hello\n', self.worker.get(digest))
+
+    def testActionCache(self):
+        """Test that the least recently used results are evicted. """
+        saved_size = remote_worker._ACTION_CACHE_SIZE
+        remote_worker._ACTION_CACHE_SIZE = 2
+        try:
+            digest = self.upload('hello\n')
+            log = os.path.join(self.dir, 'run.log')
+            actions = [{'op': 'execute', 'command': 'echo %d >> %s; cp in.txt out.txt' % (i, log),
+                        'inputs': {'in.txt': digest}, 'outputs': ['out.txt']}
+                       for i in range(3)]
+            for i in [0, 1, 0, 2, 0, 1]:
+                self.assertEqual(0, self.request(actions[i])[0]['exit_code'])
+            # actions[1] is evicted by actions[2] since actions[0] is used recently
+            self.assertEqual('0\n1\n2\n1\n', open(log).read())
+            self.assertEqual(2, len(self.worker.action_cache))
+        finally:
+            remote_worker._ACTION_CACHE_SIZE = saved_size
+
+    def testInvalidPaths(self):
+        """Test that the paths out of the exec root are rejected. """
+        digest = self.upload('hello\n')
+        for inputs, outputs in [({'../in.txt': digest}, ['out.txt']),
+                                ({'/tmp/in.txt': digest}, ['out.txt']),
+                                ({'in.txt': digest}, ['a/../../out.txt']),
+                                ({'in.txt': digest}, [self.dir + '/out.txt'])]:
+            result = self.request({'op': 'execute', 'command': 'cp in.txt out.txt',
+                                   'inputs': inputs, 'outputs': outputs})[0]
+            self.assertEqual(1, result['exit_code'])
+            self.assertIn('Invalid path', result['output'])
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'out.txt')))
+
+    def testProbeWorkers(self):
+        """Test that the unavailable workers are not counted in the slots. """
+        # Find a port nobody listens on
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        dead = '127.0.0.1:%d' % sock.getsockname()[1]
+        sock.close()
+        token_file = os.path.join(self.dir, 'token')
+        with open(token_file, 'w') as f:
+            f.write(_TOKEN + '\n')
+        self.remote_config.update({'enabled': True, 'workers': [self.address, dead],
+                                   'token_file': token_file, 'local_workers': 0,
+                                   'worker_jobs': 3})
+        self.assertEqual([self.address], remote_execution._probe_workers())
+
+        remote_execution._reachable_workers = None
+        with open(token_file, 'w') as f:
+            f.write('wrong')
+        self.assertEqual([], remote_execution._probe_workers())
+
+    def testCompileCommand(self):
+        """Test splitting the compile command into the local and remote parts. """
+        command = remote_execution._CompileCommand(
+                ['ccache', 'g++', '-Ifoo', '-DX=1', '-O2', '-gsplit-dwarf',
+                 '-MMD', '-MF', 'a.o.d', '-c', '-o', 'a.o', 'a.cc'])
+        self.assertTrue(command.remotable())
+        self.assertEqual('a.cc', command.source)
+        self.assertEqual(['a.o', 'a.dwo'], command.outputs())
+        remote = command.remote_command('/src')
+        self.assertIn('-O2', remote)
+        self.assertNotIn('-Ifoo', remote)
+        self.assertNotIn('-MF', remote)
+        self.assertIn('a.o.ii', remote)
+        self.assertFalse(remote_execution._CompileCommand(
+                ['g++', '-fprofile-use=x', '-c', '-o', 'a.o', 'a.cc']).remotable())
+
+
+if __name__ == '__main__':
+    blade_test.run(TestRemoteExecution)
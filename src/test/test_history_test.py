@@ -0,0 +1,213 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   May 30, 2018
+
+
+"""
+ This is the test module for the incremental test history.
+
+"""
+
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import blade_test
+
+sys.path.append('..')
+import blade.blade
+from blade import test_history
+from blade import test_runner
+
+
+class TestTestHistory(unittest.TestCase):
+    """Test the sqlite history of the incremental tests. """
+    def setUp(self):
+        self.md5sum_file = test_runner.md5sum_file
+        self.cur_dir = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.history = test_history.TestHistory()
+
+    def tearDown(self):
+        test_runner.md5sum_file = self.md5sum_file
+        self.history.close()
+        os.chdir(self.cur_dir)
+        shutil.rmtree(self.dir)
+
+    def reopen(self):
+        self.history.close()
+        self.history = test_history.TestHistory()
+
+    def runner(self):
+        """Returns a test runner using the history, which records the
+        files hashed by it.
+        """
+        runner = test_runner.TestRunner.__new__(test_runner.TestRunner)
+        runner.history = self.history
+        runner.inctest_time = time.time()
+        self.hashed = []
+        def md5sum_file(path):
+            self.hashed.append(path)
+            return self.md5sum_file(path)
+        test_runner.md5sum_file = md5sum_file
+        return runner
+
+    def write(self, path, content, mtime):
+        with open(path, 'w') as f:
+            f.write(content)
+        os.utime(path, (mtime, mtime))
+
+    def testSchema(self):
+        """Test creating the tables and removing the legacy stamp file. """
+        self.history.close()
+        open(test_history._LEGACY_STAMP_FILE, 'w').close()
+        self.history = test_history.TestHistory()
+        self.assertFalse(os.path.exists(test_history._LEGACY_STAMP_FILE))
+        tables = [row[0] for row in self.history.db.execute(
+                  "SELECT name FROM sqlite_master WHERE type = 'table'")]
+        self.assertEqual(['digests', 'durations', 'meta', 'tests'], sorted(tables))
+
+    def testCorruptedHistory(self):
+        """Test that the corrupted history is recreated. """
+        self.history.close()
+        with open(test_history._HISTORY_FILE, 'w') as f:
+            f.write('not a sqlite database' * 100)
+        self.history = test_history.TestHistory()
+        self.assertFalse(self.history.loaded)
+        self.assertEqual({}, self.history.get_tests(['app:foo_test']))
+
+    def testMeta(self):
+        """Test storing the json values. """
+        self.assertEqual('none', self.history.get_meta('env', 'none'))
+        self.history.set_meta('env', {'PATH': '/bin', 'args': [1, 2]})
+        self.reopen()
+        self.assertEqual({'PATH': '/bin', 'args': [1, 2]}, self.history.get_meta('env'))
+
+    def testTests(self):
+        """Test recording the results and the recent durations. """
+        digests = ('binary', 'data')
+        self.history.update_test('app:foo_test', 'foo_test', digests)
+        tests = self.history.get_tests(['app:foo_test', 'app:bar_test'])
+        self.assertEqual(['app:foo_test'], tests.keys())
+        self.assertIsNone(tests['app:foo_test']['result'])
+        self.assertEqual(0, tests['app:foo_test']['runs'])
+
+        for i in range(test_history._MAX_DURATIONS + 2):
+            result = 'FAILURE' if i % 2 else 'SUCCESS'
+            self.history.update_test('app:foo_test', 'foo_test', digests, result, i)
+        self.reopen()
+        test = self.history.get_tests(['app:foo_test'])['app:foo_test']
+        self.assertEqual('FAILURE', test['result'])
+        self.assertEqual(test_history._MAX_DURATIONS + 2, test['runs'])
+        self.assertEqual(test_history._MAX_DURATIONS / 2 + 1, test['failures'])
+        self.assertEqual(range(2, test_history._MAX_DURATIONS + 2), test['durations'])
+        self.assertEqual('binary', test['binary_digest'])
+        self.assertEqual('data', test['data_digest'])
+
+    def testManyTests(self):
+        """Test querying more tests than the variables limit of sqlite. """
+        names = ['app:test_%d' % i for i in range(test_history._QUERY_BATCH_SIZE * 2 + 1)]
+        for name in names:
+            self.history.update_test(name, name, ('b', 'd'), 'SUCCESS', 1.0)
+        tests = self.history.get_tests(names)
+        self.assertEqual(len(names), len(tests))
+        self.assertEqual([1.0], tests[names[-1]]['durations'])
+
+    def testDigests(self):
+        """Test that the digest is only returned for the unchanged file. """
+        key = (1234, 10, 1527000000.5)
+        self.assertIsNone(self.history.get_digest('app/foo.txt', key))
+        self.history.set_digest('app/foo.txt', key, 'digest')
+        self.assertEqual('digest', self.history.get_digest('app/foo.txt', key))
+        self.assertEqual('digest', self.history.get_digest('app/foo.txt', list(key)))
+        self.assertIsNone(self.history.get_digest('app/foo.txt', (1234, 11, 1527000000.5)))
+        self.history.set_digest('app/foo.txt', (1234, 11, 1527000001.5), 'new_digest')
+        self.assertEqual('new_digest',
+                         self.history.get_digest('app/foo.txt', (1234, 11, 1527000001.5)))
+
+    def testFileDigestCache(self):
+        """Test that only the changed files are hashed again. """
+        old = time.time() - 3600
+        self.write('foo.txt', 'foo', old)
+        runner = self.runner()
+        digest = runner._file_digest('foo.txt')
+        self.assertEqual(self.md5sum_file('foo.txt'), digest)
+        self.assertEqual(digest, runner._file_digest('foo.txt'))
+        self.assertEqual(['foo.txt'], self.hashed)
+
+        # Cached across the runs
+        self.reopen()
+        runner = self.runner()
+        self.assertEqual(digest, runner._file_digest('foo.txt'))
+        self.assertEqual([], self.hashed)
+
+        # Same size, different mtime
+        self.write('foo.txt', 'bar', old + 1)
+        self.assertEqual(self.md5sum_file('foo.txt'), runner._file_digest('foo.txt'))
+        self.assertEqual(['foo.txt'], self.hashed)
+
+    def testRecentlyModifiedFile(self):
+        """Test that the files modified within the mtime resolution are not cached. """
+        runner = self.runner()
+        self.write('foo.txt', 'foo', runner.inctest_time)
+        runner._file_digest('foo.txt')
+        # May be modified again without changing the mtime
+        self.write('foo.txt', 'bar', runner.inctest_time)
+        self.assertEqual(self.md5sum_file('foo.txt'), runner._file_digest('foo.txt'))
+        self.assertEqual(['foo.txt', 'foo.txt'], self.hashed)
+
+    def testDirDigest(self):
+        """Test the digests of the directories. """
+        old = time.time() - 3600
+        os.makedirs('data/sub')
+        self.write('data/a.txt', 'a', old)
+        self.write('data/sub/b.txt', 'b', old)
+        runner = self.runner()
+        digest = runner._path_digest('data')
+        self.assertEqual(digest, runner._path_digest('data'))
+        self.assertEqual(2, len(self.hashed))
+
+        # Changed by the content, the name and the new files in any level
+        self.write('data/sub/b.txt', 'c', old + 1)
+        changed = runner._path_digest('data')
+        self.assertNotEqual(digest, changed)
+        os.rename('data/sub/b.txt', 'data/sub/c.txt')
+        self.assertNotEqual(changed, runner._path_digest('data'))
+        changed = runner._path_digest('data')
+        os.makedirs('data/sub/sub2')
+        self.write('data/sub/sub2/d.txt', '', old)
+        self.assertNotEqual(changed, runner._path_digest('data'))
+        self.assertEqual(self.md5sum_file('data/a.txt'), runner._path_digest('data/a.txt'))
+
+    def testGc(self):
+        """Test removing the rows of the tests and files which no longer exist. """
+        open('foo_test', 'w').close()
+        open('foo.txt', 'w').close()
+        for name in ('foo_test', 'bar_test'):
+            self.history.update_test(name, name, ('b', 'd'), 'SUCCESS', 1.0)
+        self.history.set_digest('foo.txt', (1, 1, 1), 'digest')
+        self.history.set_digest('bar.txt', (1, 1, 1), 'digest')
+        self.history.gc()
+        self.assertEqual(['foo_test'], self.history.get_tests(['foo_test', 'bar_test']).keys())
+        self.assertEqual(1, self.history.db.execute(
+                         "SELECT COUNT(*) FROM durations").fetchone()[0])
+        self.assertIsNone(self.history.get_digest('bar.txt', (1, 1, 1)))
+        self.assertEqual('digest', self.history.get_digest('foo.txt', (1, 1, 1)))
+
+        # Not collected again until the interval passes
+        os.remove('foo_test')
+        self.history.gc()
+        self.assertEqual(['foo_test'], self.history.get_tests(['foo_test']).keys())
+        self.history.set_meta('gc_time', 0)
+        self.history.gc()
+        self.assertEqual({}, self.history.get_tests(['foo_test']))
+
+
+if __name__ == '__main__':
+    blade_test.run(TestTestHistory)
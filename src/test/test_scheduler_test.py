@@ -0,0 +1,151 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   May 30, 2018
+
+
+"""
+ This is the test module for the test scheduler.
+
+"""
+
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import blade_test
+
+sys.path.append('..')
+import blade.blade
+import blade.config
+from blade import test_scheduler
+
+
+class _Target(object):
+    """The test target scheduled by the scheduler. """
+    def __init__(self, name, **data):
+        self.key = ('app', name)
+        self.fullname = 'app:%s' % name
+        self.data = data
+
+
+class TestTestScheduler(unittest.TestCase):
+    """Test ordering, timing out and running the test jobs. """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.global_config = blade.config.get_section('global_config')
+        self.saved_test_timeout = self.global_config['test_timeout']
+
+    def tearDown(self):
+        self.global_config['test_timeout'] = self.saved_test_timeout
+        shutil.rmtree(self.dir)
+
+    def job(self, target, cmd='true', shard=None):
+        run_dir = os.path.join(self.dir, target.key[1])
+        if shard:
+            run_dir += '.shard%d' % shard[0]
+        run_dir += '.runfiles'
+        if not os.path.isdir(run_dir):
+            os.mkdir(run_dir)
+        return (target, run_dir, dict(os.environ), ['sh', '-c', cmd], shard)
+
+    def scheduler(self, jobs, num_of_jobs=1, durations=None):
+        tests_run_map = dict((job[0].key, {'result': '', 'costtime': 0}) for job in jobs)
+        return test_scheduler.TestScheduler(jobs, num_of_jobs, tests_run_map, durations)
+
+    def testLongestFirst(self):
+        """Test sorting the jobs by the expected durations. """
+        a, b, c, d = [_Target(name) for name in 'abcd']
+        jobs = [self.job(a), self.job(b), self.job(c), self.job(d, shard=(0, 4))]
+        scheduler = self.scheduler(jobs, 2, {a.key: 1.0, b.key: 5.0, d.key: 8.0})
+        # c has no history and is assumed to be as long as the longest one
+        self.assertEqual([c, b, d, a], [job[0] for job in scheduler._sort_jobs(jobs)])
+        self.assertEqual(2.0, scheduler._expected_duration(jobs[3]))
+
+        # c: 8, b: 5, d: 2, a: 1 are scheduled as [8], [5, 2, 1]
+        jobs = scheduler._sort_jobs(jobs)
+        self.assertEqual(8.0, scheduler._predict_makespan(jobs, [], 2))
+        # The exclusive jobs run after the others one by one
+        self.assertEqual(13.0, scheduler._predict_makespan(jobs[1:], jobs[:1], 2))
+
+        scheduler = self.scheduler(jobs)
+        self.assertEqual(0, scheduler._expected_duration(jobs[0]))
+
+    def testEventQueue(self):
+        """Test that the waiting scheduler is woken up by the events. """
+        events = test_scheduler._EventQueue()
+        start_time = time.time()
+        self.assertEqual([], events.wait(0.1))
+        self.assertTrue(time.time() - start_time >= 0.1)
+
+        events.put(('exit', 1))
+        events.put(('exit', 2))
+        self.assertEqual([('exit', 1), ('exit', 2)], events.wait(None))
+
+        timer = threading.Timer(0.1, events.put, [('start', 3)])
+        timer.start()
+        self.assertEqual([('start', 3)], events.wait(10))
+        timer.join()
+        events.close()
+
+    def testTimeout(self):
+        """Test that only the timeout jobs are terminated. """
+        self.global_config['test_timeout'] = 0.5
+        slow = _Target('slow', test_timeout=0.5)
+        fast = _Target('fast', test_timeout=10)
+        jobs = [self.job(slow, 'exec sleep 30'), self.job(fast, 'sleep 0.2')]
+        scheduler = self.scheduler(jobs, 2)
+        start_time = time.time()
+        scheduler.schedule_jobs()
+        self.assertTrue(time.time() - start_time < 10)
+        self.assertEqual([slow], scheduler.failed_targets)
+        self.assertEqual('SIGTERM:-15', scheduler.tests_run_map[slow.key]['result'])
+        self.assertEqual('SUCCESS', scheduler.tests_run_map[fast.key]['result'])
+        self.assertEqual(2, scheduler.num_of_run_tests)
+
+    def testShards(self):
+        """Test merging the shards into one test in tests_run_map. """
+        sharded = _Target('sharded')
+        passed = _Target('passed')
+        jobs = [self.job(sharded, 'sleep 0.1; exit $GTEST_SHARD_INDEX', (i, 3)) for i in range(3)]
+        jobs += [self.job(passed, 'sleep 0.1', (i, 2)) for i in range(2)]
+        prepared = []
+        for job in jobs:
+            job[2]['GTEST_SHARD_INDEX'] = str(job[4][0])
+        scheduler = test_scheduler.TestScheduler(
+                jobs, 4, dict((job[0].key, {'result': '', 'costtime': 0}) for job in jobs),
+                prepare_job=lambda target, shard: prepared.append((target.key, shard)))
+        self.assertEqual(2, scheduler.num_of_tests)
+        scheduler.schedule_jobs()
+        self.assertEqual(sorted((job[0].key, job[4]) for job in jobs), sorted(prepared))
+        self.assertEqual(2, scheduler.num_of_run_tests)
+        self.assertEqual([sharded], scheduler.failed_targets)
+        # The result is the first failed shard in the order of finishing
+        self.assertIn(scheduler.tests_run_map[sharded.key]['result'], ('FAILED:1', 'FAILED:2'))
+        self.assertTrue(scheduler.tests_run_map[sharded.key]['costtime'] >= 0.3)
+        self.assertEqual('SUCCESS', scheduler.tests_run_map[passed.key]['result'])
+        self.assertTrue(scheduler.tests_run_map[passed.key]['costtime'] >= 0.2)
+        self.assertEqual(5, len(scheduler.test_logs))
+        self.assertEqual([0, 1, 2], sorted(log['shard'] for log in scheduler.test_logs
+                                           if log['target'] == sharded.fullname))
+
+    def testExclusive(self):
+        """Test that the exclusive tests are run after the others. """
+        log = os.path.join(self.dir, 'order.log')
+        exclusive = _Target('exclusive', exclusive=True)
+        normal = _Target('normal')
+        jobs = [self.job(exclusive, 'echo exclusive >> %s' % log),
+                self.job(normal, 'sleep 0.2; echo normal >> %s' % log)]
+        scheduler = self.scheduler(jobs, 2)
+        scheduler.schedule_jobs()
+        self.assertEqual('normal\nexclusive\n', open(log).read())
+        self.assertEqual([], scheduler.failed_targets)
+
+
+if __name__ == '__main__':
+    blade_test.run(TestTestScheduler)
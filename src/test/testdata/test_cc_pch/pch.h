@@ -0,0 +1,8 @@
+#ifndef TEST_CC_PCH_PCH_H_
+#define TEST_CC_PCH_PCH_H_
+
+#include <map>
+#include <string>
+#include <vector>
+
+#endif  // TEST_CC_PCH_PCH_H_
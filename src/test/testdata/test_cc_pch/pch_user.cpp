@@ -0,0 +1,9 @@
+#include "test_cc_pch/pch.h"
+
+std::string JoinWords(const std::vector<std::string>& words) {
+    std::string result;
+    for (size_t i = 0; i < words.size(); ++i) {
+        result += words[i];
+    }
+    return result;
+}
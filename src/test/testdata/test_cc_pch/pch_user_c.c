@@ -0,0 +1,3 @@
+int pch_user_c(void) {
+    return 0;
+}
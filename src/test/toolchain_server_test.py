@@ -0,0 +1,100 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   May 30, 2018
+
+
+"""
+ This is the test module for the toolchain server and client.
+
+"""
+
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import blade_test
+
+sys.path.append('..')
+import blade.blade
+from blade import toolchain_server
+
+
+class TestToolchainServer(unittest.TestCase):
+    """Test running the toolchain actions through the client. """
+    def setUp(self):
+        self.blade_path = os.path.abspath(os.path.join('..', 'blade'))
+        self.dir = tempfile.mkdtemp()
+        self.build_dir = os.path.join(self.dir, 'build64_release')
+        os.mkdir(self.build_dir)
+        toolchain_server.write_client(self.build_dir)
+        self.pid = None
+
+    def tearDown(self):
+        toolchain_server.stop(self.build_dir, self.pid)
+        shutil.rmtree(self.dir)
+
+    def run_action(self, command, env=None):
+        """Run the command by the rusage toolchain action through the client,
+        returns the exit code and the output.
+        """
+        env = dict(env or os.environ)
+        env['PYTHONPATH'] = self.blade_path
+        log = os.path.join(self.dir, 'rusage.log')
+        p = subprocess.Popen([sys.executable, '-S', toolchain_server.client_path(self.build_dir),
+                              toolchain_server.socket_path(self.build_dir),
+                              'rusage', log, 'link', 'out', command],
+                             env=env, cwd=self.dir,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = p.communicate()[0]
+        return p.returncode, output
+
+    def assertActionRun(self, env=None):
+        returncode, output = self.run_action('echo $PWD $FOO; exit 3',
+                                             dict(os.environ, FOO='foo', **(env or {})))
+        self.assertEqual(3, returncode)
+        self.assertEqual('%s foo\n' % os.path.realpath(self.dir), output)
+        self.assertEqual('link\tout\t', open(os.path.join(self.dir, 'rusage.log')).read()[:9])
+
+    def testServer(self):
+        """Test that the action runs in the cwd and env of the client. """
+        self.pid = toolchain_server.start(self.build_dir)
+        self.assertTrue(self.pid)
+        self.assertTrue(os.path.exists(toolchain_server.socket_path(self.build_dir)))
+        self.assertActionRun()
+
+    def testNoServer(self):
+        """Test running the action locally if the server is not started. """
+        self.assertActionRun()
+
+    def testStoppedServer(self):
+        """Test running the action locally after the server is stopped. """
+        self.pid = toolchain_server.start(self.build_dir)
+        toolchain_server.stop(self.build_dir, self.pid)
+        self.pid = None
+        self.assertFalse(os.path.exists(toolchain_server.socket_path(self.build_dir)))
+        self.assertActionRun()
+
+    def testNonUtf8Env(self):
+        """Test running the action locally if the env can not be sent in json. """
+        self.pid = toolchain_server.start(self.build_dir)
+        self.assertActionRun({'BAR': '\xff'})
+
+    def testWriteClient(self):
+        """Test that the unchanged client is not rewritten. """
+        path = toolchain_server.client_path(self.build_dir)
+        os.utime(path, (0, 0))
+        toolchain_server.write_client(self.build_dir)
+        self.assertEqual(0, os.path.getmtime(path))
+        with open(path, 'a') as f:
+            f.write('\n')
+        toolchain_server.write_client(self.build_dir)
+        self.assertNotEqual(0, os.path.getmtime(path))
+
+
+if __name__ == '__main__':
+    blade_test.run(TestToolchainServer)
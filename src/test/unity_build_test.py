@@ -0,0 +1,160 @@
+# Copyright (c) 2018 Tencent Inc.
+# All rights reserved.
+#
+# Date:   April 16, 2018
+
+
+"""
+ This is the test module for the state of the unity build.
+
+"""
+
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import blade_test
+
+sys.path.append('..')
+import blade.blade
+from blade import unity_build
+
+
+class TestUnityBuild(unittest.TestCase):
+    """Test batching, isolating and excluding the sources. """
+    def setUp(self):
+        self.cur_dir = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.build_dir = 'build64_release'
+        os.makedirs(os.path.join(self.build_dir, 'app'))
+        os.mkdir('app')
+        self.sources = ['app/%s.cc' % name for name in 'abcd']
+        for source in self.sources:
+            open(source, 'w').close()
+            self.touch(source, time.time() - 3600)
+        self.objects = dict((source, self.obj(source)) for source in self.sources)
+
+    def tearDown(self):
+        unity_build._state = None
+        os.chdir(self.cur_dir)
+        shutil.rmtree(self.dir)
+
+    def touch(self, path, mtime):
+        if not os.path.exists(path):
+            open(path, 'w').close()
+        os.utime(path, (mtime, mtime))
+
+    def obj(self, source):
+        return os.path.join(self.build_dir, source + '.o')
+
+    def load(self, exclusion_hours=168):
+        unity_build.load_state(self.build_dir, 24, exclusion_hours)
+
+    def generate(self):
+        """Generate the unity files like a build, returns the batches and
+        the separated sources.
+        """
+        self.load()
+        batches, separated = unity_build.batch_sources(self.objects, 2)
+        self.unity_files = []
+        for index, batch in batches:
+            path = os.path.join(self.build_dir, 'app', 'unity_%d.cc' % index)
+            unity_build.write_unity_file(path, batch)
+            self.unity_files.append(path)
+        unity_build.save_state()
+        return [batch for index, batch in batches], separated
+
+    def fail(self, index):
+        """The unity file failed to compile in the build. """
+        with open(unity_build.failure_log_path(self.build_dir), 'a') as f:
+            f.write(self.unity_files[index] + '\n')
+
+    def compile(self, source):
+        """The source compiled separately in the build. """
+        self.touch(self.obj(source), time.time() + 1)
+
+    def state(self):
+        return json.load(open(os.path.join(self.build_dir, unity_build._STATE_FILE)))
+
+    def testBatches(self):
+        """Test batching the sources in order. """
+        batches, separated = self.generate()
+        self.assertEqual([['app/a.cc', 'app/b.cc'], ['app/c.cc', 'app/d.cc']], batches)
+        self.assertEqual([], separated)
+        self.assertEqual('// Generated by blade, do not edit\n'
+                         '#include "app/a.cc"\n#include "app/b.cc"\n',
+                         open(self.unity_files[0]).read())
+
+    def testIsolateEditedSource(self):
+        """Test that the edited sources are compiled separately. """
+        self.generate()
+        self.touch('app/c.cc', time.time() + 1)
+        batches, separated = self.generate()
+        self.assertEqual([['app/a.cc', 'app/b.cc']], batches)
+        self.assertEqual(['app/c.cc', 'app/d.cc'], sorted(separated))
+        self.assertIn('app/c.cc', self.state()['isolated'])
+
+    def testGenuineCompileError(self):
+        """Test that a source failing separately is not excluded. """
+        self.generate()
+        self.fail(0)
+        batches, separated = self.generate()
+        self.assertEqual([['app/c.cc', 'app/d.cc']], batches)
+        self.assertEqual(['app/a.cc', 'app/b.cc'], sorted(separated))
+
+        # b.cc compiles separately but a.cc does not
+        self.compile('app/b.cc')
+        batches, separated = self.generate()
+        self.assertEqual([['app/c.cc', 'app/d.cc']], batches)
+        self.assertEqual(['app/a.cc', 'app/b.cc'], sorted(separated))
+        self.assertEqual({'app/b.cc'}, set(self.state()['retried']))
+
+        # a.cc is fixed, both of them are retried in the unity file
+        self.compile('app/a.cc')
+        batches, separated = self.generate()
+        self.assertEqual([['app/a.cc', 'app/b.cc'], ['app/c.cc', 'app/d.cc']], batches)
+        self.assertEqual({}, self.state()['excluded'])
+
+        # The retry succeeded
+        batches, separated = self.generate()
+        self.assertEqual(2, len(batches))
+        state = self.state()
+        self.assertEqual({}, state['retried'])
+        self.assertEqual({}, state['suspected'])
+        self.assertEqual({}, state['excluded'])
+
+    def testExcludeUnityConflict(self):
+        """Test that the sources failing only in the unity file are excluded. """
+        self.generate()
+        self.fail(1)
+        self.generate()
+        self.compile('app/c.cc')
+        self.compile('app/d.cc')
+        batches, separated = self.generate()
+        self.assertEqual(2, len(batches))
+        self.fail(1)
+        batches, separated = self.generate()
+        self.assertEqual([['app/a.cc', 'app/b.cc']], batches)
+        self.assertEqual(['app/c.cc', 'app/d.cc'], sorted(separated))
+        self.assertEqual({'app/c.cc', 'app/d.cc'}, set(self.state()['excluded']))
+
+        # The exclusions expire
+        unity_build.load_state(self.build_dir, 24, 0)
+        self.assertEqual({}, unity_build._state['excluded'])
+
+    def testOldExcludedList(self):
+        """Test that the permanent exclusions of the old versions are dropped. """
+        with open(os.path.join(self.build_dir, unity_build._STATE_FILE), 'w') as f:
+            json.dump({'excluded': ['app/a.cc'], 'isolated': {}, 'time': 0}, f)
+        self.load()
+        self.assertEqual({}, unity_build._state['excluded'])
+
+
+if __name__ == '__main__':
+    blade_test.run(TestUnityBuild)